@@ -0,0 +1,197 @@
+"""
+Synthetic cohorts for benchmarking, with the shape of the datasets of
+analysis/dataset_definition_cases.py and analysis/dataset_definition_controls.py.
+
+Controls have a sex, an age, a region (the strata are the combinations of sex and
+region) and two dates used for date exclusions, died_date_ons and previous_event,
+which are missing for most patients. Cases have the same columns and an index
+date. Columns have the types of ehrQL arrow outputs: category columns are
+dictionary encoded, and dates are date32.
+
+Cohorts are generated in batches, from a random sequence seeded by the cohort's
+seed and the batch number, and written to arrow files one batch at a time, so
+that cohorts of tens of millions of controls can be generated in little memory.
+"""
+
+import dataclasses
+import hashlib
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+
+SEXES = ["female", "male", "intersex", "unknown"]
+SEX_WEIGHTS = [0.49, 0.49, 0.01, 0.01]
+MAX_AGE = 110
+# Number of rows generated and written at a time; cohorts generated with different
+# batch sizes differ
+BATCH_SIZE = 1_000_000
+# Previous events are in the years before start_date
+PREVIOUS_EVENT_DAYS = 30 * 365
+
+
+@dataclass
+class CohortSpec:
+    num_controls: int = 10_000
+    controls_per_case: int = 100
+    # number of regions; each is a stratum for each sex
+    num_regions: int = 9
+    age_mean: float = 45.0
+    age_sd: float = 22.0
+    # proportion of patients with each of the date exclusion variables
+    exclusion_date_density: float = 0.1
+    start_date: str = "2020-01-01"
+    # index dates are spread over this many days from start_date
+    index_date_days: int = 3 * 365
+    seed: int = 123
+
+    @property
+    def num_cases(self) -> int:
+        return -(-self.num_controls // self.controls_per_case)
+
+    def key(self) -> str:
+        """Identifies the cohort, for the name of the directory it's written to"""
+        spec_json = json.dumps(dataclasses.asdict(self), sort_keys=True)
+        return hashlib.blake2b(spec_json.encode(), digest_size=8).hexdigest()
+
+
+def get_schema(spec: CohortSpec, cases: bool) -> pa.Schema:
+    index_type = pa.int8() if spec.num_regions < 128 else pa.int32()
+    fields = [
+        pa.field("patient_id", pa.int64(), nullable=False),
+        pa.field("sex", pa.dictionary(pa.int8(), pa.string(), ordered=True)),
+        pa.field("age", pa.int64()),
+        pa.field("region", pa.dictionary(index_type, pa.string(), ordered=True)),
+        pa.field("died_date_ons", pa.date32()),
+        pa.field("previous_event", pa.date32()),
+    ]
+    if cases:
+        fields.insert(3, pa.field("indexdate", pa.date32()))
+    return pa.schema(fields)
+
+
+def get_region_weights(num_regions: int) -> np.ndarray:
+    """Regions differ in size; the nth largest is 1/n the size of the largest"""
+    weights = 1 / np.arange(1, num_regions + 1)
+    return weights / weights.sum()
+
+
+def get_dates(
+    rng: np.random.Generator, size: int, start: np.datetime64, days: int, density
+) -> pa.Array:
+    """Random dates in the days from start, of which the given proportion are set"""
+    dates = start + rng.integers(0, days, size).astype("timedelta64[D]")
+    missing = rng.random(size) >= density
+    return pa.array(dates, type=pa.date32(), mask=missing)
+
+
+def generate_batch(
+    spec: CohortSpec, schema: pa.Schema, first_id: int, size: int, batch_number: int
+) -> pa.RecordBatch:
+    cases = "indexdate" in schema.names
+    rng = np.random.default_rng([spec.seed, int(cases), batch_number])
+    start = np.datetime64(spec.start_date, "D")
+    regions = [f"Region {n}" for n in range(1, spec.num_regions + 1)]
+    region_type = schema.field("region").type
+    columns = {
+        "patient_id": pa.array(np.arange(first_id, first_id + size), pa.int64()),
+        "sex": pa.DictionaryArray.from_arrays(
+            rng.choice(len(SEXES), size, p=SEX_WEIGHTS).astype(np.int8),
+            SEXES,
+            ordered=True,
+        ),
+        "age": pa.array(
+            np.clip(rng.normal(spec.age_mean, spec.age_sd, size), 0, MAX_AGE).astype(
+                np.int64
+            )
+        ),
+        "region": pa.DictionaryArray.from_arrays(
+            pa.array(
+                rng.choice(
+                    spec.num_regions, size, p=get_region_weights(spec.num_regions)
+                ),
+                region_type.index_type,
+            ),
+            regions,
+            ordered=True,
+        ),
+        # deaths from the start of the index dates to a year after they end
+        "died_date_ons": get_dates(
+            rng,
+            size,
+            start,
+            spec.index_date_days + 365,
+            spec.exclusion_date_density,
+        ),
+        "previous_event": get_dates(
+            rng,
+            size,
+            start - np.timedelta64(PREVIOUS_EVENT_DAYS, "D"),
+            PREVIOUS_EVENT_DAYS,
+            spec.exclusion_date_density,
+        ),
+    }
+    if cases:
+        columns["indexdate"] = get_dates(
+            rng, size, start, spec.index_date_days, density=1
+        )
+    return pa.RecordBatch.from_arrays(
+        [columns[name] for name in schema.names], schema=schema
+    )
+
+
+def write_dataset(
+    spec: CohortSpec,
+    path: Path,
+    first_id: int,
+    size: int,
+    cases: bool,
+):
+    schema = get_schema(spec, cases)
+    with pa.ipc.new_file(path, schema) as writer:
+        for batch_number, batch_start in enumerate(range(0, size, BATCH_SIZE)):
+            writer.write_batch(
+                generate_batch(
+                    spec,
+                    schema,
+                    first_id + batch_start,
+                    min(BATCH_SIZE, size - batch_start),
+                    batch_number,
+                )
+            )
+
+
+def write_cohort(spec: CohortSpec, directory: Path) -> tuple[Path, Path]:
+    """
+    Writes the cases and controls of a cohort to cases.arrow and controls.arrow in
+    a subdirectory of directory named by the cohort's key, unless they have
+    already been written. Returns the paths of the cases and controls files.
+    Controls have patient ids from 1, and cases follow them.
+    """
+    cohort_path = directory / f"cohort_{spec.key()}"
+    cases_path = cohort_path / "cases.arrow"
+    controls_path = cohort_path / "controls.arrow"
+    if not cases_path.exists():
+        cohort_path.mkdir(parents=True, exist_ok=True)
+        write_dataset(
+            spec,
+            controls_path,
+            1,
+            spec.num_controls,
+            cases=False,
+        )
+        # the cases file is written last, so that it only exists once the cohort
+        # is complete
+        partial_path = cohort_path / "cases.arrow.partial"
+        write_dataset(
+            spec,
+            partial_path,
+            spec.num_controls + 1,
+            spec.num_cases,
+            cases=True,
+        )
+        partial_path.replace(cases_path)
+    return cases_path, controls_path
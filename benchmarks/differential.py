@@ -0,0 +1,678 @@
+"""
+Differential tests of alternative matching engines, on synthetic cohorts (see
+benchmarks.cohort).
+
+Any way of matching (an engine) must give exactly the same matched sets as the
+reference engine with the same random seed. The reference engine is the original
+matching algorithm, which compares each case with every control in turn (see
+match_cases_original); match() and the other engines replace it with faster ways
+of finding and picking eligible matches. `python -m benchmarks differential`
+generates a cohort (or reuses one generated before), matches it with the
+reference engine and another engine with each of DIFFERENTIAL_CONFIGS, and
+compares their matched cases and matches row by row. The first divergence of each
+config is reported: the output, the row, the patient id and the column where the
+outputs first differ, with the values of both engines.
+
+The configs cover category, scalar and month_only match variables, date
+exclusions, match index date offsets, min_matches_per_case,
+drop_cases_from_matches, closest_match_variables and tiers. The controls of the
+cohort don't include the cases, or have index dates, so for configs with
+drop_cases_from_matches the cases are added to the controls, and for configs
+without generate_match_index_date the controls are given random index dates.
+
+The reference engine also loads, imports and writes the data with copies of the
+original code (see load_reference_dataframe, import_reference_data and
+write_reference_results), so that changes to those parts of match() are
+compared with the original too. The matching reports, which each engine prints,
+aren't printed by the harness; they are written next to the outputs.
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from benchmarks.cohort import CohortSpec, get_dates, write_cohort
+from osmatching.osmatching import (
+    NOT_PREVIOUSLY_MATCHED,
+    add_variables,
+    date_exclusions,
+    get_date_offset,
+    get_tier_config,
+    greedily_pick_matches,
+    match,
+)
+from osmatching.partition import match_partitioned
+from osmatching.utils import (
+    MATCH_TIER_VARIABLE,
+    MatchConfig,
+    file_suffix,
+    load_dataframe,
+    parse_and_validate_config,
+)
+
+
+# An engine matches the cases and controls files with a config, and returns the
+# matched cases and matches, as match() does
+Engine = Callable[[Path, Path, MatchConfig], tuple[pd.DataFrame, pd.DataFrame]]
+OUTPUTS = ["matched_cases", "matched_matches"]
+# Partition size of the partitioned engine
+PARTITION_MEMORY_MB = 1
+# How the reference engine reads and writes each format, as the original code did
+REFERENCE_READER: dict[str, tuple] = {
+    ".csv": ("read_csv", {"engine": "pyarrow"}),
+    ".arrow": ("read_feather", {}),
+}
+REFERENCE_WRITER: dict[str, str] = {".csv": "to_csv", ".arrow": "to_feather"}
+
+DIFFERENTIAL_CONFIGS: dict[str, dict] = {
+    "category_scalar": {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "region": "category", "age": 5},
+        "generate_match_index_date": "no_offset",
+    },
+    "month_only": {
+        "matches_per_case": 2,
+        "match_variables": {"sex": "category", "age": 3, "indexdate": "month_only"},
+        "date_exclusion_variables": {"died_date_ons": "before"},
+    },
+    "date_exclusions": {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "region": "category", "age": 5},
+        "date_exclusion_variables": {
+            "died_date_ons": "before",
+            "previous_event": "after",
+        },
+        "generate_match_index_date": "no_offset",
+    },
+    "index_date_offset": {
+        "matches_per_case": 2,
+        "match_variables": {"region": "category", "age": 2},
+        "date_exclusion_variables": {"died_date_ons": "before"},
+        "generate_match_index_date": "1_year_earlier",
+    },
+    "min_matches_per_case": {
+        "matches_per_case": 5,
+        "min_matches_per_case": 3,
+        "match_variables": {"sex": "category", "region": "category", "age": 1},
+        "generate_match_index_date": "no_offset",
+    },
+    "drop_cases_from_matches": {
+        "matches_per_case": 2,
+        "match_variables": {"sex": "category", "age": 2},
+        "date_exclusion_variables": {"previous_event": "after"},
+        "drop_cases_from_matches": True,
+    },
+    "closest_match": {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "region": "category", "age": 10},
+        "closest_match_variables": ["age"],
+        "generate_match_index_date": "6_month_later",
+    },
+    "tiers": {
+        "matches_per_case": 2,
+        "min_matches_per_case": 1,
+        "match_variables": {"sex": "category", "region": "category", "age": 0},
+        "closest_match_variables": ["age"],
+        "tiers": [{"age": 0}, {"age": 2}, {"age": 10}],
+        "generate_match_index_date": "no_offset",
+    },
+}
+
+
+def get_bool_index(
+    match_type: str, value: int, match_var: str, matches: pd.DataFrame
+) -> pd.Series:
+    """
+    Compares the value in the given case variable to the variable in
+    the match dataframe, to generate a boolean Series. Comparisons vary
+    according to the matching specification.
+    """
+    if match_type == "category":
+        return matches[match_var] == value
+    else:
+        assert isinstance(match_type, int), "Unknown matching type '{match_type}'"
+        return abs(matches[match_var] - value) <= match_type
+
+
+def pre_calculate_indices(
+    cases: pd.DataFrame, matches: pd.DataFrame, match_variables: dict
+) -> dict[str, str]:
+    """
+    Loops over each of the values in the case table for each of the match
+    variables and generates a boolean Series against the match table. These are
+    returned in a dict.
+    """
+    indices_dict: dict = {}
+    for match_var in match_variables:
+        match_type = match_variables[match_var]
+        indices_dict[match_var] = {}
+
+        values = cases[match_var].unique()
+        for value in values:
+            index = get_bool_index(match_type, value, match_var, matches)
+            indices_dict[match_var][value] = index
+    return indices_dict
+
+
+def get_eligible_matches(
+    case_row: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_variables: dict,
+    indices: pd.DataFrame,
+) -> pd.DataFrame:
+    """
+    Loops over the match_variables and combines the boolean Series
+    from pre_calculate_indices into a single bool Series. Also removes previously
+    matched patients.
+    """
+    eligible_matches = pd.Series(data=True, index=matches.index)
+    for match_var in match_variables:
+        variable_bool = indices[match_var][case_row[match_var]]
+        eligible_matches = eligible_matches & variable_bool
+
+    not_previously_matched = matches["set_id"] == NOT_PREVIOUSLY_MATCHED
+    eligible_matches = eligible_matches & not_previously_matched
+    return eligible_matches
+
+
+def match_cases_original(
+    cases: pd.DataFrame, matches: pd.DataFrame, match_config: MatchConfig
+) -> np.ndarray:
+    """
+    Matches the (sorted) cases with the original matching algorithm: the eligible
+    matches of each case are found by comparing it with every match, and the
+    set_id (and index date) of the matches is updated in the matches dataframe.
+    Returns the number of matches picked for each case.
+    """
+    # Guaranteed by validation; assert not None to satisfy mypy
+    assert match_config.match_variables is not None
+    assert match_config.matches_per_case is not None
+    indices = pre_calculate_indices(cases, matches, match_config.match_variables)
+    if match_config.match_index_date_offset:
+        date_offset = get_date_offset(match_config.match_index_date_offset)
+    match_counts = pd.Series(0.0, index=cases.index)
+
+    for case_id, case_row in cases.iterrows():
+        ## Get eligible matches
+        eligible_matches = get_eligible_matches(
+            case_row, matches, match_config.match_variables, indices
+        )
+        matched_rows = matches.loc[eligible_matches]
+
+        ## Determine match index date
+        if not match_config.match_index_date_offset:
+            index_date = matched_rows[match_config.index_date_variable]
+        else:
+            unit, offset_type, _ = match_config.match_index_date_offset
+
+            if unit == "no_offset":
+                index_date = case_row[match_config.index_date_variable]
+            elif offset_type == "earlier":
+                index_date = case_row[match_config.index_date_variable] - date_offset
+            else:
+                index_date = case_row[match_config.index_date_variable] + date_offset
+
+        ## Index date based match exclusions
+        if match_config.date_exclusion_variables:
+            exclusions = date_exclusions(
+                matched_rows, match_config.date_exclusion_variables, index_date
+            )
+            matched_rows = matched_rows.loc[~exclusions]
+
+        ## Pick random matches
+        matched_rows = greedily_pick_matches(
+            match_config.matches_per_case,
+            matched_rows,
+            case_row,
+            match_config.closest_match_variables,
+        )
+
+        ## Label matches with case ID if there are enough
+        match_counts[case_id] = len(matched_rows)
+        if len(matched_rows) >= match_config.min_matches_per_case:
+            matches.loc[matched_rows, "set_id"] = case_id
+
+        ## Set index_date of the match where needed
+        if match_config.generate_match_index_date:
+            matches.loc[matched_rows, match_config.index_date_variable] = index_date
+    return match_counts.to_numpy()
+
+
+def load_reference_dataframe(file_path: Path) -> pd.DataFrame:
+    """Loads a dataset as the original load_dataframe did"""
+    read_method, kwargs = REFERENCE_READER[file_suffix(file_path).split(".gz")[0]]
+    dataframe = getattr(pd, read_method)(file_path, **kwargs)
+    dataframe.set_index("patient_id", inplace=True)
+    return dataframe
+
+
+def import_reference_data(
+    cases: pd.DataFrame, matches: pd.DataFrame, match_config: MatchConfig
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Sets the correct data types for the matching variables, as the original
+    import_data did.
+    """
+    assert match_config.match_variables is not None  # guaranteed by validation
+    match_variables = copy.deepcopy(match_config.match_variables)
+
+    # If there is no index_date_variable in the matches df, add an empty column for it
+    if match_config.index_date_variable not in matches.columns:
+        matches[match_config.index_date_variable] = ""
+
+    ## Set data types for matching variables
+    month_only = []
+    for var, match_type in match_variables.items():
+        if match_type == "category":
+            # arrow files already have category types, so we don't need to convert them
+            if cases[var].dtype.name == "category":
+                continue
+            cases[var] = cases[var].astype("category")
+            matches[var] = matches[var].astype("category")
+        ## Extract month from month_only variables
+        elif match_type == "month_only":
+            month_only.append(var)
+            # Ensure our datetimes are strings before slicing
+            cases[var] = cases[var].astype("str")
+            matches[var] = matches[var].astype("str")
+            cases[f"{var}_m"] = cases[var].str.slice(start=5, stop=7).astype("category")
+            matches[f"{var}_m"] = (
+                matches[var].str.slice(start=5, stop=7).astype("category")
+            )
+    for var in month_only:
+        del match_variables[var]
+        match_variables[f"{var}_m"] = "category"
+
+    match_config.match_variables = match_variables
+
+    ## Format exclusion variables as dates
+    for var in match_config.date_exclusion_variables:
+        cases[var] = pd.to_datetime(cases[var])
+        matches[var] = pd.to_datetime(matches[var])
+
+    ## Format index dates as date
+    cases[match_config.index_date_variable] = pd.to_datetime(
+        cases[match_config.index_date_variable]
+    )
+    matches[match_config.index_date_variable] = pd.to_datetime(
+        matches[match_config.index_date_variable]
+    )
+
+    return cases, matches
+
+
+def write_reference_results(
+    cases: pd.DataFrame, matches: pd.DataFrame, match_config: MatchConfig
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Writes the matched cases and matches, and both combined, as the original
+    match() did, and returns the matched cases and matches.
+    """
+    matched_cases = cases.loc[
+        cases["match_counts"] >= match_config.min_matches_per_case
+    ]
+    matched_matches = matches.loc[matches["set_id"] != NOT_PREVIOUSLY_MATCHED]
+    combined = pd.concat(
+        [df for df in [matched_cases, matched_matches] if not df.empty]
+    )
+    match_config.output_path.mkdir(parents=True, exist_ok=True)
+    file_suffix_ext = f"{match_config.output_suffix}.{match_config.output_format}"
+    write_method = REFERENCE_WRITER[f".{match_config.output_format}"]
+    for name, df in [
+        ("matched_cases", matched_cases),
+        ("matched_matches", matched_matches),
+        ("matched_combined", combined),
+    ]:
+        # feather requires that we reset the index before writing
+        getattr(df.reset_index(), write_method)(
+            match_config.output_path / f"{name}{file_suffix_ext}"
+        )
+    return matched_cases, matched_matches
+
+
+def reference_engine(
+    cases_path: Path, controls_path: Path, config: MatchConfig
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Matches with the original matching algorithm, in the tiers of the config, if
+    any, and writes the outputs as the original match() did.
+    """
+    match_config, errors = parse_and_validate_config(config)
+    assert not errors, errors
+    cases, matches = import_reference_data(
+        load_reference_dataframe(cases_path),
+        load_reference_dataframe(controls_path),
+        match_config,
+    )
+    if match_config.drop_cases_from_matches:
+        matches = matches.drop(cases.index, errors="ignore")
+    cases, matches = add_variables(cases, matches, match_config.indicator_variable_name)
+    if match_config.date_exclusion_variables:
+        case_exclusions = date_exclusions(
+            cases,
+            match_config.date_exclusion_variables,
+            cases[match_config.index_date_variable],
+        )
+        cases = cases.loc[~case_exclusions]
+    cases = cases.sort_values(match_config.index_date_variable)
+
+    match_counts = np.zeros(len(cases))
+    case_tiers = np.zeros(len(cases), dtype=np.int64)
+    match_tiers = np.zeros(len(matches), dtype=np.int64)
+    unmatched = np.arange(len(cases))
+    for tier_number, tier in enumerate(match_config.tiers or [{}], start=1):
+        set_ids = matches["set_id"].to_numpy(copy=True)
+        tier_counts = match_cases_original(
+            cases.iloc[unmatched], matches, get_tier_config(match_config, tier)
+        )
+        match_counts[unmatched] = tier_counts
+        match_tiers[matches["set_id"].to_numpy() != set_ids] = tier_number
+        tier_matched = tier_counts >= match_config.min_matches_per_case
+        case_tiers[unmatched[tier_matched]] = tier_number
+        unmatched = unmatched[~tier_matched]
+    if match_config.tiers:
+        cases[MATCH_TIER_VARIABLE] = case_tiers
+        matches[MATCH_TIER_VARIABLE] = match_tiers
+    cases["match_counts"] = match_counts
+
+    return write_reference_results(cases, matches, match_config)
+
+
+def match_engine(
+    cases_path: Path, controls_path: Path, config: MatchConfig
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    return match(load_dataframe(cases_path), load_dataframe(controls_path), config)
+
+
+def partitioned_engine(
+    cases_path: Path, controls_path: Path, config: MatchConfig
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    config.partition_memory_mb = PARTITION_MEMORY_MB
+    return match_partitioned(load_dataframe(cases_path), controls_path, config)
+
+
+def arrow_engine(
+    cases_path: Path, controls_path: Path, config: MatchConfig
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    config.engine = "arrow"
+    return match(load_dataframe(cases_path), load_dataframe(controls_path), config)
+
+
+ENGINES: dict[str, Engine] = {
+    "reference": reference_engine,
+    "match": match_engine,
+    "partitioned": partitioned_engine,
+    "arrow": arrow_engine,
+}
+
+
+@dataclass
+class Divergence:
+    output: str
+    # the position of the first differing row, or None if the columns differ
+    row: int | None
+    patient_id: Any
+    column: str | None
+    expected: Any
+    actual: Any
+
+    def __str__(self) -> str:
+        if self.row is None:
+            return (
+                f"{self.output}: column `{self.column}` differs; "
+                f"expected {self.expected!r}, got {self.actual!r}"
+            )
+        column = f", column `{self.column}`" if self.column else ""
+        return (
+            f"{self.output}: row {self.row} (patient_id {self.patient_id}){column} "
+            f"differs; expected {self.expected!r}, got {self.actual!r}"
+        )
+
+
+def values_equal(expected: pd.Series, actual: pd.Series) -> np.ndarray:
+    """
+    Whether each pair of values is equal; missing values are equal to each other,
+    and categories are compared by value.
+    """
+    expected_values = expected.to_numpy(dtype=object)
+    actual_values = actual.to_numpy(dtype=object)
+    expected_missing = pd.isna(expected_values)
+    actual_missing = pd.isna(actual_values)
+    equal = expected_missing & actual_missing
+    present = ~(expected_missing | actual_missing)
+    equal[present] = expected_values[present] == actual_values[present]
+    return equal
+
+
+def find_divergence(
+    output: str, expected: pd.DataFrame, actual: pd.DataFrame
+) -> Divergence | None:
+    """
+    The first difference of the output of an engine from that of the reference
+    engine: in the columns and their types, then in the patient ids and values of
+    each row in turn, then in the number of rows.
+    """
+    for position, column in enumerate(expected.columns):
+        if position >= len(actual.columns) or actual.columns[position] != column:
+            return Divergence(
+                output, None, None, column, list(expected.columns), list(actual.columns)
+            )
+        if actual[column].dtype != expected[column].dtype:
+            return Divergence(
+                output,
+                None,
+                None,
+                column,
+                str(expected[column].dtype),
+                str(actual[column].dtype),
+            )
+    if len(actual.columns) > len(expected.columns):
+        column = actual.columns[len(expected.columns)]
+        return Divergence(
+            output, None, None, column, list(expected.columns), list(actual.columns)
+        )
+
+    length = min(len(expected), len(actual))
+    differs = pd.DataFrame(
+        {
+            "patient_id": ~values_equal(
+                expected.index[:length].to_series(), actual.index[:length].to_series()
+            ),
+            **{
+                column: ~values_equal(
+                    expected[column].iloc[:length], actual[column].iloc[:length]
+                )
+                for column in expected.columns
+            },
+        }
+    ).to_numpy()
+    rows = np.flatnonzero(differs.any(axis=1))
+    if len(rows):
+        row = int(rows[0])
+        column = ["patient_id", *expected.columns][int(np.argmax(differs[row]))]
+        if column == "patient_id":
+            expected_value, actual_value = expected.index[row], actual.index[row]
+        else:
+            expected_value = expected[column].iloc[row]
+            actual_value = actual[column].iloc[row]
+        return Divergence(
+            output, row, expected.index[row], column, expected_value, actual_value
+        )
+    if len(expected) > len(actual):
+        return Divergence(
+            output, length, expected.index[length], None, "a row", "no row"
+        )
+    if len(actual) > len(expected):
+        return Divergence(output, length, actual.index[length], None, "no row", "a row")
+    return None
+
+
+def add_cases_to_controls(cases_path: Path, controls_path: Path) -> Path:
+    """
+    Writes the controls and the cases (without the columns that the controls don't
+    have) to <controls>_with_cases.arrow next to the cases, unless it has already
+    been written, and returns its path.
+    """
+    path = cases_path.parent / f"{controls_path.stem}_with_cases.arrow"
+    if not path.exists():
+        controls = feather.read_table(controls_path)
+        cases = feather.read_table(cases_path).select(controls.schema.names)
+        partial_path = path.with_suffix(".arrow.partial")
+        feather.write_feather(pa.concat_tables([controls, cases]), partial_path)
+        partial_path.replace(path)
+    return path
+
+
+def add_index_dates_to_controls(
+    spec: CohortSpec, cases_path: Path, controls_path: Path
+) -> Path:
+    """
+    Writes the controls with random index dates, over the same days as those of
+    the cases, to <controls>_with_index_dates.arrow next to the cases, unless it
+    has already been written, and returns its path.
+    """
+    path = cases_path.parent / f"{controls_path.stem}_with_index_dates.arrow"
+    if not path.exists():
+        controls = feather.read_table(controls_path)
+        rng = np.random.default_rng([spec.seed, 2])
+        index_dates = get_dates(
+            rng,
+            controls.num_rows,
+            np.datetime64(spec.start_date, "D"),
+            spec.index_date_days,
+            density=1,
+        )
+        partial_path = path.with_suffix(".arrow.partial")
+        feather.write_feather(
+            controls.append_column("indexdate", index_dates), partial_path
+        )
+        partial_path.replace(path)
+    return path
+
+
+def run_differential(
+    spec: CohortSpec,
+    data_path: Path,
+    output_path: Path,
+    engine: Engine,
+    configs: dict[str, dict] | None = None,
+) -> dict[str, Divergence | None]:
+    """
+    Matches the cohort given by spec (written to data_path, if it hasn't been
+    already) with the reference engine and engine, with each of configs (by
+    default, DIFFERENTIAL_CONFIGS). Returns the first divergence of engine from
+    the reference engine with each config, or None if their outputs are the same.
+    The outputs of each config are written to output_path/<config name>.
+    """
+    cases_path, controls_path = write_cohort(spec, data_path)
+    divergences = {}
+    for name, config in (configs or DIFFERENTIAL_CONFIGS).items():
+        # the cases that are added to the controls keep their own index dates
+        config_controls_path = controls_path
+        if not config.get("generate_match_index_date"):
+            config_controls_path = add_index_dates_to_controls(
+                spec, cases_path, config_controls_path
+            )
+        if config.get("drop_cases_from_matches"):
+            config_controls_path = add_cases_to_controls(
+                cases_path, config_controls_path
+            )
+        results = []
+        for engine_name, run_engine in [
+            ("reference", reference_engine),
+            ("engine", engine),
+        ]:
+            match_config = MatchConfig.from_dict(
+                {
+                    "index_date_variable": "indexdate",
+                    **copy.deepcopy(config),
+                    "output_path": output_path / name / engine_name,
+                }
+            )
+            # the engines print their matching reports, which would drown out
+            # the comparison
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.append(
+                    run_engine(cases_path, config_controls_path, match_config)
+                )
+        divergences[name] = next(
+            (
+                divergence
+                for output, expected, actual in zip(OUTPUTS, *results)
+                if (divergence := find_divergence(output, expected, actual))
+            ),
+            None,
+        )
+    return divergences
+
+
+def differential_main(args: list[str]) -> int:
+    defaults = CohortSpec()
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks differential",
+        description=(
+            "Compares the outputs of a matching engine with those of the reference "
+            "engine, on a synthetic cohort"
+        ),
+    )
+    parser.add_argument("--engine", choices=list(ENGINES), default="match")
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        choices=list(DIFFERENTIAL_CONFIGS),
+        help="The configs to compare the engines with; by default, all of them",
+    )
+    parser.add_argument("--controls", type=int, default=defaults.num_controls)
+    parser.add_argument(
+        "--controls-per-case", type=int, default=defaults.controls_per_case
+    )
+    parser.add_argument("--regions", type=int, default=defaults.num_regions)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument(
+        "--data-path",
+        type=Path,
+        default=Path(".benchmarks"),
+        help="Where generated cohorts are kept, to be reused by later runs",
+    )
+    parser.add_argument(
+        "--output-path",
+        type=Path,
+        default=Path(".benchmarks") / "differential",
+        help="Where the outputs of the engines are written",
+    )
+    parsed_args = parser.parse_args(args)
+    spec = CohortSpec(
+        num_controls=parsed_args.controls,
+        controls_per_case=parsed_args.controls_per_case,
+        num_regions=parsed_args.regions,
+        seed=parsed_args.seed,
+    )
+    configs = None
+    if parsed_args.configs:
+        configs = {name: DIFFERENTIAL_CONFIGS[name] for name in parsed_args.configs}
+    divergences = run_differential(
+        spec,
+        parsed_args.data_path,
+        parsed_args.output_path,
+        ENGINES[parsed_args.engine],
+        configs,
+    )
+    for name, divergence in divergences.items():
+        print(f"{name:24} {divergence or 'same'}")
+    diverged = [name for name, divergence in divergences.items() if divergence]
+    if diverged:
+        print(
+            f"\n{parsed_args.engine} differs from the reference: {', '.join(diverged)}"
+        )
+        return 1
+    return 0
@@ -0,0 +1,261 @@
+"""
+Benchmarks of the stages of matching, on synthetic cohorts (see benchmarks.cohort).
+
+`python -m benchmarks run` generates a cohort (or reuses one generated before),
+and matches it with match(), timing each stage of matching from the metrics that
+match() records (see osmatching.metrics): loading the datasets, importing them,
+building the control index, the matching loop, and writing the outputs. Each stage
+is timed in each of a number of repeats, and the results are written to a JSON file
+with the versions of osmatching and its dependencies, and the peak memory of the
+benchmark process.
+`python -m benchmarks compare` compares two results files, e.g. of two versions,
+and reports the stages that have become slower.
+"""
+
+import argparse
+import copy
+import json
+import platform
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from benchmarks.cohort import CohortSpec, write_cohort
+from benchmarks.differential import differential_main
+from osmatching.metrics import get_metrics_path, get_peak_rss_mb
+from osmatching.osmatching import match
+from osmatching.utils import MatchConfig, load_dataframe
+
+
+VERSION_PATH = Path(__file__).parents[1] / "osmatching" / "VERSION"
+# The stages of the benchmarks, and the stages of the metrics of match() (see
+# osmatching.metrics) that they are made up of. The write_<output> stages of the
+# metrics are left out, as they are run within write_outputs.
+STAGE_METRICS = {
+    "load": ["load"],
+    "import": ["import_data", "drop_cases", "drop_previous_cases"],
+    "index": ["build_control_index"],
+    "match": ["case_exclusions", "sort_cases", "thinning", "matching"],
+    "write": ["results_report", "write_outputs"],
+}
+STAGES = list(STAGE_METRICS)
+# The matching config of the benchmarks, as written by
+# analysis/write_matching_config.py, with matching within regions and date
+# exclusions
+BENCHMARK_CONFIG = {
+    "matches_per_case": 3,
+    "match_variables": {"sex": "category", "region": "category", "age": 5},
+    "index_date_variable": "indexdate",
+    "closest_match_variables": ["age"],
+    "date_exclusion_variables": {"died_date_ons": "before", "previous_event": "after"},
+    "generate_match_index_date": "no_offset",
+}
+# A stage is slower if it takes this much longer than in the baseline
+REGRESSION_THRESHOLD = 0.1
+
+
+def run_stages(
+    cases_path: Path, controls_path: Path, config: dict, output_path: Path
+) -> tuple[dict[str, float], dict[str, int]]:
+    """
+    Matches the cases and controls with match(), loading them as the action does,
+    and times each stage from the metrics that match() records. Returns the time
+    of each stage in seconds, and the number of rows of the datasets.
+    """
+    match_config = MatchConfig.from_dict(
+        {**copy.deepcopy(config), "output_path": output_path}
+    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        matched_cases, matched_matches = match(
+            case_df=executor.submit(load_dataframe, cases_path),
+            match_df=executor.submit(load_dataframe, controls_path),
+            match_config=match_config,
+        )
+    metrics = json.loads(
+        get_metrics_path(output_path, match_config.output_suffix).read_text()
+    )["stages"]
+    timings = {
+        stage: sum(metrics[name]["wall_seconds"] for name in names if name in metrics)
+        for stage, names in STAGE_METRICS.items()
+    }
+    rows = {
+        "cases": metrics["load"]["rows"]["cases"],
+        "controls": metrics["load"]["rows"]["matches"],
+        "matched_cases": len(matched_cases),
+        "matched_matches": len(matched_matches),
+    }
+    return timings, rows
+
+
+def run_benchmark(
+    spec: CohortSpec,
+    data_path: Path,
+    config: dict | None = None,
+    repeat: int = 3,
+    output_format: str = "arrow",
+) -> dict:
+    """
+    Benchmarks matching the cohort given by spec (written to data_path, if it
+    hasn't been already), repeat times. Returns the results, with the time of each
+    stage in each repeat, and the fastest.
+    """
+    config = {**(config or BENCHMARK_CONFIG), "output_format": output_format}
+    cases_path, controls_path = write_cohort(spec, data_path)
+    times: dict[str, list[float]] = {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as output_path:
+            timings, rows = run_stages(
+                cases_path, controls_path, config, Path(output_path)
+            )
+        for stage, seconds in timings.items():
+            times[stage].append(seconds)
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "versions": {
+            "osmatching": VERSION_PATH.read_text().strip(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "pyarrow": pa.__version__,
+        },
+        "platform": platform.platform(),
+        "cohort": asdict(spec),
+        "config": config,
+        "rows": rows,
+        "stages": {
+            stage: {"min": min(stage_times), "times": stage_times}
+            for stage, stage_times in times.items()
+        },
+        "total": sum(min(stage_times) for stage_times in times.values()),
+        # the high-water mark of the whole benchmark process (including generating
+        # the cohort and all the repeats), not of matching alone; None where it
+        # isn't available (see osmatching.metrics)
+        "process_peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def compare_results(
+    baseline: dict, current: dict, threshold: float = REGRESSION_THRESHOLD
+) -> tuple[pd.DataFrame, list[str]]:
+    """
+    Compares the fastest time of each stage in two benchmark results. Returns a
+    table of the times, and the stages that are more than threshold slower than
+    in the baseline.
+    """
+    stages = [stage for stage in STAGES if stage in baseline["stages"]]
+    comparison = pd.DataFrame(
+        {
+            "stage": stages,
+            "baseline": [baseline["stages"][stage]["min"] for stage in stages],
+            "current": [current["stages"][stage]["min"] for stage in stages],
+        }
+    )
+    comparison["ratio"] = comparison["current"] / comparison["baseline"]
+    regressions = comparison.loc[comparison["ratio"] > 1 + threshold, "stage"]
+    return comparison, regressions.tolist()
+
+
+def run_main(args: list[str]):
+    defaults = CohortSpec()
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks run",
+        description="Benchmarks matching a synthetic cohort",
+    )
+    parser.add_argument("--controls", type=int, default=defaults.num_controls)
+    parser.add_argument(
+        "--controls-per-case", type=int, default=defaults.controls_per_case
+    )
+    parser.add_argument(
+        "--regions",
+        type=int,
+        default=defaults.num_regions,
+        help="The number of regions; the strata are the combinations of sex and region",
+    )
+    parser.add_argument("--age-mean", type=float, default=defaults.age_mean)
+    parser.add_argument("--age-sd", type=float, default=defaults.age_sd)
+    parser.add_argument(
+        "--exclusion-date-density",
+        type=float,
+        default=defaults.exclusion_date_density,
+        help="The proportion of patients with each date exclusion variable",
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument(
+        "--config-file",
+        type=Path,
+        help="A matching config to benchmark, instead of the default",
+    )
+    parser.add_argument(
+        "--output-format", choices=["arrow", "csv.gz", "csv"], default="arrow"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--data-path",
+        type=Path,
+        default=Path(".benchmarks"),
+        help="Where generated cohorts are kept, to be reused by later runs",
+    )
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parsed_args = parser.parse_args(args)
+    spec = CohortSpec(
+        num_controls=parsed_args.controls,
+        controls_per_case=parsed_args.controls_per_case,
+        num_regions=parsed_args.regions,
+        age_mean=parsed_args.age_mean,
+        age_sd=parsed_args.age_sd,
+        exclusion_date_density=parsed_args.exclusion_date_density,
+        seed=parsed_args.seed,
+    )
+    config = None
+    if parsed_args.config_file is not None:
+        config = json.loads(parsed_args.config_file.read_text())
+    results = run_benchmark(
+        spec,
+        parsed_args.data_path,
+        config,
+        repeat=parsed_args.repeat,
+        output_format=parsed_args.output_format,
+    )
+    parsed_args.output.write_text(json.dumps(results, indent=2))
+    for stage, stage_results in results["stages"].items():
+        print(f"{stage:8} {stage_results['min']:.3f}s")
+    print(f"Results written to {parsed_args.output}")
+
+
+def compare_main(args: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks compare",
+        description="Compares the results of two benchmark runs",
+    )
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parsed_args = parser.parse_args(args)
+    comparison, regressions = compare_results(
+        json.loads(parsed_args.baseline.read_text()),
+        json.loads(parsed_args.current.read_text()),
+        parsed_args.threshold,
+    )
+    print(comparison.to_string(index=False, float_format="{:.3f}".format))
+    if regressions:
+        print(f"\nSlower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def main(args: list[str]) -> int:
+    commands = {
+        "run": run_main,
+        "compare": compare_main,
+        "differential": differential_main,
+    }
+    if not args or args[0] not in commands:
+        print(f"Usage: python -m benchmarks {{{','.join(commands)}}} ...")
+        return 2
+    return commands[args[0]](args[1:]) or 0
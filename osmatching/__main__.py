@@ -3,17 +3,46 @@
 import argparse
 import json
 import sys
+from collections import defaultdict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
-from osmatching.osmatching import match
+import pyarrow as pa
+
+from osmatching.cache import load_cached_controls
+from osmatching.dry_run import dry_run
+from osmatching.index import build_control_index, get_index_path, load_control_index
+from osmatching.osmatching import (
+    import_dataframe,
+    match,
+    match_incremental,
+    match_populations,
+)
+from osmatching.partition import match_partitioned
+from osmatching.shard import merge, shard
+from osmatching.sweep import SWEEP_WORKERS, sweep
 from osmatching.utils import (
     MatchConfig,
+    file_digest,
+    file_stamp,
     file_suffix,
     load_config,
     load_dataframe,
+    read_schema,
     report_validation_errors,
+    select_input_columns,
+)
+from osmatching.validation import (
+    ValidationType,
+    get_population_config,
+    get_required_columns,
+    merge_errors,
+    validate_input_schema,
+    validate_matches_schema,
+    validate_previous_run_columns,
 )
-from osmatching.validation import ValidationType
 
 
 class BaseLoadMatchingConfig(argparse.Action):
@@ -51,41 +80,296 @@ class LoadMatchingConfigFile(BaseLoadMatchingConfig):
             )
 
 
-class LoadDataframe(argparse.Action):
-    def __call__(self, parser, namespace, values, option_string=None):
-        data_filepath = Path(values)
+class DataFilePath(argparse.Action):
+    """
+    Checks that a data file exists and is of a supported type. The file itself is
+    not loaded until the config has been parsed and validated; see run_matching.
+    If the argument takes multiple values, a list of paths is stored.
+    """
+
+    def check_path(self, value):
+        data_filepath = Path(value)
         if not data_filepath.exists():
-            raise argparse.ArgumentTypeError(f"File {values} not found")
+            raise argparse.ArgumentTypeError(f"File {value} not found")
         if file_suffix(data_filepath) not in [".csv", ".csv.gz", ".arrow"]:
             raise argparse.ArgumentTypeError(
                 "Invalid file type; provide a .arrow, .csv.gz or .csv file"
             )
-        setattr(namespace, self.dest, load_dataframe(data_filepath))
+        return data_filepath
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        if isinstance(values, list):
+            setattr(namespace, self.dest, [self.check_path(value) for value in values])
+        else:
+            setattr(namespace, self.dest, self.check_path(values))
+
+
+def get_population_name(cases: Path) -> str:
+    return cases.name.removesuffix(file_suffix(cases))
+
+
+def get_populations(cases: list[Path], config: MatchConfig) -> dict[str, Path]:
+    """
+    Each cases file is a population, named by its file name without suffixes, which
+    is used to look up its config overrides (see match_populations).
+    """
+    populations = {get_population_name(path): path for path in cases}
+    errors = defaultdict(list)
+    if len(populations) < len(cases):
+        errors["cases"].append("Cases files must have different names")
+    if len(cases) > 1 and config.partition_memory_mb is not None:
+        errors["cases"].append(
+            "Only one cases file can be matched with `partition_memory_mb`"
+        )
+    for name in config.populations:
+        if name not in populations:
+            errors["populations"].append(f"No cases file found for population `{name}`")
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+        raise ValueError("There was an error in one or more config values")
+    return populations
+
+
+def check_input_files(
+    populations: dict[str, Path], controls: Path, config: MatchConfig
+) -> tuple[dict[str, pa.Schema], pa.Schema]:
+    """
+    Preflight validation of the input files against the config, using only the
+    file schemas, so that errors are reported before any data is loaded.
+    """
+    controls_schema = read_schema(controls)
+    cases_schemas = {name: read_schema(path) for name, path in populations.items()}
+    errors = merge_errors(
+        *(
+            validate_input_schema(
+                cases_schema, controls_schema, get_config(name, populations, config)
+            )
+            for name, cases_schema in cases_schemas.items()
+        )
+    )
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+    return cases_schemas, controls_schema
+
+
+def check_previous_run(
+    previous_matches: Path,
+    previous_cases: Path | None,
+    populations: dict[str, Path],
+    config: MatchConfig,
+):
+    """
+    Preflight validation of the outputs of a previous run, to match incrementally
+    (see match_incremental).
+    """
+    errors = defaultdict(list)
+    if is_batch(populations, config):
+        errors["cases"].append(
+            "Only one population of cases can be matched with `--previous-matches`"
+        )
+    if config.partition_memory_mb is not None:
+        errors["partition_memory_mb"].append(
+            "`partition_memory_mb` cannot be used with `--previous-matches`"
+        )
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+        raise ValueError("There was an error in one or more config values")
+    errors = validate_previous_run_columns(
+        read_schema(previous_matches).names,
+        read_schema(previous_cases).names if previous_cases is not None else None,
+    )
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+
+
+def is_batch(populations: dict[str, Path], config: MatchConfig) -> bool:
+    return len(populations) > 1 or bool(config.populations)
+
+
+def get_config(name: str, populations: dict[str, Path], config: MatchConfig):
+    if is_batch(populations, config):
+        return get_population_config(config, name)
+    return config
+
+
+def load_controls(controls: Path, columns: list[str] | None, config: MatchConfig):
+    if config.control_cache_path:
+        return load_cached_controls(controls, columns, config)
+    return load_dataframe(controls, columns)
+
+
+@contextmanager
+def loading_executor() -> Iterator[ThreadPoolExecutor]:
+    """
+    Threads to load the input datasets in. If loading or matching fails (e.g. a
+    cases file can't be loaded), the threads are shut down without waiting for the
+    other datasets to load, so that the error is raised as soon as it happens;
+    datasets that are already loading finish in the background.
+    """
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        yield executor
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
 
 
 def run_matching(
-    cases: str, controls: str, config: MatchConfig, output_format: str | None = None
+    cases: list[Path],
+    controls: Path,
+    config: MatchConfig,
+    output_format: str | None = None,
+    check: bool = False,
+    dry_run_only: bool = False,
+    resume: bool = False,
+    profile: bool = False,
+    loop_counters: bool = False,
+    previous_matches: Path | None = None,
+    previous_cases: Path | None = None,
 ):
     # an explicitly provided command line output_format takes precedence over config value
     if output_format is not None:
         config.output_format = output_format
-    match(
-        case_df=cases,
-        match_df=controls,
-        match_config=config,
+    config.resume = resume
+    config.profile = profile
+    config.loop_counters = loop_counters
+    populations = get_populations(cases, config)
+    cases_schemas, controls_schema = check_input_files(populations, controls, config)
+    if previous_matches is not None:
+        check_previous_run(previous_matches, previous_cases, populations, config)
+    if check:
+        print("\nThe input data and configuration are valid")
+        return
+    if dry_run_only:
+        run_dry_run(populations, controls, cases_schemas, controls_schema, config)
+        return
+    if config.partition_memory_mb is not None:
+        # the controls are read from the file in batches, by match_partitioned
+        (name,) = populations
+        match_partitioned(
+            case_df=load_dataframe(
+                populations[name],
+                select_input_columns(cases_schemas[name].names, config),
+            ),
+            controls_path=controls,
+            match_config=config,
+            columns=select_input_columns(controls_schema.names, config),
+        )
+        return
+    control_index = load_control_index(controls, config)
+    # Load cases and controls concurrently; match() starts importing the cases
+    # while the controls are still loading. Only the columns needed for matching
+    # and output are loaded.
+    with loading_executor() as executor:
+        match_df = executor.submit(
+            load_controls,
+            controls,
+            select_input_columns(controls_schema.names, config),
+            config,
+        )
+        case_dfs = {
+            name: executor.submit(
+                load_dataframe,
+                path,
+                select_input_columns(
+                    cases_schemas[name].names, get_config(name, populations, config)
+                ),
+            )
+            for name, path in populations.items()
+        }
+        if previous_matches is not None:
+            (case_df,) = case_dfs.values()
+            match_incremental(
+                case_df=case_df,
+                match_df=match_df,
+                match_config=config,
+                previous_matches=load_dataframe(
+                    previous_matches, ["patient_id", "set_id"]
+                ),
+                previous_cases=(
+                    load_dataframe(previous_cases, ["patient_id"])
+                    if previous_cases is not None
+                    else None
+                ),
+                control_index=control_index,
+            )
+        elif not is_batch(populations, config):
+            (case_df,) = case_dfs.values()
+            match(
+                case_df=case_df,
+                match_df=match_df,
+                match_config=config,
+                control_index=control_index,
+            )
+        else:
+            match_populations(
+                populations=case_dfs,
+                match_df=match_df,
+                match_config=config,
+                control_index=control_index,
+            )
+
+
+def run_dry_run(
+    populations: dict[str, Path],
+    controls: Path,
+    cases_schemas: dict[str, pa.Schema],
+    controls_schema: pa.Schema,
+    config: MatchConfig,
+):
+    """
+    Estimates the results and time of matching each population (see
+    osmatching.dry_run). The controls are loaded into memory once, even with
+    partition_memory_mb.
+    """
+    control_index = load_control_index(controls, config)
+    matches = load_controls(
+        controls, select_input_columns(controls_schema.names, config), config
     )
+    for name, path in populations.items():
+        population_config = get_config(name, populations, config)
+        # each population gets a shallow copy of the controls (see match_populations)
+        dry_run(
+            case_df=load_dataframe(
+                path, select_input_columns(cases_schemas[name].names, population_config)
+            ),
+            match_df=matches.copy(deep=False),
+            match_config=population_config,
+            control_index=control_index,
+        )
 
 
-def main():
+def build_index(controls: Path, config: MatchConfig):
     """
-    Command line tool for running matching.
+    Builds the control index of a controls file, and saves it as a sidecar file
+    that is used by later matching runs with the same controls file (see
+    osmatching.index).
     """
-    # make args parser
-    parser = argparse.ArgumentParser(
-        description="Matches cases to controls if provided with 2 datasets"
+    controls_schema = read_schema(controls)
+    errors = validate_matches_schema(controls_schema, config)
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+    required = get_required_columns(config) | {"patient_id", config.index_date_variable}
+    columns = [column for column in controls_schema.names if column in required]
+    source_stamp = file_stamp(controls)
+    matches = load_controls(controls, columns, config)
+    control_index = build_control_index(
+        import_dataframe(matches, config),
+        config,
+        file_digest(controls),
+        source_stamp,
     )
+    index_path = get_index_path(controls)
+    control_index.write(index_path)
+    print(f"Control index written to {index_path}")
 
-    # add configuration arg; one of config or config-file is required
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    # one of config or config-file is required
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
         "--config",
@@ -100,15 +384,200 @@ def main():
         dest="config",
     )
 
+
+def index_main(args: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="osmatching index",
+        description="Builds an index of a controls file, to speed up matching",
+    )
+    add_config_arguments(parser)
+    parser.add_argument(
+        "--controls",
+        action=DataFilePath,
+        required=True,
+        help="Data file that contains the cohort for cases",
+    )
+    parsed_args = parser.parse_args(args)
+    build_index(controls=parsed_args.controls, config=parsed_args.config)
+
+
+def run_sweep(
+    cases: Path, controls: Path, config: MatchConfig, grid: dict, workers: int | None
+):
+    name = get_population_name(cases)
+    cases_schemas, controls_schema = check_input_files({name: cases}, controls, config)
+    control_index = load_control_index(controls, config)
+    with loading_executor() as executor:
+        sweep(
+            case_df=executor.submit(
+                load_dataframe,
+                cases,
+                select_input_columns(cases_schemas[name].names, config),
+            ),
+            match_df=executor.submit(
+                load_controls,
+                controls,
+                select_input_columns(controls_schema.names, config),
+                config,
+            ),
+            match_config=config,
+            grid=grid,
+            workers=workers,
+            control_index=control_index,
+        )
+
+
+def load_grid_json(value: str):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError as exc:
+        raise argparse.ArgumentTypeError(f"Could not parse {value}\n{exc}")
+
+
+def load_grid_file(value: str):
+    path = Path(value)
+    if not path.exists():
+        raise argparse.ArgumentTypeError(f"Grid file not found: {value}")
+    return load_grid_json(path.read_text())
+
+
+def sweep_main(args: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="osmatching sweep",
+        description="Matches cases to controls with each combination of a grid of parameters, and writes a table of match rates and balance",
+    )
+    add_config_arguments(parser)
+    parser.add_argument(
+        "--cases",
+        action=DataFilePath,
+        required=True,
+        help="Data file that contains the cases",
+    )
+    parser.add_argument(
+        "--controls",
+        action=DataFilePath,
+        required=True,
+        help="Data file that contains the cohort for cases",
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--grid",
+        type=load_grid_json,
+        help='The parameters to sweep over (a JSON string), e.g. {"matches_per_case": [1, 2], "match_variables.age": [1, 3]}',
+    )
+    group.add_argument(
+        "--grid-file",
+        type=load_grid_file,
+        dest="grid",
+        help="Path to a JSON file of the parameters to sweep over",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help=f"Number of grid points to run in parallel (default: {SWEEP_WORKERS})",
+    )
+    parsed_args = parser.parse_args(args)
+    run_sweep(
+        cases=parsed_args.cases,
+        controls=parsed_args.controls,
+        config=parsed_args.config,
+        grid=parsed_args.grid,
+        workers=parsed_args.workers,
+    )
+
+
+def run_shard(cases: Path, controls: Path, config: MatchConfig, num_shards: int):
+    name = get_population_name(cases)
+    cases_schemas, controls_schema = check_input_files({name: cases}, controls, config)
+    shard(
+        case_df=load_dataframe(
+            cases, select_input_columns(cases_schemas[name].names, config)
+        ),
+        controls_path=controls,
+        match_config=config,
+        num_shards=num_shards,
+        columns=select_input_columns(controls_schema.names, config),
+    )
+
+
+def shard_main(args: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="osmatching shard",
+        description="Splits cases and controls into shards by stratum, to be matched separately and merged",
+    )
+    add_config_arguments(parser)
+    parser.add_argument(
+        "--cases",
+        action=DataFilePath,
+        required=True,
+        help="Data file that contains the cases",
+    )
+    parser.add_argument(
+        "--controls",
+        action=DataFilePath,
+        required=True,
+        help="Data file that contains the cohort for cases",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        required=True,
+        help="Number of shards to split the cases and controls into",
+    )
+    parsed_args = parser.parse_args(args)
+    run_shard(
+        cases=parsed_args.cases,
+        controls=parsed_args.controls,
+        config=parsed_args.config,
+        num_shards=parsed_args.shards,
+    )
+
+
+def merge_main(args: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="osmatching merge",
+        description="Combines the outputs of matching each shard into the outputs of matching all cases",
+    )
+    add_config_arguments(parser)
+    parsed_args = parser.parse_args(args)
+    merge(parsed_args.config)
+
+
+# Subcommands; without one, matching is run
+COMMANDS = {
+    "index": index_main,
+    "sweep": sweep_main,
+    "shard": shard_main,
+    "merge": merge_main,
+}
+
+
+def main():
+    """
+    Command line tool for running matching.
+    """
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
+    # make args parser
+    parser = argparse.ArgumentParser(
+        description="Matches cases to controls if provided with 2 datasets"
+    )
+    add_config_arguments(parser)
+
     # Cases
     parser.add_argument(
-        "--cases", action=LoadDataframe, help="Data file that contains the cases"
+        "--cases",
+        action=DataFilePath,
+        nargs="+",
+        help="Data file that contains the cases; provide several files to match each population of cases against the same controls",
     )
 
     # Controls
     parser.add_argument(
         "--controls",
-        action=LoadDataframe,
+        action=DataFilePath,
         help="Data file that contains the cohort for cases",
     )
 
@@ -118,8 +587,54 @@ def main():
         help="Format for the output files",
     )
 
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Validate the configuration and input files, without loading any data or running matching",
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Estimate the match rate, the strata likely to be exhausted and the time of matching, without running matching",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted matching run from its last checkpoint (see `checkpoint_interval`)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile each stage of matching, and write the profiles to the output directory; this slows matching down",
+    )
+
+    parser.add_argument(
+        "--loop-counters",
+        action="store_true",
+        help="Count the candidates, date exclusions and random sampling of each case in the matching loop, and add histograms of them to the report and metrics",
+    )
+
+    parser.add_argument(
+        "--previous-matches",
+        action=DataFilePath,
+        help="The matched matches of a previous run; only cases that weren't matched in it are matched, against the matches it didn't use",
+    )
+
+    parser.add_argument(
+        "--previous-cases",
+        action=DataFilePath,
+        help="The cases of a previous run (with --previous-matches); none of them are matched again",
+    )
+
     # parse args
     args = parser.parse_args()
+    if args.previous_cases is not None and args.previous_matches is None:
+        parser.error("--previous-cases requires --previous-matches")
+    if args.dry_run and args.previous_matches is not None:
+        parser.error("--dry-run cannot be used with --previous-matches")
 
     # run matching
     run_matching(
@@ -127,6 +642,13 @@ def main():
         controls=args.controls,
         config=args.config,
         output_format=args.output_format,
+        check=args.check,
+        dry_run_only=args.dry_run,
+        resume=args.resume,
+        profile=args.profile,
+        loop_counters=args.loop_counters,
+        previous_matches=args.previous_matches,
+        previous_cases=args.previous_cases,
     )
 
 
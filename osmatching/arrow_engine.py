@@ -0,0 +1,174 @@
+"""
+The arrow matching engine, which matches cases without creating pandas objects for
+each case (see osmatching.match_cases, and the `engine` config option).
+
+The pandas engine iterates over the rows of the cases dataframe as Series, and
+picks the matches of each case from a dataframe of its eligible matches. The arrow
+engine converts the cases to an arrow table once, and reads each case's values
+from its columns. The closest match variables of the matches are arrow arrays, and
+the differences of each case's eligible matches from the case are calculated, and
+sorted, with arrow compute kernels.
+
+Matches are picked exactly as by the pandas engine: the matches with the smallest
+differences are picked as by DataFrame.nsmallest(keep="all"), and samples are
+taken with the same random seed as by DataFrame.sample, so that both engines give
+the same matched sets. The one exception is a closest match variable, other than
+the last, of nullable integers: if fewer than matches_per_case of more eligible
+matches have a value, DataFrame.nsmallest picks none of them, whereas the arrow
+engine picks them as for a float variable with missing values.
+"""
+
+from collections.abc import Iterator
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from osmatching.index import get_numeric_values
+from osmatching.metrics import LoopCounters
+from osmatching.utils import RANDOM_SEED, MatchConfig
+
+
+def get_case_rows(
+    cases: pd.DataFrame, match_config: MatchConfig
+) -> Iterator[tuple[Any, dict[str, Any]]]:
+    """
+    The id and the values of the variables used for matching of each case, in order.
+    Missing dates are NaT, as in the pandas engine; other missing values are None.
+    """
+    assert match_config.match_variables is not None  # guaranteed by validation
+    columns = list(
+        dict.fromkeys(
+            [
+                *match_config.match_variables,
+                match_config.index_date_variable,
+                *match_config.closest_match_variables,
+            ]
+        )
+    )
+    table = pa.Table.from_pandas(cases[columns], preserve_index=False)
+    values = {}
+    for column in columns:
+        column_values = table[column].to_pylist()
+        if pa.types.is_timestamp(table[column].type):
+            column_values = [
+                pd.NaT if value is None else value for value in column_values
+            ]
+        values[column] = column_values
+    for position, case_id in enumerate(cases.index):
+        yield case_id, {column: values[column][position] for column in columns}
+
+
+def get_closest_matches(
+    matches: pd.DataFrame, closest_match_variables: list[str]
+) -> pa.Table:
+    """
+    The values of the closest match variables of the matches; missing values are
+    null.
+    """
+    return pa.table(
+        {
+            var: pa.array(get_numeric_values(matches[var]), from_pandas=True)
+            for var in closest_match_variables
+        }
+    )
+
+
+def get_differences(values: pa.ChunkedArray, case_value: Any) -> pa.Array:
+    if case_value is None:
+        return pa.nulls(len(values), pa.float64())
+    return pc.abs(pc.subtract(values, case_value)).combine_chunks()
+
+
+def get_smallest(values: pa.Array, n: int) -> np.ndarray:
+    """
+    Positions of the n smallest values, and of any other values equal to the
+    largest of them, in ascending order of value (as Series.nsmallest(n,
+    keep="all")). If there are fewer than n values that aren't missing, all
+    positions are returned, with those of missing values last.
+    """
+    if n <= 0:
+        return np.array([], dtype=np.int64)
+    # a stable sort, so that equal values are in their original order
+    order = pc.sort_indices(values, null_placement="at_end").to_numpy()
+    if n > len(values) - values.null_count:
+        return order
+    largest = values[order[n - 1]]
+    return order[: pc.sum(pc.less_equal(values, largest)).as_py()]
+
+
+def get_closest_positions(differences: list[pa.Array], n: int) -> np.ndarray:
+    """
+    Positions of the n matches with the smallest differences, prioritised in the
+    order of the closest match variables, and of any other matches tied with them
+    (as DataFrame.nsmallest(n, columns, keep="all")).
+
+    The positions are in the same order as the rows of DataFrame.nsmallest, except
+    when all of them are picked, and their order doesn't matter.
+    """
+    positions = np.arange(len(differences[0]))
+    picked: list[np.ndarray] = []
+    num_to_pick = n
+    for values in differences[:-1]:
+        smallest = positions[get_smallest(values.take(positions), num_to_pick)]
+        if len(smallest) <= max(num_to_pick, 0):
+            break
+        # matches tied with the largest of the smallest differences are picked by
+        # their differences in the next variable
+        smallest_values = values.take(smallest)
+        tied = pc.fill_null(pc.equal(smallest_values, smallest_values[-1]), False)
+        tied = tied.to_numpy(zero_copy_only=False)
+        picked.append(smallest[~tied])
+        positions = smallest[tied]
+        num_to_pick = n - sum(map(len, picked))
+    else:
+        smallest = positions[get_smallest(differences[-1].take(positions), num_to_pick)]
+    picked.append(smallest)
+    closest = np.concatenate(picked)
+
+    if len(differences) > 1:
+        table = pa.table(
+            {
+                str(number): values.take(closest)
+                for number, values in enumerate(differences)
+            }
+        )
+        order = pc.sort_indices(
+            table,
+            sort_keys=[(name, "ascending") for name in table.column_names],
+            null_placement="at_end",
+        )
+        closest = closest[order.to_numpy()]
+    return closest
+
+
+def pick_matches(
+    matches_per_case: int,
+    closest_matches: pa.Table,
+    positions: np.ndarray,
+    case_row: dict[str, Any],
+    closest_match_variables: list[str],
+    counters: LoopCounters | None = None,
+) -> np.ndarray:
+    """
+    Picks matches_per_case of the eligible matches at positions, as
+    osmatching.greedily_pick_matches does, and returns their positions.
+    """
+    if closest_match_variables:
+        differences = [
+            get_differences(closest_matches[var].take(positions), case_row[var])
+            for var in closest_match_variables
+        ]
+        positions = positions[get_closest_positions(differences, matches_per_case)]
+
+    if len(positions) > matches_per_case:
+        if counters is not None:
+            counters.sampled_from.append(len(positions))
+        # the same sample as DataFrame.sample(n=matches_per_case, random_state=RANDOM_SEED)
+        sample = np.random.RandomState(RANDOM_SEED).choice(
+            len(positions), size=matches_per_case, replace=False
+        )
+        positions = positions[sample]
+    return positions
@@ -0,0 +1,168 @@
+"""
+Balance diagnostics of the matched cases and matches, for the "Balance after
+matching" section of the matching report.
+
+Each variable is compared between the matched cases and matches:
+
+- numeric (and date) variables by their means, the standardised mean difference
+  (the difference of the means, divided by the square root of the mean of the two
+  variances), and the variance ratio (of the cases to the matches);
+- categorical variables by the proportion of each level, and its standardised
+  difference (with the variance of a proportion p, p * (1 - p)).
+
+The variables are the match variables (other than index_date_variable), the
+closest_match_variables and the balance_variables. The moments of all the numeric
+variables are computed with one vectorised reduction of each population, so that
+the diagnostics stay fast for many variables and large populations.
+"""
+
+import numpy as np
+import pandas as pd
+
+from osmatching.utils import MatchConfig
+
+
+# Standardised differences larger than this (in absolute value) are counted as
+# imbalanced in the report
+SMD_THRESHOLD = 0.1
+BALANCE_COLUMNS = [
+    "variable",
+    "level",
+    "cases",
+    "matches",
+    "difference",
+    "smd",
+    "variance_ratio",
+]
+
+
+def get_balance_variables(match_config: MatchConfig) -> list[str]:
+    variables = [
+        *(match_config.match_variables or {}),
+        *match_config.closest_match_variables,
+        *match_config.balance_variables,
+    ]
+    return [
+        var
+        for var in dict.fromkeys(variables)
+        if var != match_config.index_date_variable
+    ]
+
+
+def is_numeric(series: pd.Series) -> bool:
+    return (
+        pd.api.types.is_numeric_dtype(series)
+        or pd.api.types.is_datetime64_any_dtype(series)
+    ) and not isinstance(series.dtype, pd.CategoricalDtype)
+
+
+def get_moments(population: pd.DataFrame) -> tuple[pd.Series, pd.Series]:
+    """The means and variances of the (numeric) columns of a population"""
+    dates = population.select_dtypes("datetime")
+    if len(dates.columns):
+        # dates are compared in days
+        population = population.assign(
+            **{
+                var: (values - pd.Timestamp(0)) / pd.Timedelta(days=1)
+                for var, values in dates.items()
+            }
+        )
+    # nullable columns have nullable means
+    return population.mean().astype("float64"), population.var().astype("float64")
+
+
+def get_standardised_difference(
+    difference: pd.Series, case_variance: pd.Series, match_variance: pd.Series
+) -> pd.Series:
+    return difference / np.sqrt((case_variance + match_variance) / 2)
+
+
+def get_numeric_balance(
+    matched_cases: pd.DataFrame, matched_matches: pd.DataFrame
+) -> pd.DataFrame:
+    case_means, case_variances = get_moments(matched_cases)
+    match_means, match_variances = get_moments(matched_matches)
+    difference = case_means - match_means
+    return pd.DataFrame(
+        {
+            "variable": matched_cases.columns,
+            "level": "",
+            "cases": case_means.to_numpy(),
+            "matches": match_means.to_numpy(),
+            "difference": difference.to_numpy(),
+            "smd": get_standardised_difference(
+                difference, case_variances, match_variances
+            ).to_numpy(),
+            "variance_ratio": (case_variances / match_variances).to_numpy(),
+        }
+    )
+
+
+def get_categorical_balance(
+    var: str, case_values: pd.Series, match_values: pd.Series
+) -> pd.DataFrame:
+    counts = pd.concat(
+        [
+            case_values.value_counts(dropna=False, sort=False),
+            match_values.value_counts(dropna=False, sort=False),
+        ],
+        axis=1,
+        keys=["cases", "matches"],
+    ).fillna(0)
+    # the proportions of an empty population are missing
+    proportions = counts[counts.any(axis=1)] / [len(case_values), len(match_values)]
+    difference = proportions["cases"] - proportions["matches"]
+    return pd.DataFrame(
+        {
+            "variable": var,
+            "level": proportions.index.astype(str),
+            "cases": proportions["cases"].to_numpy(),
+            "matches": proportions["matches"].to_numpy(),
+            "difference": difference.to_numpy(),
+            "smd": get_standardised_difference(
+                difference,
+                proportions["cases"] * (1 - proportions["cases"]),
+                proportions["matches"] * (1 - proportions["matches"]),
+            ).to_numpy(),
+        }
+    )
+
+
+def get_balance_table(
+    matched_cases: pd.DataFrame, matched_matches: pd.DataFrame, variables: list[str]
+) -> pd.DataFrame:
+    """
+    The balance of each variable between the matched cases and matches (see the
+    module docstring), with a row for each numeric variable and for each level of
+    each categorical variable, in the order of variables.
+    """
+    numeric = [var for var in variables if is_numeric(matched_cases[var])]
+    tables = {
+        var: get_categorical_balance(var, matched_cases[var], matched_matches[var])
+        for var in variables
+        if var not in numeric
+    }
+    if numeric:
+        numeric_balance = get_numeric_balance(
+            matched_cases[numeric], matched_matches[numeric]
+        )
+        for position, var in enumerate(numeric):
+            tables[var] = numeric_balance.iloc[[position]]
+    if not variables:
+        return pd.DataFrame(columns=BALANCE_COLUMNS)
+    # categorical variables have no variance ratio
+    return pd.concat([tables[var] for var in variables], ignore_index=True).reindex(
+        columns=BALANCE_COLUMNS
+    )
+
+
+def get_balance_report(table: pd.DataFrame) -> list:
+    """The "Balance after matching" section of the matching report"""
+    if not len(table):
+        return []
+    imbalanced = table.loc[table["smd"].abs() > SMD_THRESHOLD, "variable"].unique()
+    return [
+        "\nBalance after matching:",
+        table.to_string(index=False, float_format=lambda value: f"{value:.3f}"),
+        f"\nVariables with |SMD| > {SMD_THRESHOLD}  {len(imbalanced)}",
+    ]
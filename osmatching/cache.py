@@ -0,0 +1,132 @@
+"""
+On-disk cache of imported control datasets.
+
+Many matching actions are often run against the same (large) control file, with
+different case files or output suffixes. Loading and importing (see
+osmatching.import_dataframe) the controls is repeated by each of them, so the
+imported controls can be cached, keyed by a hash of the file contents and the
+parts of the config that affect the import. The hash of each controls file is
+saved in the cache with the file's size and modification time (see
+utils.file_stamp), and the file is only hashed again when they change.
+
+Cached datasets are stored as uncompressed arrow files of the loaded columns only,
+which are memory-mapped when they are loaded: numeric and date columns without
+missing values are views of the mapped file, and other columns (e.g. strings and
+categories) are copied. When the total size of the cache exceeds its maximum size,
+the least recently used files are removed.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pyarrow as pa
+
+from osmatching.osmatching import IMPORT_KEY_ATTR, get_import_key, import_dataframe
+from osmatching.utils import MatchConfig, file_digest, file_stamp, load_dataframe
+
+
+# Increment this if the format of cached files, or the import, changes
+CACHE_VERSION = 1
+
+
+def get_digest_path(cache_path: Path, file_path: Path) -> Path:
+    name = hashlib.blake2b(str(file_path.resolve()).encode(), digest_size=16)
+    return cache_path / f"{name.hexdigest()}.digest"
+
+
+def get_file_digest(cache_path: Path, file_path: Path) -> str:
+    """
+    The hash of the contents of a file (see utils.file_digest), which is saved in
+    the cache with the file's size and modification time, and only computed again
+    if they have changed since.
+    """
+    # taken before hashing, so that a change while hashing is seen by the next run
+    stamp = file_stamp(file_path)
+    digest_path = get_digest_path(cache_path, file_path)
+    try:
+        saved = json.loads(digest_path.read_text())
+    except (FileNotFoundError, ValueError):
+        saved = {}
+    if saved.get("stamp") == stamp:
+        return saved["digest"]
+    digest = file_digest(file_path)
+    cache_path.mkdir(parents=True, exist_ok=True)
+    temporary_file = digest_path.with_suffix(f".{os.getpid()}.tmp")
+    temporary_file.write_text(json.dumps({"stamp": stamp, "digest": digest}))
+    temporary_file.replace(digest_path)
+    return digest
+
+
+def get_cache_key(
+    file_path: Path, columns: list[str] | None, config: MatchConfig
+) -> str:
+    key = json.dumps(
+        {
+            "version": CACHE_VERSION,
+            "file": get_file_digest(Path(config.control_cache_path), file_path),
+            "columns": columns,
+            "import": get_import_key(config),
+        },
+        sort_keys=True,
+    )
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def evict(cache_path: Path, max_size: int, keep: Path):
+    """
+    Removes the least recently used cache files until the total size of the
+    cache is no more than max_size bytes. The file just written (keep) is never
+    removed. Files removed by other runs evicting at the same time are skipped.
+    """
+    cache_files = []
+    for path in cache_path.glob("*.arrow"):
+        try:
+            cache_files.append((path.stat(), path))
+        except FileNotFoundError:
+            continue
+    cache_files.sort(key=lambda cache_file: cache_file[0].st_mtime)
+    total_size = sum(stat.st_size for stat, _ in cache_files)
+    for stat, path in cache_files:
+        if total_size <= max_size:
+            break
+        if path == keep:
+            continue
+        total_size -= stat.st_size
+        path.unlink(missing_ok=True)
+
+
+def load_cached_controls(
+    file_path: Path, columns: list[str] | None, config: MatchConfig
+):
+    """
+    Loads and imports a control dataset, using the cache at
+    config.control_cache_path if it contains it, and adding it otherwise.
+    """
+    cache_path = Path(config.control_cache_path)
+    cache_path.mkdir(parents=True, exist_ok=True)
+    cached_file = cache_path / f"{get_cache_key(file_path, columns, config)}.arrow"
+
+    if cached_file.exists():
+        # mark as recently used
+        os.utime(cached_file)
+        with pa.memory_map(str(cached_file)) as source:
+            # the cached file has only the loaded columns, and reading it maps them
+            # without copying
+            table = pa.ipc.open_file(source).read_all()
+        # pandas metadata in the cached file restores the index and categories
+        dataframe = table.to_pandas(split_blocks=True, self_destruct=True)
+        dataframe.attrs[IMPORT_KEY_ATTR] = get_import_key(config)
+        return dataframe
+
+    dataframe = import_dataframe(load_dataframe(file_path, columns), config)
+    table = pa.Table.from_pandas(dataframe, preserve_index=True)
+    # write to a temporary file first, so that concurrent runs never read a
+    # partially written cache file
+    temporary_file = cached_file.with_suffix(f".{os.getpid()}.tmp")
+    with pa.ipc.new_file(temporary_file, table.schema) as writer:
+        writer.write_table(table)
+    temporary_file.replace(cached_file)
+    evict(cache_path, config.control_cache_max_size_mb * 1024 * 1024, cached_file)
+    return dataframe
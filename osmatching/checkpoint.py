@@ -0,0 +1,142 @@
+"""
+Checkpoints of the state of matching, so that a long matching run that is
+interrupted can be resumed.
+
+Cases are matched one at a time, in order of index date (see match_cases), and the
+state of matching after each case is given by a few arrays: the number of matches
+picked for each case, the set_id of each match, which matches are still available,
+and (if generated) the index date of each match. Every checkpoint_interval cases,
+and once all cases are matched, these arrays are saved with the position in the
+sorted cases to an (uncompressed) numpy .npz file in the output path. When matching
+in tiers, the results of the earlier tiers are saved with them.
+
+A resumed run loads the checkpoint, if it was saved by a run with the same cases,
+matches and config, and continues matching from the next case. Matching is
+deterministic, so the results are identical to those of an uninterrupted run. The
+checkpoint is removed once the output files are written.
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from osmatching.utils import MatchConfig
+
+
+# Increment this if the format of checkpoint files changes
+CHECKPOINT_VERSION = 1
+# Config values that affect the results of matching, given the imported datasets
+CHECKPOINT_CONFIG_FIELDS = [
+    "matches_per_case",
+    "match_variables",
+    "index_date_variable",
+    "closest_match_variables",
+    "date_exclusion_variables",
+    "min_matches_per_case",
+    "generate_match_index_date",
+    "match_index_date_offset",
+    "indicator_variable_name",
+    "tiers",
+]
+
+
+def get_checkpoint_path(match_config: MatchConfig) -> Path:
+    return match_config.output_path / f".checkpoint{match_config.output_suffix}.npz"
+
+
+def get_checkpoint_key(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_config: MatchConfig,
+    available: np.ndarray,
+) -> str:
+    """
+    Identifies a matching run, by a hash of its config, the (sorted) cases and the
+    matches, and the matches that are available before matching.
+    """
+    config = dataclasses.asdict(match_config)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(
+        json.dumps(
+            {name: config[name] for name in CHECKPOINT_CONFIG_FIELDS},
+            sort_keys=True,
+        ).encode()
+    )
+    assert match_config.match_variables is not None  # guaranteed by validation
+    columns = {
+        *match_config.match_variables,
+        *match_config.closest_match_variables,
+        *match_config.date_exclusion_variables,
+        match_config.index_date_variable,
+    }
+    for df in [cases, matches]:
+        hashes = pd.util.hash_pandas_object(
+            df[[column for column in df.columns if column in columns]]
+        )
+        digest.update(hashes.to_numpy().tobytes())
+    digest.update(available.tobytes())
+    return f"{CHECKPOINT_VERSION}-{digest.hexdigest()}"
+
+
+@dataclass
+class Checkpoint:
+    path: Path
+    key: str
+    # number of cases matched between checkpoints
+    interval: int
+    # the state of matching loaded by resume(), if any
+    state: dict[str, np.ndarray] = field(default_factory=dict)
+    # arrays saved with each checkpoint of the current stage, e.g. the results of
+    # earlier tiers
+    context: dict[str, np.ndarray] = field(default_factory=dict)
+
+    def resume(self) -> bool:
+        """
+        Loads the checkpoint file, if there is one from the same run. Returns
+        whether a checkpoint was loaded.
+        """
+        if not self.path.exists():
+            return False
+        with np.load(self.path) as checkpoint:
+            if str(checkpoint["key"]) != self.key:
+                return False
+            self.state = dict(checkpoint)
+        return True
+
+    def get_state(self, stage: int) -> dict[str, np.ndarray] | None:
+        """The loaded state of matching, if it was saved in the given stage"""
+        if self.state and int(self.state["stage"]) == stage:
+            return self.state
+        return None
+
+    def save(self, stage: int, position: int, arrays: dict[str, np.ndarray]):
+        """
+        Saves the state of matching after the first position cases of the given
+        stage (the tier, when matching in tiers). The file is replaced atomically,
+        so an interrupted save leaves the previous checkpoint.
+        """
+        temporary_path = self.path.with_name(f"{self.path.name}.tmp")
+        with temporary_path.open("wb") as checkpoint_file:
+            np.savez(
+                checkpoint_file,
+                key=np.array(self.key),
+                stage=np.array(stage),
+                position=np.array(position),
+                **self.context,
+                **arrays,
+            )
+        os.replace(temporary_path, self.path)
+
+    def update(self, stage: int, position: int, arrays: dict[str, np.ndarray]):
+        """Saves a checkpoint every interval cases"""
+        if position % self.interval == 0:
+            self.save(stage, position, arrays)
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
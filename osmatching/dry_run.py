@@ -0,0 +1,284 @@
+"""
+Fast estimates of the results and time of matching, with the `--dry-run` option,
+to check that a config is feasible before running it.
+
+The cases and controls are imported and indexed as for matching (see
+osmatching.index), but instead of matching each case in turn, the demand for
+controls in each stratum (the number of cases times matches_per_case) is compared
+with the supply of available controls, with group-bys over the cases of each
+stratum:
+
+- date exclusions are applied approximately, at the median match index date of the
+  cases of the stratum;
+- the candidates of each case are counted on the first scalar match variable only,
+  so they may be overestimated if there are several;
+- with tiers, the ranges of the last (widest) tier are used.
+
+A case is expected to be fully matched (with matches_per_case matches) if it has at
+least matches_per_case candidates, up to the number of cases that the supply of its
+stratum can provide for. Strata
+whose demand is more than their supply are likely to be exhausted. The time of
+matching is estimated by matching a random sample of DRY_RUN_SAMPLE_CASES cases.
+"""
+
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from osmatching.index import (
+    EMPTY_POSITIONS,
+    ControlIndex,
+    build_control_index,
+    get_numeric_values,
+)
+from osmatching.osmatching import (
+    RANDOM_SEED,
+    add_variables,
+    exclude_cases,
+    get_date_offset,
+    get_match_index_date,
+    get_tier_config,
+    import_data,
+    match_cases,
+    sort_cases,
+    thin_control_pool,
+)
+from osmatching.utils import MatchConfig, report_validation_errors
+from osmatching.validation import ValidationType, parse_and_validate_config
+
+
+# Number of cases matched to estimate the time of matching
+DRY_RUN_SAMPLE_CASES = 100
+# Number of the strata likely to be exhausted that are shown in the report
+DRY_RUN_REPORT_STRATA = 20
+
+
+@dataclass
+class DryRunEstimate:
+    # a row for each stratum of the cases
+    strata: pd.DataFrame
+    num_cases: int
+    seconds_per_case: float
+
+    @property
+    def expected_matched(self) -> int:
+        return int(self.strata["expected_matched"].sum())
+
+    @property
+    def match_rate(self) -> float:
+        return self.expected_matched / self.num_cases if self.num_cases else np.nan
+
+    @property
+    def exhausted(self) -> pd.DataFrame:
+        exhausted = self.strata[self.strata["demand"] > self.strata["supply"]]
+        shortfall = exhausted["demand"] - exhausted["supply"]
+        return exhausted.loc[shortfall.sort_values(ascending=False).index]
+
+    @property
+    def estimated_seconds(self) -> float:
+        return self.seconds_per_case * self.num_cases
+
+
+def get_case_strata(
+    cases: pd.DataFrame, category_variables: list[str]
+) -> dict[tuple, np.ndarray]:
+    """
+    The positions of the cases in each stratum; cases with missing category values,
+    which never match, are in none.
+    """
+    if not category_variables:
+        return {(): np.arange(len(cases))}
+    groups = cases.groupby(category_variables, observed=True, sort=False).indices
+    return {
+        key if isinstance(key, tuple) else (key,): positions
+        for key, positions in groups.items()
+    }
+
+
+def count_candidates(
+    stratum_cases: pd.DataFrame,
+    supply: np.ndarray,
+    control_index: ControlIndex,
+    match_variables: dict,
+) -> np.ndarray:
+    """
+    The number of controls at the supply positions that are within range of each
+    case on the first scalar match variable; all of them, if there is none.
+    """
+    if not control_index.scalar_variables:
+        return np.full(len(stratum_cases), len(supply))
+    var = control_index.scalar_variables[0]
+    values = np.sort(control_index.scalar_values[var][supply])
+    case_values = get_numeric_values(stratum_cases[var])
+    tolerance = match_variables[var]
+    # missing values are sorted last, and never match
+    candidates = np.searchsorted(values, case_values + tolerance, side="right") - (
+        np.searchsorted(values, case_values - tolerance, side="left")
+    )
+    return np.where(np.isnan(case_values), 0, candidates)
+
+
+def estimate_strata(
+    cases: pd.DataFrame,
+    match_config: MatchConfig,
+    control_index: ControlIndex,
+    available: np.ndarray,
+) -> pd.DataFrame:
+    """
+    Compares the demand for controls in each stratum of the cases with the supply of
+    available controls (see the module docstring).
+    """
+    assert match_config.match_variables is not None  # guaranteed by validation
+    assert match_config.matches_per_case is not None
+    matches_per_case = match_config.matches_per_case
+    date_offset = None
+    if match_config.match_index_date_offset:
+        date_offset = get_date_offset(match_config.match_index_date_offset)
+
+    rows = []
+    for key, positions in get_case_strata(
+        cases, control_index.category_variables
+    ).items():
+        stratum_cases = cases.iloc[positions]
+        supply = control_index.strata.get(key, EMPTY_POSITIONS)
+        supply = supply[available[supply]]
+        if match_config.date_exclusion_variables:
+            median_case = pd.Series(
+                {
+                    match_config.index_date_variable: stratum_cases[
+                        match_config.index_date_variable
+                    ].median()
+                }
+            )
+            index_date = get_match_index_date(median_case, match_config, date_offset)
+            supply = supply[~control_index.get_exclusions(supply, index_date)]
+        candidates = count_candidates(
+            stratum_cases, supply, control_index, match_config.match_variables
+        )
+        rows.append(
+            (
+                *key,
+                len(stratum_cases),
+                len(stratum_cases) * matches_per_case,
+                len(supply),
+                min(
+                    (candidates >= matches_per_case).sum(),
+                    len(supply) // matches_per_case,
+                ),
+            )
+        )
+    return pd.DataFrame(
+        rows,
+        columns=[
+            *control_index.category_variables,
+            "cases",
+            "demand",
+            "supply",
+            "expected_matched",
+        ],
+    )
+
+
+def time_matching(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_config: MatchConfig,
+    control_index: ControlIndex,
+    available: np.ndarray,
+) -> float:
+    """
+    The mean time in seconds of matching a case, from matching a random sample of
+    the cases against a copy of the available controls.
+    """
+    sample_size = min(DRY_RUN_SAMPLE_CASES, len(cases))
+    if not sample_size:
+        return 0.0
+    rng = np.random.default_rng(RANDOM_SEED)
+    sample = np.sort(rng.choice(len(cases), size=sample_size, replace=False))
+    started = time.perf_counter()
+    match_cases(
+        cases.iloc[sample], matches, match_config, control_index, available.copy()
+    )
+    return (time.perf_counter() - started) / sample_size
+
+
+def get_dry_run_report(estimate: DryRunEstimate, match_config: MatchConfig) -> list:
+    exhausted = estimate.exhausted
+    report = [
+        "Dry run estimates:",
+        f"Cases                          {estimate.num_cases}",
+        f"Matches per case               {match_config.matches_per_case}",
+        f"Cases fully matched            {estimate.expected_matched} "
+        f"({estimate.match_rate:.1%})",
+        f"Strata                         {len(estimate.strata)}",
+        f"Strata likely to be exhausted  {len(exhausted)}",
+        "Estimated matching time        "
+        f"{timedelta(seconds=round(estimate.estimated_seconds))} "
+        f"({estimate.estimated_seconds:.1f} seconds)",
+    ]
+    if len(exhausted):
+        report += [
+            "\nStrata likely to be exhausted (by shortfall):",
+            exhausted.head(DRY_RUN_REPORT_STRATA).to_string(index=False),
+        ]
+        if len(exhausted) > DRY_RUN_REPORT_STRATA:
+            report.append(f"... and {len(exhausted) - DRY_RUN_REPORT_STRATA} more")
+    return report
+
+
+def dry_run(
+    case_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_config: MatchConfig,
+    control_index: ControlIndex | None = None,
+) -> DryRunEstimate:
+    """
+    Estimates the results and time of matching the cases (see the module
+    docstring), without running matching. The estimates are printed and written to
+    dry_run<output_suffix>.txt, and returned.
+    """
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
+    started = datetime.now()
+
+    cases, matches = import_data(case_df, match_df, match_config)
+    available = np.ones(len(matches), dtype=bool)
+    if match_config.drop_cases_from_matches:
+        available &= ~matches.index.isin(cases.index)
+    cases, matches = add_variables(cases, matches, match_config.indicator_variable_name)
+    if control_index is None or not control_index.is_valid_for(matches, match_config):
+        control_index = build_control_index(matches, match_config)
+    if match_config.date_exclusion_variables:
+        cases = exclude_cases(cases, match_config)
+    cases = sort_cases(cases, match_config)
+    if match_config.control_pool_multiple:
+        thin_control_pool(cases, match_config, control_index, available)
+    if match_config.tiers:
+        match_config = get_tier_config(match_config, match_config.tiers[-1])
+
+    estimate = DryRunEstimate(
+        strata=estimate_strata(cases, match_config, control_index, available),
+        num_cases=len(cases),
+        seconds_per_case=time_matching(
+            cases, matches, match_config, control_index, available
+        ),
+    )
+    report = "\n".join(
+        [
+            f"Dry run started at: {started}",
+            f"Completed {datetime.now()}\n",
+            *get_dry_run_report(estimate, match_config),
+        ]
+    )
+    match_config.output_path.mkdir(parents=True, exist_ok=True)
+    report_path = match_config.output_path / f"dry_run{match_config.output_suffix}.txt"
+    report_path.write_text(f"{report}\n")
+    print(report)
+    return estimate
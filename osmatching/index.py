@@ -0,0 +1,372 @@
+"""
+Index of a control (matches) dataset, used to find the eligible matches for each
+case without scanning the whole dataset.
+
+Controls are grouped into strata of identical values of the category match
+variables. Within each stratum, controls are sorted by the first scalar match
+variable, so that those within its range of a case's value can be found by binary
+search. Date exclusion variables are reduced to two boundary dates per control:
+a control is excluded if its earliest "before" exclusion date is before the index
+date, or its latest "after" exclusion date is after it.
+
+An index depends only on the controls and on which variables are used for
+matching and exclusions, not on the cases or scalar match ranges. It can be built
+once with `osmatching index` and saved as a sidecar file next to the controls
+file, which is then loaded by later matching runs.
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from osmatching.utils import (
+    MatchConfig,
+    file_digest,
+    file_stamp,
+    import_match_variables,
+)
+
+
+# Increment this if the format of index files changes
+INDEX_VERSION = 1
+NO_STRATUM = -1
+EMPTY_POSITIONS = np.array([], dtype=np.int64)
+
+
+def get_index_path(controls_path: Path) -> Path:
+    return controls_path.with_name(f"{controls_path.name}.index")
+
+
+def get_index_key(config: MatchConfig) -> str:
+    """
+    Identifies the parts of the config that an index depends on. Scalar match
+    ranges can change without rebuilding the index.
+    """
+    assert config.match_variables is not None  # guaranteed by validation
+    match_variables = import_match_variables(config.match_variables)
+    return json.dumps(
+        {
+            "version": INDEX_VERSION,
+            "category_variables": get_category_variables(match_variables),
+            "scalar_variables": get_scalar_variables(match_variables),
+            "date_exclusion_variables": config.date_exclusion_variables,
+            "index_date_variable": config.index_date_variable,
+        },
+        sort_keys=True,
+    )
+
+
+def get_category_variables(match_variables: dict) -> list[str]:
+    return [
+        var for var, match_type in match_variables.items() if match_type == "category"
+    ]
+
+
+def get_scalar_variables(match_variables: dict) -> list[str]:
+    return [
+        var for var, match_type in match_variables.items() if match_type != "category"
+    ]
+
+
+def get_numeric_values(series: pd.Series) -> np.ndarray:
+    values = series.to_numpy()
+    if values.dtype.kind not in "iuf":
+        # e.g. nullable integers
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+    return values
+
+
+def get_exclusion_boundaries(
+    matches: pd.DataFrame, date_exclusion_variables: dict, when: str
+) -> np.ndarray | None:
+    """
+    For "before" exclusions, the earliest exclusion date of each control; for "after"
+    exclusions, the latest. Missing dates are ignored, as they never exclude a
+    control.
+    """
+    variables = [
+        var
+        for var, before_after in date_exclusion_variables.items()
+        if before_after == when
+    ]
+    if not variables:
+        return None
+    dates = matches[variables]
+    boundaries = dates.min(axis=1) if when == "before" else dates.max(axis=1)
+    return boundaries.to_numpy(dtype="datetime64[ns]")
+
+
+@dataclass
+class ControlIndex:
+    key: str
+    source_digest: str
+    patient_ids: np.ndarray
+    category_variables: list[str]
+    scalar_variables: list[str]
+    # stratum id of each control, or NO_STRATUM if any category value is missing
+    stratum_ids: np.ndarray
+    # values of the category variables for each stratum id
+    stratum_keys: list[tuple]
+    scalar_values: dict[str, np.ndarray]
+    index_dates: np.ndarray
+    exclude_before: np.ndarray | None
+    exclude_after: np.ndarray | None
+    # the size and modification time of the source file (see utils.file_stamp)
+    source_stamp: str = ""
+
+    def __post_init__(self) -> None:
+        self.strata: dict[tuple, np.ndarray] = {}
+        self.sorted_values: dict[tuple, np.ndarray] = {}
+        if self.scalar_variables:
+            first_values = self.scalar_values[self.scalar_variables[0]]
+            # sort by stratum, then by the first scalar variable
+            order = np.lexsort((first_values, self.stratum_ids))
+        else:
+            order = np.argsort(self.stratum_ids, kind="stable")
+        sorted_strata = self.stratum_ids[order]
+        boundaries = np.flatnonzero(np.diff(sorted_strata)) + 1
+        for positions in np.split(order, boundaries):
+            if not len(positions) or self.stratum_ids[positions[0]] == NO_STRATUM:
+                continue
+            key = self.stratum_keys[self.stratum_ids[positions[0]]]
+            self.strata[key] = positions
+            if self.scalar_variables:
+                self.sorted_values[key] = first_values[positions]
+
+    def is_valid_for(self, matches: pd.DataFrame, config: MatchConfig) -> bool:
+        return self.key == get_index_key(config) and np.array_equal(
+            self.patient_ids, matches.index.to_numpy()
+        )
+
+    def get_candidates(self, case_row: pd.Series, match_variables: dict) -> np.ndarray:
+        """
+        Positions of the controls that match the case on all match variables, in
+        their original order (equivalent to comparing the case with every control,
+        as benchmarks.differential.get_eligible_matches does, without removing
+        previously matched controls).
+        """
+        key = tuple(case_row[var] for var in self.category_variables)
+        if any(pd.isna(value) for value in key) or key not in self.strata:
+            return EMPTY_POSITIONS
+        positions = self.strata[key]
+        if not self.scalar_variables:
+            return positions
+
+        case_values = {var: case_row[var] for var in self.scalar_variables}
+        if any(pd.isna(value) for value in case_values.values()):
+            return EMPTY_POSITIONS
+        first_var = self.scalar_variables[0]
+        value, tolerance = case_values[first_var], match_variables[first_var]
+        # The search range is widened slightly so that no values are missed due to
+        # floating point rounding; the exact comparisons are made below
+        slack = 1e-9 * (abs(value) + tolerance + 1)
+        sorted_values = self.sorted_values[key]
+        start = np.searchsorted(sorted_values, value - tolerance - slack, side="left")
+        end = np.searchsorted(sorted_values, value + tolerance + slack, side="right")
+        positions = positions[start:end]
+        for var, value in case_values.items():
+            differences = abs(self.scalar_values[var][positions] - value)
+            positions = positions[differences <= match_variables[var]]
+        return np.sort(positions)
+
+    def get_exclusions(
+        self, positions: np.ndarray, index_date: pd.Timestamp | None
+    ) -> np.ndarray:
+        """
+        Boolean array of the controls at positions that are excluded by date
+        (equivalent to date_exclusions). If index_date is None, each control's own
+        index date is used.
+        """
+        if index_date is None:
+            dates = self.index_dates[positions]
+        else:
+            dates = pd.Timestamp(index_date).to_datetime64()
+        excluded = np.zeros(len(positions), dtype=bool)
+        # comparisons with missing dates (NaT) are always False
+        if self.exclude_before is not None:
+            excluded |= self.exclude_before[positions] < dates
+        if self.exclude_after is not None:
+            excluded |= self.exclude_after[positions] > dates
+        return excluded
+
+    def write(self, path: Path):
+        """
+        Writes the index to an arrow file. The category values of each stratum are
+        stored in the file metadata, as a serialized arrow table.
+        """
+        path = Path(path)
+        columns = {
+            "patient_id": self.patient_ids,
+            "stratum_id": self.stratum_ids,
+            "index_date": self.index_dates,
+            **{
+                f"scalar_{var}": self.scalar_values[var]
+                for var in self.scalar_variables
+            },
+        }
+        if self.exclude_before is not None:
+            columns["exclude_before"] = self.exclude_before
+        if self.exclude_after is not None:
+            columns["exclude_after"] = self.exclude_after
+        table = pa.table(columns)
+
+        strata = pa.table(
+            {
+                var: [key[i] for key in self.stratum_keys]
+                for i, var in enumerate(self.category_variables)
+            }
+        )
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, strata.schema) as writer:
+            writer.write_table(strata)
+        metadata = {
+            "key": self.key,
+            "source_digest": self.source_digest,
+            "source_stamp": self.source_stamp,
+            "category_variables": json.dumps(self.category_variables),
+            "scalar_variables": json.dumps(self.scalar_variables),
+            "strata": sink.getvalue().to_pybytes(),
+        }
+        table = table.replace_schema_metadata(metadata)
+        # write to a temporary file first, so that a matching run never reads a
+        # partially written index
+        temporary_file = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with pa.ipc.new_file(temporary_file, table.schema) as writer:
+            writer.write_table(table)
+        temporary_file.replace(path)
+
+    @classmethod
+    def read(cls, path: Path) -> "ControlIndex":
+        with pa.memory_map(str(path)) as source:
+            table = pa.ipc.open_file(source).read_all()
+        metadata = table.schema.metadata
+        category_variables = json.loads(metadata[b"category_variables"])
+        scalar_variables = json.loads(metadata[b"scalar_variables"])
+        strata = pa.ipc.open_stream(metadata[b"strata"]).read_all()
+        if category_variables:
+            stratum_keys = list(
+                zip(*(strata[var].to_pylist() for var in category_variables))
+            )
+        else:
+            stratum_keys = [()]
+
+        def get_column(name):
+            if name not in table.column_names:
+                return None
+            return table[name].to_numpy()
+
+        return cls(
+            key=metadata[b"key"].decode(),
+            source_digest=metadata[b"source_digest"].decode(),
+            patient_ids=get_column("patient_id"),
+            category_variables=category_variables,
+            scalar_variables=scalar_variables,
+            stratum_ids=get_column("stratum_id"),
+            stratum_keys=stratum_keys,
+            scalar_values={
+                var: get_column(f"scalar_{var}") for var in scalar_variables
+            },
+            index_dates=get_column("index_date"),
+            exclude_before=get_column("exclude_before"),
+            exclude_after=get_column("exclude_after"),
+            source_stamp=metadata.get(b"source_stamp", b"").decode(),
+        )
+
+
+def get_strata(
+    matches: pd.DataFrame, category_variables: list[str]
+) -> tuple[np.ndarray, list[tuple]]:
+    """
+    Assigns a stratum id to each control, from its values of the category
+    variables, and returns these ids with the category values of each stratum.
+    """
+    num_controls = len(matches)
+    if not category_variables:
+        return np.zeros(num_controls, dtype=np.int64), [()]
+
+    factorized = [pd.factorize(matches[var]) for var in category_variables]
+    combined = np.zeros(num_controls, dtype=np.int64)
+    has_values = np.ones(num_controls, dtype=bool)
+    for codes, uniques in factorized:
+        combined = combined * len(uniques) + codes
+        has_values &= codes != NO_STRATUM
+
+    stratum_ids = np.full(num_controls, NO_STRATUM, dtype=np.int64)
+    ids, _ = pd.factorize(combined[has_values])
+    stratum_ids[has_values] = ids
+    _, first_indices = np.unique(ids, return_index=True)
+    first_positions = np.flatnonzero(has_values)[first_indices]
+    stratum_keys = [
+        tuple(uniques[codes[position]] for codes, uniques in factorized)
+        for position in first_positions
+    ]
+    return stratum_ids, stratum_keys
+
+
+def build_control_index(
+    matches: pd.DataFrame,
+    config: MatchConfig,
+    source_digest: str = "",
+    source_stamp: str = "",
+) -> ControlIndex:
+    """
+    Builds the index of an imported controls dataset. source_digest and
+    source_stamp identify the file that the controls were loaded from, if any (see
+    utils.file_digest and utils.file_stamp).
+    """
+    assert config.match_variables is not None  # guaranteed by validation
+    match_variables = import_match_variables(config.match_variables)
+    category_variables = get_category_variables(match_variables)
+    scalar_variables = get_scalar_variables(match_variables)
+    stratum_ids, stratum_keys = get_strata(matches, category_variables)
+    return ControlIndex(
+        key=get_index_key(config),
+        source_digest=source_digest,
+        patient_ids=matches.index.to_numpy(),
+        category_variables=category_variables,
+        scalar_variables=scalar_variables,
+        stratum_ids=stratum_ids,
+        stratum_keys=stratum_keys,
+        scalar_values={
+            var: get_numeric_values(matches[var]) for var in scalar_variables
+        },
+        index_dates=matches[config.index_date_variable].to_numpy(
+            dtype="datetime64[ns]"
+        ),
+        exclude_before=get_exclusion_boundaries(
+            matches, config.date_exclusion_variables, "before"
+        ),
+        exclude_after=get_exclusion_boundaries(
+            matches, config.date_exclusion_variables, "after"
+        ),
+        source_stamp=source_stamp,
+    )
+
+
+def load_control_index(controls_path: Path, config: MatchConfig) -> ControlIndex | None:
+    """
+    Loads the sidecar index of a controls file, if there is one and it is up to
+    date with the file contents and the config. The file is only hashed to check
+    its contents if its size or modification time has changed since the index was
+    built.
+    """
+    index_path = get_index_path(controls_path)
+    if not index_path.exists():
+        return None
+    with pa.memory_map(str(index_path)) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata
+    if metadata[b"key"].decode() != get_index_key(config):
+        print(f"Control index {index_path} was built with a different config; ignoring")
+        return None
+    source_stamp = metadata.get(b"source_stamp", b"").decode()
+    if source_stamp != file_stamp(controls_path) and (
+        metadata[b"source_digest"].decode() != file_digest(controls_path)
+    ):
+        print(f"Control index {index_path} is out of date; ignoring")
+        return None
+    return ControlIndex.read(index_path)
@@ -0,0 +1,290 @@
+"""
+Timing and memory metrics of the stages of matching.
+
+The wall time, CPU time and peak resident memory of the process so far are
+recorded at the end of each stage of matching (e.g. importing the data, or the matching loop),
+as each section of the matching report is completed, with the number of rows
+(e.g. of cases and matches) left after it. The metrics are written to
+matching_metrics<output_suffix>.json, next to the matching report, so that the
+scaling of matching can be compared across studies, and a stage that takes much
+longer or uses much more memory than expected can be found.
+
+CPU time is that of the whole process, so it includes threads running at the same
+time as the stage, such as those loading the controls while the cases are
+imported; for the output files, which are written concurrently, it is that of the
+thread writing each file. A stage that is run more than once (e.g. loading, which
+is waited for once for each dataset, or matching each partition of the controls)
+has the sum of its times and rows. The peak memory is the high-water mark of the
+whole process at the end of the stage, not of the stage alone, so it never
+decreases from one stage to the next; a stage that used more memory than any before
+it is one after which it increased. It is only recorded where the resource module
+is available (not on Windows).
+
+With a profiler (see osmatching.profiling), each stage recorded by lap() is also
+profiled. With loop counters, what the matching loop did for each case is counted
+(see LoopCounters), and written to the metrics and the matching report.
+
+The progress of the matching loop is also printed (but not added to the report)
+every PROGRESS_INTERVAL_SECONDS, so that slow matching can be told apart from
+matching that's stuck in the logs of a running job (see MatchingProgress).
+"""
+
+import json
+import os
+import sys
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from osmatching.profiling import StageProfiler
+
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # resource is Unix-only
+    resource = None  # type: ignore[assignment]
+
+# ru_maxrss is in bytes on macOS, and kilobytes elsewhere
+MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
+BYTES_PER_MB = 1024 * 1024
+# The resident memory of the process, in pages, is the second field of this file
+# (on Linux only)
+PROC_STATM_PATH = Path("/proc/self/statm")
+# Minimum time between progress updates of the matching loop
+PROGRESS_INTERVAL_SECONDS = 60.0
+
+
+def get_peak_rss_mb() -> float | None:
+    """The peak resident memory of the process so far; None if it isn't available"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss * MAXRSS_BYTES / BYTES_PER_MB, 1)
+
+
+def get_current_rss_mb() -> float | None:
+    """The resident memory of the process; its peak, where that isn't available"""
+    try:
+        resident_pages = int(PROC_STATM_PATH.read_text().split()[1])
+    except OSError:
+        return get_peak_rss_mb()
+    return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / BYTES_PER_MB, 1)
+
+
+def get_metrics_path(output_path: Path, output_suffix: str) -> Path:
+    return output_path / f"matching_metrics{output_suffix}.json"
+
+
+@dataclass
+class MatchingProgress:
+    """
+    Prints the progress of matching num_cases cases, at most every
+    PROGRESS_INTERVAL_SECONDS; the check of the time in update() is all that's done
+    for most cases. label identifies the cases, e.g. a matching tier, and cases
+    matched before the loop started (e.g. before resuming from a checkpoint) are
+    counted as done, but not in the rate of matching.
+    """
+
+    num_cases: int
+    label: str = ""
+    done_before: int = 0
+    started: float = field(default_factory=time.monotonic)
+    last_reported: float = field(default_factory=time.monotonic)
+
+    def update(self, done: int, available: np.ndarray):
+        now = time.monotonic()
+        if now - self.last_reported < PROGRESS_INTERVAL_SECONDS:
+            return
+        self.last_reported = now
+        rate = (done - self.done_before) / max(now - self.started, 1e-9)
+        eta = "unknown"
+        if rate:
+            eta = str(timedelta(seconds=round((self.num_cases - done) / rate)))
+        rss_mb = get_current_rss_mb()
+        memory = "unknown" if rss_mb is None else f"{rss_mb} MB"
+        print(
+            f"Matching progress{self.label}: {done}/{self.num_cases} cases "
+            f"({done / self.num_cases:.1%}), {rate:.1f} cases/s, ETA {eta}, "
+            f"{available.sum()} controls available, "
+            f"memory {memory}",
+            flush=True,
+        )
+
+
+@dataclass
+class StageMetrics:
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    # the peak of the whole process at the end of the stage
+    process_peak_rss_mb: float | None = None
+    rows: dict[str, int] = field(default_factory=dict)
+
+
+def get_histogram(values: list[int], name: str) -> pd.Series:
+    """
+    The number of values in bins of powers of two: 0, 1, 2-3, 4-7, and so on, up to
+    the bin of the largest value.
+    """
+    values_array = np.asarray(values, dtype=np.int64)
+    bins = np.zeros(len(values_array), dtype=np.int64)
+    positive = values_array > 0
+    bins[positive] = np.floor(np.log2(values_array[positive])).astype(np.int64) + 1
+    labels = ["0", "1"] + [f"{2 ** (b - 1)}-{2**b - 1}" for b in range(2, 64)]
+    counts = np.bincount(bins, minlength=1)
+    return pd.Series(
+        counts, index=pd.Index(labels[: len(counts)], name=name), name="cases"
+    )
+
+
+@dataclass
+class LoopCounters:
+    """
+    Counts of what the matching loop did for each case, for tuning matching
+    configs. Values are appended for each case as it's matched, in any tier or
+    partition, so counting adds little to matching, and nothing if it's disabled.
+    """
+
+    # the available candidates of each case, before date exclusions
+    candidates: list[int] = field(default_factory=list)
+    # the candidates of each case excluded by date exclusions
+    date_excluded: list[int] = field(default_factory=list)
+    # the number of tied candidates that the matches of each case were randomly
+    # sampled from, for the cases that had more than matches_per_case
+    sampled_from: list[int] = field(default_factory=list)
+    # cases that would have had enough candidates if earlier cases hadn't been
+    # matched to them
+    exhausted: int = 0
+
+    def get_histograms(self) -> dict[str, pd.Series]:
+        return {
+            "candidates": get_histogram(self.candidates, "candidates"),
+            "date_excluded": get_histogram(self.date_excluded, "date_excluded"),
+            "sampled_from": get_histogram(self.sampled_from, "sampled_from"),
+        }
+
+    def get_report(self) -> list[str]:
+        histograms = self.get_histograms()
+        return [
+            "Matching loop counters:",
+            f"Cases              {len(self.candidates)}",
+            f"Stratum exhausted  {self.exhausted}",
+            f"Sampled from ties  {len(self.sampled_from)}",
+            "\nAvailable candidates per case:",
+            histograms["candidates"].to_string(),
+            "\nCandidates excluded by date per case:",
+            histograms["date_excluded"].to_string(),
+            "\nTied candidates sampled from per sampled case:",
+            histograms["sampled_from"].to_string(),
+        ]
+
+    def to_dict(self) -> dict:
+        return {
+            "cases": len(self.candidates),
+            "exhausted": self.exhausted,
+            "sampled": len(self.sampled_from),
+            "histograms": {
+                name: {str(label): int(count) for label, count in histogram.items()}
+                for name, histogram in self.get_histograms().items()
+            },
+        }
+
+
+@dataclass
+class MatchingMetrics:
+    stages: dict[str, StageMetrics] = field(default_factory=dict)
+    started: float = field(default_factory=time.perf_counter)
+    cpu_started: float = field(default_factory=time.process_time)
+    # the end of the last stage recorded by lap()
+    lap_started: float = field(default_factory=time.perf_counter)
+    lap_cpu_started: float = field(default_factory=time.process_time)
+    profiler: StageProfiler | None = None
+    counters: LoopCounters | None = None
+
+    def __post_init__(self):
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def record(self, name: str, wall_seconds: float, cpu_seconds: float, **rows):
+        metrics = self.stages.setdefault(name, StageMetrics())
+        metrics.wall_seconds += wall_seconds
+        metrics.cpu_seconds += cpu_seconds
+        metrics.process_peak_rss_mb = get_peak_rss_mb()
+        for key, value in rows.items():
+            metrics.rows[key] = metrics.rows.get(key, 0) + int(value)
+
+    def add(self, other: dict):
+        """
+        Adds the stages of the metrics of another run, as written by write() (e.g.
+        of a shard; see osmatching.shard). Their times and rows are summed, and the
+        peak memory of each stage is the larger of those of the two processes.
+        """
+        for name, stage in other["stages"].items():
+            metrics = self.stages.setdefault(name, StageMetrics())
+            metrics.wall_seconds += stage["wall_seconds"]
+            metrics.cpu_seconds += stage["cpu_seconds"]
+            peaks = [metrics.process_peak_rss_mb, stage["process_peak_rss_mb"]]
+            metrics.process_peak_rss_mb = max(
+                (peak for peak in peaks if peak is not None), default=None
+            )
+            for key, value in stage["rows"].items():
+                metrics.rows[key] = metrics.rows.get(key, 0) + int(value)
+
+    def lap(self, name: str, **rows):
+        """
+        Records the named stage as the time since the end of the last one (or the
+        start of matching), with the given row counts.
+        """
+        if self.profiler is not None:
+            self.profiler.lap(name)
+        lap_ended = time.perf_counter()
+        lap_cpu_ended = time.process_time()
+        self.record(
+            name,
+            lap_ended - self.lap_started,
+            lap_cpu_ended - self.lap_cpu_started,
+            **rows,
+        )
+        self.lap_started = lap_ended
+        self.lap_cpu_started = lap_cpu_ended
+
+    @contextmanager
+    def thread_stage(self, name: str, **rows) -> Iterator[None]:
+        """
+        Records the code run in the block, in its own thread, as the named stage,
+        with the given row counts, independently of lap(). The CPU time is that of
+        the thread.
+        """
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        yield
+        self.record(
+            name,
+            time.perf_counter() - started,
+            time.thread_time() - cpu_started,
+            **rows,
+        )
+
+    def to_dict(self) -> dict:
+        metrics = {
+            "stages": {name: asdict(metrics) for name, metrics in self.stages.items()},
+            "total": asdict(
+                StageMetrics(
+                    wall_seconds=time.perf_counter() - self.started,
+                    cpu_seconds=time.process_time() - self.cpu_started,
+                    process_peak_rss_mb=get_peak_rss_mb(),
+                )
+            ),
+        }
+        if self.counters is not None:
+            metrics["loop_counters"] = self.counters.to_dict()
+        return metrics
+
+    def write(self, file_path: Path):
+        file_path.write_text(json.dumps(self.to_dict(), indent=2))
@@ -1,74 +1,175 @@
 """Main program that does matching"""
 
 import copy
+import json
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from pathlib import Path
+from typing import Any, Optional
 
+import numpy as np
 import pandas as pd
 
-from osmatching.utils import MatchConfig, report_validation_errors, write_output_file
+from osmatching import arrow_engine
+from osmatching.balance import (
+    get_balance_report,
+    get_balance_table,
+    get_balance_variables,
+)
+from osmatching.checkpoint import Checkpoint, get_checkpoint_key, get_checkpoint_path
+from osmatching.index import EMPTY_POSITIONS, ControlIndex, build_control_index
+from osmatching.metrics import (
+    LoopCounters,
+    MatchingMetrics,
+    MatchingProgress,
+    get_metrics_path,
+)
+from osmatching.profiling import StageProfiler, get_profile_path
+from osmatching.strata import (
+    get_case_strata,
+    get_strata_path,
+    get_stratum_table,
+    sort_strata,
+    suppress_small_numbers,
+    to_stratum_table,
+)
+from osmatching.utils import (
+    MATCH_TIER_VARIABLE,
+    RANDOM_SEED,
+    ROW_NUMBER_VARIABLE,
+    MatchConfig,
+    import_match_variables,
+    report_validation_errors,
+    select_output_columns,
+    write_output_file,
+    write_output_files,
+)
 from osmatching.validation import (
     ValidationType,
+    get_population_config,
+    merge_errors,
     parse_and_validate_config,
-    validate_input_data,
+    validate_case_columns,
+    validate_match_columns,
+    validate_previous_run_columns,
 )
 
 
 NOT_PREVIOUSLY_MATCHED = -9
+# Records in DataFrame.attrs that a dataset has already been imported
+IMPORT_KEY_ATTR = "osmatching_import_key"
 
 
-def import_data(
-    cases: pd.DataFrame,
-    matches: pd.DataFrame,
-    match_config: MatchConfig,
-) -> tuple[pd.DataFrame, pd.DataFrame]:
+def resolve_dataframe(df: "pd.DataFrame | Future[pd.DataFrame]") -> pd.DataFrame:
+    """
+    Input datasets may be passed as a Future that resolves to a DataFrame; the
+    command line tool loads both input files concurrently in background threads.
+    """
+    if isinstance(df, Future):
+        return df.result()
+    return df
+
+
+def get_import_key(match_config: MatchConfig) -> str:
+    """
+    Identifies the parts of the config that determine how a dataset is imported
     """
-    Sets the correct data types for the matching variables.
+    return json.dumps(
+        {
+            "match_variables": match_config.match_variables,
+            "date_exclusion_variables": match_config.date_exclusion_variables,
+            "index_date_variable": match_config.index_date_variable,
+        },
+        sort_keys=True,
+    )
+
+
+def import_dataframe(df: pd.DataFrame, match_config: MatchConfig) -> pd.DataFrame:
+    """
+    Sets the correct data types for the matching variables in a single (case or
+    match) dataset. match_config.match_variables is not updated here, as both
+    datasets must be imported with the original match variables; see import_data.
+
+    Datasets that have already been imported with the same config (e.g. loaded
+    from the control cache) are returned unchanged.
     """
     assert match_config.match_variables is not None  # guaranteed by validation
-    match_variables = copy.deepcopy(match_config.match_variables)
+
+    import_key = get_import_key(match_config)
+    if df.attrs.get(IMPORT_KEY_ATTR) == import_key:
+        return df
 
     # If there is no index_date_variable in the matches df, add an empty column for it
-    if match_config.index_date_variable not in matches.columns:
-        matches[match_config.index_date_variable] = ""
+    if match_config.index_date_variable not in df.columns:
+        df[match_config.index_date_variable] = ""
 
     ## Set data types for matching variables
-    month_only = []
-    for var, match_type in match_variables.items():
+    for var, match_type in match_config.match_variables.items():
         if match_type == "category":
             # arrow files already have category types, so we don't need to convert them
-            if cases[var].dtype.name == "category":
+            if df[var].dtype.name == "category":
                 continue
-            cases[var] = cases[var].astype("category")
-            matches[var] = matches[var].astype("category")
+            df[var] = df[var].astype("category")
         ## Extract month from month_only variables
         elif match_type == "month_only":
-            month_only.append(var)
             # Ensure our datetimes are strings before slicing
-            cases[var] = cases[var].astype("str")
-            matches[var] = matches[var].astype("str")
-            cases[f"{var}_m"] = cases[var].str.slice(start=5, stop=7).astype("category")
-            matches[f"{var}_m"] = (
-                matches[var].str.slice(start=5, stop=7).astype("category")
-            )
-    for var in month_only:
-        del match_variables[var]
-        match_variables[f"{var}_m"] = "category"
-
-    match_config.match_variables = match_variables
+            df[var] = df[var].astype("str")
+            df[f"{var}_m"] = df[var].str.slice(start=5, stop=7).astype("category")
 
     ## Format exclusion variables as dates
     for var in match_config.date_exclusion_variables:
-        cases[var] = pd.to_datetime(cases[var])
-        matches[var] = pd.to_datetime(matches[var])
+        df[var] = pd.to_datetime(df[var])
 
     ## Format index dates as date
-    cases[match_config.index_date_variable] = pd.to_datetime(
-        cases[match_config.index_date_variable]
+    df[match_config.index_date_variable] = pd.to_datetime(
+        df[match_config.index_date_variable]
     )
-    matches[match_config.index_date_variable] = pd.to_datetime(
-        matches[match_config.index_date_variable]
+    df.attrs[IMPORT_KEY_ATTR] = import_key
+    return df
+
+
+def import_data(
+    cases: "pd.DataFrame | Future[pd.DataFrame]",
+    matches: "pd.DataFrame | Future[pd.DataFrame]",
+    match_config: MatchConfig,
+    metrics: MatchingMetrics | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Validates the input datasets and sets the correct data types for the matching
+    variables.
+
+    Either dataset may be a Future (see resolve_dataframe). The cases are validated
+    and imported as soon as they are available, while the matches are still
+    loading. Errors in either dataset are reported together once both are loaded.
+    If metrics are given, the time spent waiting for the datasets to load and
+    importing them are recorded.
+    """
+    assert match_config.match_variables is not None  # guaranteed by validation
+    if metrics is None:
+        metrics = MatchingMetrics()
+
+    cases = resolve_dataframe(cases)
+    metrics.lap("load", cases=len(cases))
+    case_errors = validate_case_columns(cases.columns, match_config)
+    if not case_errors:
+        cases = import_dataframe(cases, match_config)
+    metrics.lap("import_data", cases=len(cases))
+
+    matches = resolve_dataframe(matches)
+    metrics.lap("load", matches=len(matches))
+    errors = merge_errors(
+        case_errors, validate_match_columns(matches.columns, match_config)
     )
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+    matches = import_dataframe(matches, match_config)
+    metrics.lap("import_data", matches=len(matches))
+
+    match_config.match_variables = import_match_variables(match_config.match_variables)
 
     return cases, matches
 
@@ -92,62 +193,6 @@ def add_variables(
     return cases, matches
 
 
-def get_bool_index(
-    match_type: str, value: int, match_var: str, matches: pd.DataFrame
-) -> pd.Series:
-    """
-    Compares the value in the given case variable to the variable in
-    the match dataframe, to generate a boolean Series. Comparisons vary
-    according to the matching specification.
-    """
-    if match_type == "category":
-        return matches[match_var] == value
-    else:
-        assert isinstance(match_type, int), "Unknown matching type '{match_type}'"
-        return abs(matches[match_var] - value) <= match_type
-
-
-def pre_calculate_indices(
-    cases: pd.DataFrame, matches: pd.DataFrame, match_variables: dict
-) -> dict[str, str]:
-    """
-    Loops over each of the values in the case table for each of the match
-    variables and generates a boolean Series against the match table. These are
-    returned in a dict.
-    """
-    indices_dict: dict = {}
-    for match_var in match_variables:
-        match_type = match_variables[match_var]
-        indices_dict[match_var] = {}
-
-        values = cases[match_var].unique()
-        for value in values:
-            index = get_bool_index(match_type, value, match_var, matches)
-            indices_dict[match_var][value] = index
-    return indices_dict
-
-
-def get_eligible_matches(
-    case_row: pd.DataFrame,
-    matches: pd.DataFrame,
-    match_variables: dict,
-    indices: pd.DataFrame,
-) -> pd.DataFrame:
-    """
-    Loops over the match_variables and combines the boolean Series
-    from pre_calculate_indices into a single bool Series. Also removes previously
-    matched patients.
-    """
-    eligible_matches = pd.Series(data=True, index=matches.index)
-    for match_var in match_variables:
-        variable_bool = indices[match_var][case_row[match_var]]
-        eligible_matches = eligible_matches & variable_bool
-
-    not_previously_matched = matches["set_id"] == NOT_PREVIOUSLY_MATCHED
-    eligible_matches = eligible_matches & not_previously_matched
-    return eligible_matches
-
-
 def date_exclusions(df1: pd.DataFrame, date_exclusion_variables: dict, index_date: str):
     """
     Loops over the exclusion variables and creates a boolean Series corresponding
@@ -174,13 +219,15 @@ def greedily_pick_matches(
     matched_rows: pd.DataFrame,
     case_row: pd.DataFrame,
     closest_match_variables: list,
+    counters: LoopCounters | None = None,
 ) -> pd.Index:
     """
     Cuts the eligible_matches list to the number of matches specified. This is a
     greedy matching method, so if closest_match_variables are specified, it picks the
     values that deviate least from the case values (prioritised in the order they are
     specified). If there are more than matches_per_case matches who are identical,
-    matches are randomly sampled.
+    matches are randomly sampled, and the number sampled from is counted in
+    counters, if given.
     """
     # Ensure we're working with a copy of the matched_rows df
     matched_rows = matched_rows.copy()
@@ -192,10 +239,79 @@ def greedily_pick_matches(
         matched_rows = matched_rows.nsmallest(matches_per_case, sort_cols, keep="all")
 
     if len(matched_rows) > matches_per_case:
-        matched_rows = matched_rows.sample(n=matches_per_case, random_state=123)
+        if counters is not None:
+            counters.sampled_from.append(len(matched_rows))
+        matched_rows = matched_rows.sample(n=matches_per_case, random_state=RANDOM_SEED)
     return matched_rows.index
 
 
+def get_case_rows(
+    cases: pd.DataFrame, match_config: MatchConfig
+) -> Iterator[tuple[Any, pd.Series]]:
+    return cases.iterrows()
+
+
+def get_closest_matches(
+    matches: pd.DataFrame, closest_match_variables: list[str]
+) -> pd.DataFrame:
+    # a positional index, so that the labels of picked matches are their positions
+    return matches[closest_match_variables].reset_index(drop=True)
+
+
+def pick_matches(
+    matches_per_case: int,
+    closest_matches: pd.DataFrame,
+    positions: np.ndarray,
+    case_row: pd.Series,
+    closest_match_variables: list[str],
+    counters: LoopCounters | None = None,
+) -> np.ndarray:
+    return greedily_pick_matches(
+        matches_per_case,
+        closest_matches.iloc[positions],
+        case_row,
+        closest_match_variables,
+        counters,
+    ).to_numpy()
+
+
+@dataclass
+class MatchingEngine:
+    """
+    How match_cases reads the values of each case, and picks its matches from the
+    positions of its eligible matches, given the closest match variables of the
+    matches.
+    """
+
+    get_case_rows: Callable[[pd.DataFrame, MatchConfig], Iterator[tuple[Any, Any]]]
+    get_closest_matches: Callable[[pd.DataFrame, list[str]], Any]
+    pick_matches: Callable[..., np.ndarray]
+
+
+# Matching engines, selected by the `engine` config option; all engines pick the
+# same matches
+ENGINES = {
+    "pandas": MatchingEngine(get_case_rows, get_closest_matches, pick_matches),
+    "arrow": MatchingEngine(
+        arrow_engine.get_case_rows,
+        arrow_engine.get_closest_matches,
+        arrow_engine.pick_matches,
+    ),
+}
+
+
+def sort_cases(cases: pd.DataFrame, match_config: MatchConfig) -> pd.DataFrame:
+    """
+    Sorts the cases into the order they are matched in, by index date. The cases of
+    a shard (see osmatching.shard) are sorted by their row numbers, which give their
+    order among the cases of all the shards, as cases with the same index date may
+    be sorted into a different order when only some of them are sorted.
+    """
+    if ROW_NUMBER_VARIABLE in cases.columns:
+        return cases.sort_values(ROW_NUMBER_VARIABLE)
+    return cases.sort_values(match_config.index_date_variable)
+
+
 def get_date_offset(offset: tuple[str, str, int]) -> Optional[pd.DataFrame]:
     """
     Converts the tuple of unit and length given by match_index_date_offset
@@ -208,42 +324,340 @@ def get_date_offset(offset: tuple[str, str, int]) -> Optional[pd.DataFrame]:
         return pd.DateOffset(**{unit: length})
 
 
-def match(
-    case_df: str,
-    match_df: str,
+def exclude_cases(cases: pd.DataFrame, match_config: MatchConfig) -> pd.DataFrame:
+    """
+    Removes cases that are excluded by date, relative to their own index date.
+    """
+    case_exclusions = date_exclusions(
+        cases,
+        match_config.date_exclusion_variables,
+        cases[match_config.index_date_variable],
+    )
+    return cases.loc[~case_exclusions]
+
+
+def get_match_index_date(
+    case_row: pd.Series, match_config: MatchConfig, date_offset
+) -> pd.Timestamp | None:
+    """
+    The index date used for a case's matches; None if each match's own index date
+    is used.
+    """
+    if not match_config.match_index_date_offset:
+        return None
+    unit, offset_type, _ = match_config.match_index_date_offset
+
+    if unit == "no_offset":
+        return case_row[match_config.index_date_variable]
+    elif offset_type == "earlier":
+        return case_row[match_config.index_date_variable] - date_offset
+    elif offset_type == "later":
+        return case_row[match_config.index_date_variable] + date_offset
+    else:
+        assert False, f"Date offset type '{offset_type}' not recognised"
+
+
+def thin_control_pool(
+    cases: pd.DataFrame,
     match_config: MatchConfig,
-) -> tuple[pd.DataFrame, pd.DataFrame]:
+    control_index: ControlIndex,
+    available: np.ndarray,
+) -> pd.DataFrame:
     """
-    Wrapper function that calls functions to:
-    - import data
-    - find eligible matches
-    - pick the correct number of randomly allocated matches
-    - make exclusions that are based on index date
-      - (this is not currently possible in a study definition, and will only ever be possible
-        during matching for studies where the match index date comes from the case)
-    - set the set_id as that of the case_id (this excludes them from being matched later)
-    - set the index date of the match as that of the case (where desired)
-    - save the results in the specified output format
+    Randomly samples the available controls of each stratum (see osmatching.index)
+    down to control_pool_multiple times the number of matches its cases need, and
+    marks the rest as unavailable. Sampling is seeded, so results are reproducible.
+
+    Returns a table of the number of cases, available controls and controls kept
+    in each stratum of the cases, and the thinning ratio (controls kept / available).
     """
-    # validate the config if we haven't already
-    if not match_config.validated:
-        match_config, errors = parse_and_validate_config(match_config)
-        if errors:
-            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
-            raise ValueError("There was an error in one or more config values")
+    assert match_config.matches_per_case is not None  # guaranteed by validation
+    assert match_config.control_pool_multiple is not None
+    category_variables = control_index.category_variables
+    # number of cases in each stratum of the cases
+    case_counts = [((), len(cases))]
+    if category_variables:
+        value_counts = cases[category_variables].value_counts(sort=False)
+        # unobserved values of categorical variables are counted as 0
+        case_counts = list(value_counts[value_counts > 0].items())
 
-    errors = validate_input_data(case_df, match_df, match_config)
-    if errors:
-        report_validation_errors(errors, validation_type=ValidationType.DATA)
-        raise ValueError("Errors encountered in the input datasets")
+    rng = np.random.default_rng(RANDOM_SEED)
+    rows = []
+    for key, num_cases in case_counts:
+        positions = control_index.strata.get(key, EMPTY_POSITIONS)
+        pool = np.sort(positions[available[positions]])
+        pool_size = num_cases * match_config.matches_per_case
+        pool_size *= match_config.control_pool_multiple
+        if len(pool) > pool_size:
+            kept = rng.choice(pool, size=pool_size, replace=False)
+            available[pool] = False
+            available[kept] = True
+        rows.append(
+            (
+                *key,
+                num_cases,
+                len(pool),
+                min(len(pool), pool_size),
+                min(len(pool), pool_size) / len(pool) if len(pool) else np.nan,
+            )
+        )
+    return pd.DataFrame(
+        rows,
+        columns=[
+            *category_variables,
+            "cases",
+            "controls",
+            "controls_kept",
+            "thinning_ratio",
+        ],
+    )
+
+
+def match_cases(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_config: MatchConfig,
+    control_index: ControlIndex,
+    available: np.ndarray,
+    checkpoint: Checkpoint | None = None,
+    stage: int = 0,
+    counters: LoopCounters | None = None,
+    case_seconds: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+    """
+    Matches each of the (sorted) cases in turn to the eligible matches that are
+    still available, and marks the matches picked for it as unavailable. The values
+    of each case are read, and its matches picked, by match_config.engine (see
+    ENGINES).
 
-    # Guaranteed by validation; assert not None to satisfy mypy
-    assert match_config.match_variables is not None
+    Results are collected in arrays indexed by position: the number of matches
+    picked for each case, and the set_id of each match. If generate_match_index_date
+    is set, the index date of each match is also returned.
+
+    If a checkpoint is given, the state of matching is saved to it periodically, as
+    the given stage of matching; if it has a loaded state from this stage, matching
+    continues from there (see osmatching.checkpoint).
+
+    If counters are given, what the loop does for each case is counted (see
+    osmatching.metrics.LoopCounters). Progress is printed periodically (see
+    osmatching.metrics.MatchingProgress). If case_seconds is given, the time spent
+    matching each case is added to it.
+    """
+    assert match_config.match_variables is not None  # guaranteed by validation
     assert match_config.matches_per_case is not None
 
-    # Make sure the output path exists
-    match_config.output_path.mkdir(parents=True, exist_ok=True)
+    date_offset = None
+    if match_config.match_index_date_offset:
+        date_offset = get_date_offset(match_config.match_index_date_offset)
+
+    match_counts = np.zeros(len(cases))
+    set_ids = matches["set_id"].to_numpy(copy=True)
+    match_index_dates = None
+    if match_config.generate_match_index_date:
+        match_index_dates = matches[match_config.index_date_variable].to_numpy(
+            dtype="datetime64[ns]", copy=True
+        )
+    engine = ENGINES[match_config.engine]
+    closest_matches = engine.get_closest_matches(
+        matches, match_config.closest_match_variables
+    )
+
+    start = 0
+    state = checkpoint.get_state(stage) if checkpoint is not None else None
+    if state is not None:
+        start = int(state["position"])
+        match_counts = state["match_counts"]
+        set_ids = state["set_ids"]
+        available[:] = state["available"]
+        if match_index_dates is not None:
+            match_index_dates = state["match_index_dates"]
+
+    def get_state() -> dict[str, np.ndarray]:
+        state = {
+            "match_counts": match_counts,
+            "set_ids": set_ids,
+            "available": available,
+        }
+        if match_index_dates is not None:
+            state["match_index_dates"] = match_index_dates
+        return state
+
+    progress = MatchingProgress(
+        len(cases), label=f" (tier {stage})" if stage else "", done_before=start
+    )
+    for case_number, (case_id, case_row) in enumerate(
+        engine.get_case_rows(cases.iloc[start:], match_config), start=start
+    ):
+        if case_seconds is not None:
+            case_started = time.perf_counter()
+        ## Get eligible matches
+        eligible_matches = control_index.get_candidates(
+            case_row, match_config.match_variables
+        )
+        if counters is not None:
+            used = (set_ids[eligible_matches] != NOT_PREVIOUSLY_MATCHED).sum()
+        eligible_matches = eligible_matches[available[eligible_matches]]
+        if counters is not None:
+            counters.candidates.append(len(eligible_matches))
+            if (
+                len(eligible_matches)
+                < match_config.matches_per_case
+                <= len(eligible_matches) + used
+            ):
+                counters.exhausted += 1
+
+        ## Determine match index date; if None, each match's own index date is used
+        index_date = get_match_index_date(case_row, match_config, date_offset)
+
+        ## Index date based match exclusions (faster to do this after get_candidates)
+        if match_config.date_exclusion_variables:
+            exclusions = control_index.get_exclusions(eligible_matches, index_date)
+            eligible_matches = eligible_matches[~exclusions]
+            if counters is not None:
+                counters.date_excluded.append(exclusions.sum())
+
+        ## Pick random matches
+        matched_rows = engine.pick_matches(
+            match_config.matches_per_case,
+            closest_matches,
+            eligible_matches,
+            case_row,
+            match_config.closest_match_variables,
+            counters,
+        )
+
+        ## Report number of matches for each case
+        num_matches = len(matched_rows)
+        match_counts[case_number] = num_matches
+        ## Label matches with case ID if there are enough
+        if num_matches >= match_config.min_matches_per_case:
+            set_ids[matched_rows] = case_id
+            available[matched_rows] = False
+
+            ## Set index_date of the match where needed
+            if match_index_dates is not None:
+                match_index_dates[matched_rows] = pd.Timestamp(
+                    index_date
+                ).to_datetime64()
+
+        if case_seconds is not None:
+            case_seconds[case_number] += time.perf_counter() - case_started
+        if checkpoint is not None:
+            checkpoint.update(stage, case_number + 1, get_state())
+        progress.update(case_number + 1, available)
+
+    if checkpoint is not None:
+        checkpoint.save(stage, len(cases), get_state())
+    return match_counts, set_ids, match_index_dates
+
+
+def get_tier_config(match_config: MatchConfig, tier: dict[str, int]) -> MatchConfig:
+    """
+    The config for one matching tier; the match variables with the tier's ranges.
+    """
+    tier_config = copy.deepcopy(match_config)
+    assert tier_config.match_variables is not None  # guaranteed by validation
+    tier_config.match_variables.update(tier)
+    return tier_config
+
+
+def match_cases_in_tiers(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_config: MatchConfig,
+    control_index: ControlIndex,
+    available: np.ndarray,
+    checkpoint: Checkpoint | None = None,
+    counters: LoopCounters | None = None,
+    case_seconds: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Matches cases in the tiers given by match_config.tiers, in order. Cases with
+    fewer than min_matches_per_case matches in one tier are matched again in the
+    next, against the matches that are still available.
+
+    The set_id (and index date) of each match is updated in the matches dataframe.
+    Returns the number of matches picked for each case in the last tier it was
+    matched in, and the tier that each case and match was matched in (numbered
+    from 1, or 0 if unmatched).
+
+    Each tier is a stage of the checkpoint, if given, whose checkpoints include the
+    results of the earlier tiers; when resuming, those tiers are skipped.
+    """
+    match_counts = np.zeros(len(cases))
+    case_tiers = np.zeros(len(cases), dtype=np.int64)
+    match_tiers = np.zeros(len(matches), dtype=np.int64)
+    unmatched = np.arange(len(cases))
+    index_date_variable = match_config.index_date_variable
+    first_tier = 1
+    if checkpoint is not None and checkpoint.state:
+        first_tier = int(checkpoint.state["stage"])
+        match_counts = checkpoint.state["tiers_match_counts"]
+        case_tiers = checkpoint.state["case_tiers"]
+        match_tiers = checkpoint.state["match_tiers"]
+        unmatched = checkpoint.state["unmatched"]
+        matches["set_id"] = checkpoint.state["tier_set_ids"]
+        if match_config.generate_match_index_date:
+            matches[index_date_variable] = checkpoint.state["tier_match_index_dates"]
+
+    for tier_number, tier in enumerate(match_config.tiers, start=1):
+        if tier_number < first_tier:
+            continue
+        if checkpoint is not None:
+            checkpoint.context = {
+                "tiers_match_counts": match_counts,
+                "case_tiers": case_tiers,
+                "match_tiers": match_tiers,
+                "unmatched": unmatched,
+                "tier_set_ids": matches["set_id"].to_numpy(),
+            }
+            if match_config.generate_match_index_date:
+                checkpoint.context["tier_match_index_dates"] = matches[
+                    index_date_variable
+                ].to_numpy(dtype="datetime64[ns]")
+        tier_seconds = None if case_seconds is None else np.zeros(len(unmatched))
+        tier_counts, set_ids, match_index_dates = match_cases(
+            cases.iloc[unmatched],
+            matches,
+            get_tier_config(match_config, tier),
+            control_index,
+            available,
+            checkpoint,
+            stage=tier_number,
+            counters=counters,
+            case_seconds=tier_seconds,
+        )
+        if case_seconds is not None:
+            case_seconds[unmatched] += tier_seconds
+        match_counts[unmatched] = tier_counts
+        match_tiers[set_ids != matches["set_id"].to_numpy()] = tier_number
+        matches["set_id"] = set_ids
+        if match_index_dates is not None:
+            matches[index_date_variable] = match_index_dates
+
+        tier_matched = tier_counts >= match_config.min_matches_per_case
+        case_tiers[unmatched[tier_matched]] = tier_number
+        unmatched = unmatched[~tier_matched]
+    return match_counts, case_tiers, match_tiers
+
+
+def get_tier_report(matched_cases: pd.DataFrame, match_config: MatchConfig) -> list:
+    if not match_config.tiers:
+        return []
+    tier_counts = (
+        matched_cases[MATCH_TIER_VARIABLE]
+        .value_counts()
+        .reindex(range(1, len(match_config.tiers) + 1), fill_value=0)
+    )
+    return ["\nNumber of matched cases per tier:", tier_counts.to_string()]
+
 
+def get_matching_report(match_config: MatchConfig) -> Callable[..., None]:
+    """
+    Returns a function that appends sections of text to the matching report, and
+    prints them. The output path is created if it doesn't exist.
+    """
+    match_config.output_path.mkdir(parents=True, exist_ok=True)
     report_path = (
         match_config.output_path / f"matching_report{match_config.output_suffix}.txt"
     )
@@ -258,159 +672,516 @@ def match(
             report_file.write(text_to_write)
         print(text_to_write)
 
-    matching_report(
-        [f"Matching started at: {datetime.now()}"],
-        erase=True,
-    )
+    return matching_report
 
-    # Import_data; note match_config.match_variables may be updated with date variables that
-    # are converted to month-only
-    cases, matches = import_data(
-        case_df,
-        match_df,
+
+def assign_matches(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_config: MatchConfig,
+    control_index: ControlIndex,
+    available: np.ndarray,
+    checkpoint: Checkpoint | None = None,
+    counters: LoopCounters | None = None,
+    case_seconds: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Matches the (sorted) cases, in tiers if match_config.tiers is set, and updates
+    the set_id (and index date, and match tier) of the matches. Returns the number
+    of matches picked for each case and, if matching in tiers, the tier that each
+    case was matched in.
+    """
+    if match_config.tiers:
+        match_counts, case_tiers, match_tiers = match_cases_in_tiers(
+            cases,
+            matches,
+            match_config,
+            control_index,
+            available,
+            checkpoint,
+            counters,
+            case_seconds,
+        )
+        matches[MATCH_TIER_VARIABLE] = match_tiers
+        return match_counts, case_tiers
+
+    match_counts, set_ids, match_index_dates = match_cases(
+        cases,
+        matches,
         match_config,
+        control_index,
+        available,
+        checkpoint,
+        counters=counters,
+        case_seconds=case_seconds,
     )
+    matches["set_id"] = set_ids
+    if match_index_dates is not None:
+        matches[match_config.index_date_variable] = match_index_dates
+    return match_counts, None
 
-    matching_report(
-        [
-            "Data import:",
-            f"Completed {datetime.now()}",
-            f"Cases    {len(cases)}",
-            f"Matches  {len(matches)}",
-        ],
-    )
 
-    ## Drop cases from match population if specified
-    if match_config.drop_cases_from_matches:
-        matches = matches.drop(cases.index, errors="ignore")
+def match(
+    case_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_config: MatchConfig,
+    control_index: ControlIndex | None = None,
+    excluded_matches: pd.Index | np.ndarray | None = None,
+    excluded_cases: pd.Index | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Wrapper function that calls functions to:
+    - import data
+    - find eligible matches
+    - pick the correct number of randomly allocated matches
+    - make exclusions that are based on index date
+      - (this is not currently possible in a study definition, and will only ever be possible
+        during matching for studies where the match index date comes from the case)
+    - set the set_id as that of the case_id (this excludes them from being matched later)
+    - set the index date of the match as that of the case (where desired)
+    - save the results in the specified output format
 
-    matching_report(
-        [
-            "Dropping cases from matches:",
-            f"Completed {datetime.now()}",
-            f"Cases    {len(cases)}",
-            f"Matches  {len(matches)}",
-        ]
-    )
+    Eligible matches are found with a ControlIndex of the matches; control_index
+    may be a prebuilt index (see osmatching.index), which is used if it was built
+    from the same matches and match variables. Matches with patient ids in
+    excluded_matches are never matched, and cases with patient ids in
+    excluded_cases are not matched (see match_incremental).
+    """
+    # validate the config if we haven't already
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
 
-    ## Add set_id variable
-    cases, matches = add_variables(cases, matches, match_config.indicator_variable_name)
+    matching_started = datetime.now()
+    metrics = MatchingMetrics(
+        profiler=StageProfiler() if match_config.profile else None,
+        counters=LoopCounters() if match_config.loop_counters else None,
+    )
 
-    indices = pre_calculate_indices(cases, matches, match_config.match_variables)
-    matching_report([f"Completed pre-calculating indices at {datetime.now()}"])
+    try:
+        # Import_data; note match_config.match_variables may be updated with date variables that
+        # are converted to month-only
+        cases, matches = import_data(
+            case_df,
+            match_df,
+            match_config,
+            metrics,
+        )
 
-    if match_config.match_index_date_offset:
-        date_offset = get_date_offset(match_config.match_index_date_offset)
+        # Guaranteed by validation; assert not None to satisfy mypy
+        assert match_config.match_variables is not None
+        assert match_config.matches_per_case is not None
 
-    if match_config.date_exclusion_variables:
-        case_exclusions = date_exclusions(
-            cases,
-            match_config.date_exclusion_variables,
-            cases[match_config.index_date_variable],
+        matching_report = get_matching_report(match_config)
+        matching_report(
+            [f"Matching started at: {matching_started}"],
+            erase=True,
         )
-        cases = cases.loc[~case_exclusions]
+
         matching_report(
             [
-                "Date exclusions for cases:",
+                "Data import:",
                 f"Completed {datetime.now()}",
                 f"Cases    {len(cases)}",
                 f"Matches  {len(matches)}",
+            ],
+        )
+
+        ## Drop cases from match population if specified; dropped matches are marked
+        ## as unavailable, so that the control index still applies to them
+        available = np.ones(len(matches), dtype=bool)
+        if match_config.drop_cases_from_matches:
+            available &= ~matches.index.isin(cases.index)
+        if excluded_matches is not None:
+            available &= ~matches.index.isin(excluded_matches)
+
+        matching_report(
+            [
+                "Dropping cases from matches:",
+                f"Completed {datetime.now()}",
+                f"Cases    {len(cases)}",
+                f"Matches  {available.sum()}",
             ]
         )
+        metrics.lap("drop_cases", cases=len(cases), matches=available.sum())
 
-    ## Sort cases by index date
-    cases = cases.sort_values(match_config.index_date_variable)
+        ## Drop cases that were matched in a previous run, if specified
+        if excluded_cases is not None:
+            cases = cases.drop(index=excluded_cases, errors="ignore")
+            matching_report(
+                [
+                    "Dropping cases of a previous run:",
+                    f"Completed {datetime.now()}",
+                    f"Cases    {len(cases)}",
+                    f"Matches  {available.sum()}",
+                ]
+            )
+            metrics.lap("drop_previous_cases", cases=len(cases))
 
-    for case_id, case_row in cases.iterrows():
-        ## Get eligible matches
-        eligible_matches = get_eligible_matches(
-            case_row, matches, match_config.match_variables, indices
+        ## Add set_id variable
+        cases, matches = add_variables(
+            cases, matches, match_config.indicator_variable_name
         )
-        matched_rows = matches.loc[eligible_matches]
-
-        ## Determine match index date
-        if not match_config.match_index_date_offset:
-            index_date = matched_rows[match_config.index_date_variable]
-        else:
-            unit, offset_type, _ = match_config.match_index_date_offset
-
-            if unit == "no_offset":
-                index_date = case_row[match_config.index_date_variable]
-            elif offset_type == "earlier":
-                index_date = case_row[match_config.index_date_variable] - date_offset
-            elif offset_type == "later":
-                index_date = case_row[match_config.index_date_variable] + date_offset
-            else:
-                assert False, f"Date offset type '{offset_type}' not recognised"
-
-        ## Index date based match exclusions (faster to do this after get_eligible_matches)
+
+        if control_index is None or not control_index.is_valid_for(
+            matches, match_config
+        ):
+            control_index = build_control_index(matches, match_config)
+        matching_report([f"Completed building the control index at {datetime.now()}"])
+        metrics.lap("build_control_index", matches=len(matches))
+
         if match_config.date_exclusion_variables:
-            exclusions = date_exclusions(
-                matched_rows, match_config.date_exclusion_variables, index_date
+            cases = exclude_cases(cases, match_config)
+            matching_report(
+                [
+                    "Date exclusions for cases:",
+                    f"Completed {datetime.now()}",
+                    f"Cases    {len(cases)}",
+                    f"Matches  {available.sum()}",
+                ]
             )
-            matched_rows = matched_rows.loc[~exclusions]
+            metrics.lap("case_exclusions", cases=len(cases))
 
-        ## Pick random matches
-        matched_rows = greedily_pick_matches(
-            match_config.matches_per_case,
-            matched_rows,
-            case_row,
-            match_config.closest_match_variables,
-        )
+        ## Sort cases by index date
+        cases = sort_cases(cases, match_config)
+        metrics.lap("sort_cases", cases=len(cases))
 
-        ## Report number of matches for each case
-        num_matches = len(matched_rows)
-        cases.loc[case_id, "match_counts"] = num_matches
-        ## Label matches with case ID if there are enough
-        if num_matches >= match_config.min_matches_per_case:
-            matches.loc[matched_rows, "set_id"] = case_id
+        ## Thin the control pool of each stratum, if specified
+        if match_config.control_pool_multiple:
+            thinning = thin_control_pool(cases, match_config, control_index, available)
+            metrics.lap("thinning", matches=available.sum())
+            matching_report(
+                [
+                    "Thinning control pools:",
+                    f"Completed {datetime.now()}",
+                    f"Cases    {len(cases)}",
+                    f"Matches  {available.sum()}\n",
+                    "Controls kept in each stratum:",
+                    thinning.to_string(index=False),
+                ]
+            )
 
-        ## Set index_date of the match where needed
-        if match_config.generate_match_index_date:
-            matches.loc[matched_rows, match_config.index_date_variable] = index_date
+        ## Resume from the last checkpoint of an interrupted run, if specified
+        checkpoint = None
+        if match_config.checkpoint_interval:
+            checkpoint = Checkpoint(
+                get_checkpoint_path(match_config),
+                get_checkpoint_key(cases, matches, match_config, available),
+                match_config.checkpoint_interval,
+            )
+            if match_config.resume:
+                resumed = ["No checkpoint of this run found; matching from the start"]
+                if checkpoint.resume():
+                    resumed = [f"Cases    {checkpoint.state['position']}"]
+                    if match_config.tiers:
+                        resumed.insert(0, f"Tier     {checkpoint.state['stage']}")
+                matching_report(
+                    [
+                        "Resuming from checkpoint:",
+                        f"Completed {datetime.now()}",
+                        *resumed,
+                    ]
+                )
 
-    ## Drop unmatched cases/matches
-    matched_cases = cases.loc[
-        cases["match_counts"] >= match_config.min_matches_per_case
-    ]
-    matched_matches = matches.loc[matches["set_id"] != NOT_PREVIOUSLY_MATCHED]
+        case_strata = get_case_strata(cases, control_index)
+        eligible_controls = available.copy()
+        case_seconds = np.zeros(len(cases))
+        match_counts, case_tiers = assign_matches(
+            cases,
+            matches,
+            match_config,
+            control_index,
+            available,
+            checkpoint,
+            metrics.counters,
+            case_seconds,
+        )
+        if case_tiers is not None:
+            cases[MATCH_TIER_VARIABLE] = case_tiers
+        cases["match_counts"] = match_counts
+        metrics.lap(
+            "matching",
+            cases=len(cases),
+            matched_cases=(match_counts >= match_config.min_matches_per_case).sum(),
+            matches=(matches["set_id"] != NOT_PREVIOUSLY_MATCHED).sum(),
+        )
 
-    ## Describe population differences
-    scalar_comparisons = compare_populations(
-        matched_cases, matched_matches, match_config.closest_match_variables
-    )
+        stratum_table = get_stratum_table(
+            control_index,
+            case_strata,
+            case_seconds,
+            matched_cases=match_counts >= match_config.min_matches_per_case,
+            eligible_controls=eligible_controls,
+            matched_controls=matches["set_id"].to_numpy() != NOT_PREVIOUSLY_MATCHED,
+        )
 
-    matching_report(
+        results = write_matching_results(
+            cases, matches, match_config, matching_report, metrics, stratum_table
+        )
+        if checkpoint is not None:
+            checkpoint.remove()
+        return results
+    finally:
+        # stop profiling if matching fails, as it would slow down the rest of
+        # the process (e.g. the other grid points of a sweep)
+        if metrics.profiler is not None:
+            metrics.profiler.stop()
+
+
+def get_results_report(
+    matched_cases: pd.DataFrame,
+    matched_matches: pd.DataFrame,
+    match_counts: pd.Series,
+    scalar_comparisons: list,
+    balance_report: list,
+    match_config: MatchConfig,
+) -> list:
+    """
+    The "After matching" section of the matching report; match_counts is the number
+    of cases with each number of available matches.
+    """
+    return (
         [
             "After matching:",
             f"Completed {datetime.now()}",
             f"Cases    {len(matched_cases)}",
             f"Matches  {len(matched_matches)}\n",
             "Number of available matches per case:",
-            cases["match_counts"].value_counts().to_string(),
+            match_counts.to_string(),
         ]
+        + get_tier_report(matched_cases, match_config)
         + scalar_comparisons
+        + balance_report
     )
 
-    ## Write output files
-    file_suffix_ext = f"{match_config.output_suffix}.{match_config.output_format}"
+
+def get_shard_results_path(output_path: Path, output_suffix: str) -> Path:
+    return output_path / f"matching_results{output_suffix}.json"
+
+
+def write_stratum_table(stratum_table: pd.DataFrame, match_config: MatchConfig):
+    """
+    Writes the table of the strata (see osmatching.strata), in order of their
+    category values, with suppression
+    """
     write_output_file(
-        matched_cases, match_config.output_path / f"matched_cases{file_suffix_ext}"
+        to_stratum_table(suppress_small_numbers(sort_strata(stratum_table))),
+        get_strata_path(
+            match_config.output_path,
+            match_config.output_suffix,
+            match_config.output_format,
+        ),
+        match_config.output_compression,
+        index=False,
     )
-    write_output_file(
-        matched_matches, match_config.output_path / f"matched_matches{file_suffix_ext}"
+
+
+def write_shard_results(
+    match_counts: pd.Series, stratum_table: pd.DataFrame, match_config: MatchConfig
+):
+    """
+    Writes the number of cases with each number of available matches, and the
+    (unsuppressed) stratum table, of matching a shard (see osmatching.shard), which
+    are combined with those of the other shards when they are merged.
+    """
+    results = {
+        "match_counts": {
+            str(value): int(count) for value, count in match_counts.items()
+        },
+        "strata": stratum_table.to_dict(orient="list"),
+    }
+    get_shard_results_path(
+        match_config.output_path, match_config.output_suffix
+    ).write_text(json.dumps(results, indent=2))
+
+
+def write_matching_results(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_config: MatchConfig,
+    matching_report: Callable[[list], None],
+    metrics: MatchingMetrics,
+    stratum_table: pd.DataFrame,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Reports the results of matching, and writes the matched cases and matches
+    (those with at least min_matches_per_case matches, and those with a set_id) to
+    the output files. The reporting and writing of the outputs are recorded in the
+    metrics, which (with the profiles, if matching is profiled) are written next to
+    the report. The stratum table (see osmatching.strata) is written with
+    small-number suppression, and if the cases are those of a shard (see
+    osmatching.shard), the results to merge with those of the other shards are
+    also written.
+    """
+    matched_case_rows = cases["match_counts"] >= match_config.min_matches_per_case
+    matched_match_rows = matches["set_id"] != NOT_PREVIOUSLY_MATCHED
+
+    ## Describe population differences
+    closest_match_variables = match_config.closest_match_variables
+    scalar_comparisons = compare_populations(
+        cases.loc[matched_case_rows, closest_match_variables],
+        matches.loc[matched_match_rows, closest_match_variables],
+        closest_match_variables,
     )
-    combined = pd.concat(
-        [df for df in [matched_cases, matched_matches] if not df.empty]
+    balance_variables = get_balance_variables(match_config)
+    balance_report = get_balance_report(
+        get_balance_table(
+            cases.loc[matched_case_rows, balance_variables],
+            matches.loc[matched_match_rows, balance_variables],
+            balance_variables,
+        )
     )
-    write_output_file(
-        combined, match_config.output_path / f"matched_combined{file_suffix_ext}"
+
+    ## Drop unmatched cases/matches, keeping only the selected output columns
+    matched_cases = cases.loc[
+        matched_case_rows, select_output_columns(list(cases.columns), match_config)
+    ]
+    matched_matches = matches.loc[
+        matched_match_rows, select_output_columns(list(matches.columns), match_config)
+    ]
+
+    matching_report(
+        get_results_report(
+            matched_cases,
+            matched_matches,
+            cases["match_counts"].value_counts(),
+            scalar_comparisons,
+            balance_report,
+            match_config,
+        )
     )
 
+    if metrics.counters is not None:
+        matching_report(metrics.counters.get_report())
+
+    ## Write output files
+    metrics.lap(
+        "results_report",
+        cases=len(matched_cases),
+        matches=len(matched_matches),
+    )
+    write_output_files(matched_cases, matched_matches, match_config, metrics)
+    write_stratum_table(stratum_table, match_config)
+    if ROW_NUMBER_VARIABLE in cases.columns:
+        write_shard_results(
+            cases["match_counts"].value_counts(), stratum_table, match_config
+        )
+    metrics.lap("write_outputs")
+    metrics.write(
+        get_metrics_path(match_config.output_path, match_config.output_suffix)
+    )
+    if metrics.profiler is not None:
+        metrics.profiler.write(
+            get_profile_path(match_config.output_path, match_config.output_suffix)
+        )
+
     # return the matched dataframes, for ease of testing
     return matched_cases, matched_matches
 
 
+def match_populations(
+    populations: dict[str, "pd.DataFrame | Future[pd.DataFrame]"],
+    match_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_config: MatchConfig,
+    control_index: ControlIndex | None = None,
+) -> dict[str, tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Matches several populations of cases (e.g. exposure groups), given as a dict of
+    population names to case datasets, against the same matches. The matches are
+    imported and indexed once, and each population is then matched with its own
+    config and output suffix (see validation.get_population_config).
+
+    Populations are matched in order. Unless
+    match_config.reuse_controls_across_populations, matches of earlier populations
+    are not available to later ones.
+    """
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
+
+    matches = resolve_dataframe(match_df)
+    errors = validate_match_columns(matches.columns, match_config)
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+    matches = import_dataframe(matches, match_config)
+    if control_index is None or not control_index.is_valid_for(matches, match_config):
+        control_index = build_control_index(matches, match_config)
+
+    matched_populations = {}
+    used_matches = np.array([], dtype=matches.index.dtype)
+    for name, case_df in populations.items():
+        excluded_matches = None
+        if not match_config.reuse_controls_across_populations:
+            excluded_matches = used_matches
+        # each population gets a shallow copy of the matches, so that the columns
+        # added by matching one population are not seen by the others
+        matched_cases, matched_matches = match(
+            case_df,
+            matches.copy(deep=False),
+            get_population_config(match_config, name),
+            control_index=control_index,
+            excluded_matches=excluded_matches,
+        )
+        used_matches = np.concatenate([used_matches, matched_matches.index])
+        matched_populations[name] = (matched_cases, matched_matches)
+    return matched_populations
+
+
+def match_incremental(
+    case_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_config: MatchConfig,
+    previous_matches: "pd.DataFrame | Future[pd.DataFrame]",
+    previous_cases: "pd.DataFrame | Future[pd.DataFrame] | None" = None,
+    control_index: ControlIndex | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Matches the cases that weren't matched in a previous run, keeping the matches
+    of that run fixed. previous_matches is the matched_matches output of the
+    previous run: its matches are not available, and the cases they were matched
+    to (their set_ids) are not matched again. If previous_cases is given (e.g. the
+    cases dataset of the previous run), none of its cases are matched again,
+    including those that weren't matched. If drop_cases_from_matches, the previous
+    cases are not available as matches either.
+
+    Only the new cases and their matches are written to the outputs.
+    """
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
+
+    previous_matches = resolve_dataframe(previous_matches)
+    previous_columns = [previous_matches.index.name, *previous_matches.columns]
+    errors = validate_previous_run_columns(previous_columns)
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+
+    previous_case_ids = pd.Index(previous_matches["set_id"].unique())
+    if previous_cases is not None:
+        previous_case_ids = previous_case_ids.union(
+            resolve_dataframe(previous_cases).index
+        )
+    excluded_matches = previous_matches.index
+    if match_config.drop_cases_from_matches:
+        excluded_matches = excluded_matches.union(previous_case_ids)
+    return match(
+        case_df,
+        match_df,
+        match_config,
+        control_index=control_index,
+        excluded_matches=excluded_matches,
+        excluded_cases=previous_case_ids,
+    )
+
+
 def compare_populations(
     matched_cases: pd.DataFrame,
     matched_matches: pd.DataFrame,
@@ -0,0 +1,501 @@
+"""
+Out-of-core matching, for control datasets that are too large to load into memory.
+
+Controls only ever match cases in their own stratum (with the same values of the
+category match variables; see osmatching.index), so the controls can be matched
+one group of strata at a time. The controls file is read in record batches, and
+each control is written to one of PARTITION_BUCKETS temporary arrow files, by its
+stratum; controls with missing category values, which never match, are dropped.
+The buckets are then combined into partitions of at most partition_memory_mb, and
+the controls of each partition are loaded, indexed and matched to the cases in
+their strata in turn.
+
+Cases are matched in the same order as in memory (by index date), and the
+controls of each partition are kept in their original order, so the results are
+identical to in-memory matching.
+"""
+
+import copy
+import tempfile
+from concurrent.futures import Future
+from contextlib import ExitStack
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from osmatching.index import (
+    NO_STRATUM,
+    build_control_index,
+    get_category_variables,
+    get_strata,
+)
+from osmatching.metrics import LoopCounters, MatchingMetrics
+from osmatching.osmatching import (
+    NOT_PREVIOUSLY_MATCHED,
+    add_variables,
+    assign_matches,
+    exclude_cases,
+    get_matching_report,
+    import_dataframe,
+    resolve_dataframe,
+    sort_cases,
+    write_matching_results,
+)
+from osmatching.profiling import StageProfiler
+from osmatching.strata import COUNT_COLUMNS, get_case_strata, get_stratum_table
+from osmatching.utils import (
+    MATCH_TIER_VARIABLE,
+    ROW_NUMBER_VARIABLE,
+    MatchConfig,
+    import_match_variables,
+    iter_record_batches,
+    parse_and_validate_config,
+    read_schema,
+    report_validation_errors,
+)
+from osmatching.validation import (
+    ValidationType,
+    merge_errors,
+    validate_case_columns,
+    validate_match_columns,
+)
+
+
+PARTITION_BUCKETS = 64
+BYTES_PER_MB = 1024 * 1024
+
+
+@dataclass
+class PartitionedControls:
+    directory: Path
+    # schema of the bucket files
+    schema: pa.Schema
+    num_controls: int
+    # number of controls that are not excluded from matching
+    num_available: int
+    # bucket of each stratum, keyed by the values of the category match variables
+    stratum_buckets: dict[tuple, int]
+    # number and size in bytes of the controls in each bucket
+    bucket_rows: list[int]
+    bucket_sizes: list[int]
+    # categories of the category match variables, across all controls
+    categories: dict[str, pd.Index]
+    # pandas types of the other columns, across all controls
+    dtypes: dict[str, np.dtype]
+
+    def get_bucket_path(self, bucket: int) -> Path:
+        return self.directory / f"bucket_{bucket}.arrow"
+
+    def get_partitions(self, max_size: int) -> list[list[int]]:
+        """
+        Groups the (non-empty) buckets into partitions of at most max_size bytes.
+        Buckets larger than max_size can't be split, and are partitions of their own.
+        """
+        partitions: list[list[int]] = []
+        partition_size = 0
+        for bucket, bucket_size in enumerate(self.bucket_sizes):
+            if not bucket_size:
+                continue
+            if not partitions or partition_size + bucket_size > max_size:
+                partitions.append([])
+                partition_size = 0
+            partitions[-1].append(bucket)
+            partition_size += bucket_size
+        return partitions
+
+    def load_partition(self, buckets: list[int]) -> pd.DataFrame:
+        """Loads the controls in the given buckets, in their original order"""
+        tables = []
+        for bucket in buckets:
+            with pa.memory_map(str(self.get_bucket_path(bucket))) as source:
+                tables.append(pa.ipc.open_file(source).read_all())
+        table = pa.concat_tables(tables) if tables else self.schema.empty_table()
+        controls = table.to_pandas()
+        controls.set_index("patient_id", inplace=True)
+        return controls.sort_values(ROW_NUMBER_VARIABLE)
+
+    def get_case_buckets(
+        self, cases: pd.DataFrame, category_variables: list[str]
+    ) -> np.ndarray:
+        """
+        The bucket of the stratum of each case; NO_STRATUM if no controls are in
+        its stratum, or if any of its category values are missing.
+        """
+        stratum_ids, stratum_keys = get_strata(cases, category_variables)
+        # stratum_ids of NO_STRATUM (-1) index the last element
+        key_buckets = np.array(
+            [self.stratum_buckets.get(key, NO_STRATUM) for key in stratum_keys]
+            + [NO_STRATUM],
+            dtype=np.int64,
+        )
+        return key_buckets[stratum_ids]
+
+    def restore_types(self, matches: pd.DataFrame) -> pd.DataFrame:
+        """
+        Sets the types of the columns of matches combined from several partitions
+        to those of the whole controls dataset; e.g. integer columns with missing
+        values in any partition are floats.
+        """
+        for var, categories in self.categories.items():
+            matches[var] = pd.Categorical(matches[var], categories=categories)
+        for column, dtype in self.dtypes.items():
+            if matches[column].dtype != dtype:
+                matches[column] = matches[column].astype(dtype)
+        return matches
+
+
+def get_categories(values: list, is_dictionary: bool) -> pd.Index:
+    """
+    The categories of a category match variable with the given values, as set when
+    importing the whole dataset; dictionary-encoded columns keep their dictionary,
+    and others are converted with astype("category") (see import_dataframe).
+    """
+    if is_dictionary:
+        return pd.Index(values)
+    return pd.Series(values).astype("category").cat.categories
+
+
+def get_pandas_dtypes(schema: pa.Schema, has_nulls: dict[str, bool]) -> pd.Series:
+    """
+    The pandas types of the columns of a dataset with the given schema, as converted
+    by to_pandas(); integer columns with missing values are converted to floats, and
+    boolean columns with missing values to objects (unless the schema has pandas
+    metadata with nullable types, e.g. Int64).
+    """
+    dtypes = schema.empty_table().to_pandas().dtypes
+    for name, dtype in dtypes.items():
+        if not has_nulls.get(name) or not isinstance(dtype, np.dtype):
+            continue
+        if dtype.kind in "iu":
+            dtypes[name] = np.dtype("float64")
+        elif dtype.kind == "b":
+            dtypes[name] = np.dtype("object")
+    return dtypes
+
+
+def partition_controls(
+    controls_path: Path,
+    columns: list[str] | None,
+    config: MatchConfig,
+    directory: Path,
+    excluded_ids: pd.Index,
+    num_buckets: int = PARTITION_BUCKETS,
+    drop_excluded: bool = False,
+) -> PartitionedControls:
+    """
+    Reads the controls file in record batches, and writes each control to the
+    bucket file of its stratum. Each new stratum is assigned to the bucket with
+    the fewest controls so far. config is the config before the match variables
+    are imported (see import_data). If drop_excluded, controls in excluded_ids
+    are not written to any bucket.
+    """
+    assert config.match_variables is not None  # guaranteed by validation
+    category_variables = get_category_variables(
+        import_match_variables(config.match_variables)
+    )
+    # columns that are converted by import_dataframe
+    imported_columns = {
+        var
+        for var, match_type in config.match_variables.items()
+        if match_type in ["category", "month_only"]
+    }
+    imported_columns |= set(config.date_exclusion_variables)
+    imported_columns.add(config.index_date_variable)
+
+    schema = None
+    num_controls = 0
+    num_available = 0
+    stratum_buckets: dict[tuple, int] = {}
+    # controls in the strata assigned to each bucket, including any dropped
+    assigned_rows = np.zeros(num_buckets, dtype=np.int64)
+    bucket_rows = [0] * num_buckets
+    bucket_sizes = [0] * num_buckets
+    categories: dict[str, dict] = {var: {} for var in category_variables}
+    has_nulls: dict[str, bool] = {}
+    with ExitStack() as stack:
+        writers: dict[int, pa.ipc.RecordBatchFileWriter] = {}
+        for batch in iter_record_batches(controls_path, columns):
+            # the schema metadata is kept, as it sets the pandas types of columns
+            # (e.g. nullable integers) in arrow files written by pandas
+            batch = pa.RecordBatch.from_arrays(
+                [
+                    *batch.columns,
+                    pa.array(np.arange(num_controls, num_controls + batch.num_rows)),
+                ],
+                schema=batch.schema.append(pa.field(ROW_NUMBER_VARIABLE, pa.int64())),
+            )
+            schema = batch.schema
+            num_controls += batch.num_rows
+            patient_ids = pd.Index(batch.column("patient_id").to_numpy())
+            excluded = patient_ids.isin(excluded_ids)
+            num_available += int((~excluded).sum())
+            for name, column in zip(batch.schema.names, batch.columns):
+                has_nulls[name] = has_nulls.get(name, False) or column.null_count > 0
+
+            # the strata are found from the imported category match variables
+            keys = import_dataframe(
+                batch.select(
+                    [name for name in batch.schema.names if name in imported_columns]
+                ).to_pandas(),
+                config,
+            )
+            for var in category_variables:
+                categories[var].update(dict.fromkeys(keys[var].cat.categories))
+            stratum_ids, stratum_keys = get_strata(keys, category_variables)
+            has_stratum = stratum_ids != NO_STRATUM
+            stratum_rows = np.bincount(
+                stratum_ids[has_stratum], minlength=len(stratum_keys)
+            )
+            key_buckets = np.zeros(len(stratum_keys), dtype=np.int64)
+            for stratum_id, key in enumerate(stratum_keys):
+                if key not in stratum_buckets:
+                    stratum_buckets[key] = int(np.argmin(assigned_rows))
+                key_buckets[stratum_id] = stratum_buckets[key]
+                assigned_rows[key_buckets[stratum_id]] += stratum_rows[stratum_id]
+
+            # write the rows of each bucket, in their original order
+            row_buckets = np.where(has_stratum, key_buckets[stratum_ids], NO_STRATUM)
+            if drop_excluded:
+                row_buckets[excluded] = NO_STRATUM
+            order = np.argsort(row_buckets, kind="stable")
+            sorted_buckets = row_buckets[order]
+            for bucket in np.unique(sorted_buckets[sorted_buckets != NO_STRATUM]):
+                start, end = np.searchsorted(sorted_buckets, [bucket, bucket + 1])
+                rows = batch.take(pa.array(order[start:end]))
+                if bucket not in writers:
+                    writers[bucket] = stack.enter_context(
+                        pa.ipc.new_file(
+                            directory / f"bucket_{bucket}.arrow", batch.schema
+                        )
+                    )
+                writers[bucket].write_batch(rows)
+                bucket_rows[bucket] += rows.num_rows
+                bucket_sizes[bucket] += rows.nbytes
+
+    if schema is None:
+        # no controls
+        schema = read_schema(controls_path)
+        if columns is not None:
+            schema = pa.schema([schema.field(column) for column in columns])
+        schema = schema.append(pa.field(ROW_NUMBER_VARIABLE, pa.int64()))
+
+    dictionary_variables = {
+        name
+        for name, data_type in zip(schema.names, schema.types)
+        if pa.types.is_dictionary(data_type)
+    }
+    return PartitionedControls(
+        directory=directory,
+        schema=schema,
+        num_controls=num_controls,
+        num_available=num_available,
+        stratum_buckets=stratum_buckets,
+        bucket_rows=bucket_rows,
+        bucket_sizes=bucket_sizes,
+        categories={
+            var: get_categories(list(values), var in dictionary_variables)
+            for var, values in categories.items()
+        },
+        dtypes={
+            name: dtype
+            for name, dtype in get_pandas_dtypes(schema, has_nulls).items()
+            if name not in imported_columns | {"patient_id", ROW_NUMBER_VARIABLE}
+            and dtype != "category"
+        },
+    )
+
+
+def match_partitioned(
+    case_df: "pd.DataFrame | Future[pd.DataFrame]",
+    controls_path: Path,
+    match_config: MatchConfig,
+    columns: list[str] | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Matches the cases to the controls in controls_path, without loading all the
+    controls into memory at once; only the controls of one partition, of at most
+    match_config.partition_memory_mb, are loaded at a time. If columns are given,
+    only those columns of the controls file are read. The results are the same as
+    those of match().
+    """
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
+    assert match_config.partition_memory_mb is not None
+
+    matching_started = datetime.now()
+    metrics = MatchingMetrics(
+        profiler=StageProfiler() if match_config.profile else None,
+        counters=LoopCounters() if match_config.loop_counters else None,
+    )
+
+    try:
+        cases = resolve_dataframe(case_df)
+        metrics.lap("load", cases=len(cases))
+        controls_columns = columns or read_schema(controls_path).names
+        errors = merge_errors(
+            validate_case_columns(cases.columns, match_config),
+            validate_match_columns(controls_columns, match_config),
+        )
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.DATA)
+            raise ValueError("Errors encountered in the input datasets")
+        cases = import_dataframe(cases, match_config)
+        metrics.lap("import_data", cases=len(cases))
+
+        matching_report = get_matching_report(match_config)
+        matching_report([f"Matching started at: {matching_started}"], erase=True)
+
+        excluded_ids = pd.Index([])
+        if match_config.drop_cases_from_matches:
+            excluded_ids = cases.index
+
+        with tempfile.TemporaryDirectory(
+            dir=match_config.output_path, prefix=".partitions"
+        ) as directory:
+            # the controls are imported with the original match variables
+            import_config = copy.deepcopy(match_config)
+            partitioned = partition_controls(
+                controls_path, columns, import_config, Path(directory), excluded_ids
+            )
+            assert match_config.match_variables is not None
+            match_config.match_variables = import_match_variables(
+                match_config.match_variables
+            )
+            partitions = partitioned.get_partitions(
+                match_config.partition_memory_mb * BYTES_PER_MB
+            )
+            metrics.lap(
+                "partition_controls",
+                matches=partitioned.num_controls,
+                partitions=len(partitions),
+            )
+            matching_report(
+                [
+                    "Data import:",
+                    f"Completed {datetime.now()}",
+                    f"Cases    {len(cases)}",
+                    f"Matches  {partitioned.num_controls}",
+                    f"Partitions  {len(partitions)}",
+                ],
+            )
+            matching_report(
+                [
+                    "Dropping cases from matches:",
+                    f"Completed {datetime.now()}",
+                    f"Cases    {len(cases)}",
+                    f"Matches  {partitioned.num_available}",
+                ]
+            )
+
+            cases, _ = add_variables(
+                cases, pd.DataFrame(), match_config.indicator_variable_name
+            )
+            if match_config.date_exclusion_variables:
+                cases = exclude_cases(cases, match_config)
+                matching_report(
+                    [
+                        "Date exclusions for cases:",
+                        f"Completed {datetime.now()}",
+                        f"Cases    {len(cases)}",
+                        f"Matches  {partitioned.num_available}",
+                    ]
+                )
+                metrics.lap("case_exclusions", cases=len(cases))
+            cases = sort_cases(cases, match_config)
+            metrics.lap("sort_cases", cases=len(cases))
+
+            case_buckets = partitioned.get_case_buckets(
+                cases, get_category_variables(match_config.match_variables)
+            )
+            match_counts = np.zeros(len(cases))
+            case_tiers = np.zeros(len(cases), dtype=np.int64)
+            matched_matches = []
+            stratum_tables = []
+            # with no partitions, the (empty) controls are still imported, so that the
+            # matched matches have the expected columns
+            for partition_number, partition in enumerate(partitions or [[]], start=1):
+                matches = import_dataframe(
+                    partitioned.load_partition(partition), import_config
+                )
+                _, matches = add_variables(
+                    pd.DataFrame(), matches, match_config.indicator_variable_name
+                )
+                available = ~matches.index.isin(excluded_ids)
+                metrics.lap("load_partitions", matches=len(matches))
+                control_index = build_control_index(matches, match_config)
+                metrics.lap("build_control_index")
+                in_partition = np.isin(case_buckets, partition)
+                eligible_controls = available.copy()
+                case_seconds = np.zeros(in_partition.sum())
+                partition_counts, partition_tiers = assign_matches(
+                    cases[in_partition],
+                    matches,
+                    match_config,
+                    control_index,
+                    available,
+                    counters=metrics.counters,
+                    case_seconds=case_seconds,
+                )
+                metrics.lap("matching")
+                match_counts[in_partition] = partition_counts
+                if partition_tiers is not None:
+                    case_tiers[in_partition] = partition_tiers
+                matched_controls = (
+                    matches["set_id"].to_numpy() != NOT_PREVIOUSLY_MATCHED
+                )
+                matched_matches.append(matches[matched_controls])
+                stratum_tables.append(
+                    get_stratum_table(
+                        control_index,
+                        get_case_strata(cases[in_partition], control_index),
+                        case_seconds,
+                        partition_counts >= match_config.min_matches_per_case,
+                        eligible_controls,
+                        matched_controls,
+                    )
+                )
+                matching_report(
+                    [
+                        f"Partition {partition_number}:",
+                        f"Completed {datetime.now()}",
+                        f"Cases    {in_partition.sum()}",
+                        f"Matches  {len(matches)}",
+                    ]
+                )
+
+        # partitions with no matched matches are left out, unless all are empty
+        matched_matches = [df for df in matched_matches if len(df)] or matched_matches
+        matches = pd.concat(matched_matches).sort_values(ROW_NUMBER_VARIABLE)
+        matches = partitioned.restore_types(matches.drop(columns=ROW_NUMBER_VARIABLE))
+        if match_config.tiers:
+            cases[MATCH_TIER_VARIABLE] = case_tiers
+        cases["match_counts"] = match_counts
+        # cases in no partition have no controls in their stratum
+        no_stratum = case_buckets == NO_STRATUM
+        if no_stratum.any():
+            stratum_tables.append(
+                pd.DataFrame(
+                    {
+                        **{var: [None] for var in control_index.category_variables},
+                        **{column: [0] for column in COUNT_COLUMNS},
+                        "seconds": [0.0],
+                    }
+                ).assign(cases=no_stratum.sum())
+            )
+        stratum_table = pd.concat(stratum_tables, ignore_index=True)
+        metrics.lap("combine_partitions", matches=len(matches))
+
+        return write_matching_results(
+            cases, matches, match_config, matching_report, metrics, stratum_table
+        )
+    finally:
+        # stop profiling if matching fails (see match())
+        if metrics.profiler is not None:
+            metrics.profiler.stop()
@@ -0,0 +1,124 @@
+"""
+Profiles of the stages of matching, with the `--profile` option.
+
+The stages are those of the matching metrics (see osmatching.metrics): the code
+run in each stage is profiled with cProfile, and the memory it allocates is traced
+with tracemalloc. When matching is complete, each stage's profile is written to
+profiles<output_suffix>/<stage>.prof, which can be read with pstats (or tools such
+as snakeviz), with a summary of the functions that took the most time, and the
+lines that allocated the most memory, in <stage>.txt.
+
+The profiles only contain the names of functions and source files, and aggregate
+times and sizes, so they're safe to release as moderately sensitive outputs.
+Profiling and tracing slow matching down (tracing allocations, considerably), so
+this is only for diagnosing matching that's slower than expected.
+
+Only the thread matching is run in is profiled, so the output files, which are
+written in other threads, are profiled as the time spent waiting for them, in the
+write_outputs stage.
+"""
+
+import cProfile
+import io
+import pstats
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+# Number of functions and allocating lines in each stage's summary
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 20
+# Frames kept for each traced allocation
+TRACEMALLOC_FRAMES = 1
+
+
+def get_profile_path(output_path: Path, output_suffix: str) -> Path:
+    return output_path / f"profiles{output_suffix}"
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024:,.1f} KiB"
+
+
+@dataclass
+class StageProfiler:
+    stats: dict[str, pstats.Stats] = field(default_factory=dict)
+    # the summary of the allocations of each run of each stage
+    allocations: dict[str, list[str]] = field(default_factory=dict)
+    profile: cProfile.Profile = field(default_factory=cProfile.Profile)
+    snapshot: tracemalloc.Snapshot | None = None
+    # whether tracemalloc was started by this profiler, and so is stopped by it
+    tracing: bool = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.tracing = True
+        tracemalloc.reset_peak()
+        self.snapshot = tracemalloc.take_snapshot()
+        self.profile.enable()
+
+    def lap(self, name: str):
+        """
+        Records the profile and allocations since the last stage (or the start) as
+        the named stage, and starts profiling the next.
+        """
+        self.profile.disable()
+        if name in self.stats:
+            self.stats[name].add(self.profile)
+        else:
+            self.stats[name] = pstats.Stats(self.profile)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        assert self.snapshot is not None
+        differences = snapshot.compare_to(self.snapshot, "lineno")
+        runs = self.allocations.setdefault(name, [])
+        runs.append(
+            "\n".join(
+                [
+                    f"Run {len(runs) + 1}: peak traced memory {format_size(peak)}",
+                    *(
+                        f"{difference.traceback}: "
+                        f"{format_size(difference.size_diff)} "
+                        f"({difference.count_diff:+} blocks)"
+                        for difference in differences[:TOP_ALLOCATIONS]
+                    ),
+                ]
+            )
+        )
+        tracemalloc.reset_peak()
+        self.snapshot = snapshot
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        self.snapshot = None
+
+    def write(self, profile_path: Path):
+        """
+        Stops profiling, and writes the profile and summary of each stage to
+        profile_path.
+        """
+        self.stop()
+        profile_path.mkdir(parents=True, exist_ok=True)
+        for name, stats in self.stats.items():
+            stats.dump_stats(profile_path / f"{name}.prof")
+            functions = io.StringIO()
+            summary = pstats.Stats(stream=functions)
+            summary.add(stats)
+            summary.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+            (profile_path / f"{name}.txt").write_text(
+                "\n\n".join(
+                    [
+                        f"Top functions by cumulative time:\n{functions.getvalue().strip()}",
+                        "Top allocations by line:",
+                        *self.allocations[name],
+                    ]
+                )
+                + "\n"
+            )
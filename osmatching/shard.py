@@ -0,0 +1,407 @@
+"""
+Splitting one matching job across several actions (or machines).
+
+As in osmatching.partition, controls only ever match cases in their own stratum,
+so groups of strata can be matched independently. `osmatching shard` reads the
+controls file in record batches and splits the cases and controls into shards by
+stratum, writing each shard to cases_shard_<n>.arrow and controls_shard_<n>.arrow.
+Each shard is then matched as usual, with the output suffix _shard_<n>, and
+`osmatching merge` combines the outputs of all the shards into the outputs of
+matching all the cases at once.
+
+The shard files have a row number column, which gives the order of their rows in
+the merged outputs. For cases, this is the order in which all the cases would be
+matched at once (by index date), and each shard's cases are matched in this order
+(see osmatching.sort_cases). The types of the columns of the whole datasets, which
+may differ from those of a single shard (e.g. integer columns with missing values
+in any shard are floats), and the parts of the matching report that come before
+matching are saved in a manifest file, which is read by merge. The number of
+matches of each case and the stratum table of each shard are written by matching
+it to a results file, and are combined by merge with those of the other shards,
+as are their metrics.
+"""
+
+import copy
+import json
+import tempfile
+from collections import Counter, defaultdict
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from osmatching.balance import (
+    get_balance_report,
+    get_balance_table,
+    get_balance_variables,
+)
+from osmatching.index import NO_STRATUM, get_category_variables
+from osmatching.metrics import MatchingMetrics, get_metrics_path
+from osmatching.osmatching import (
+    compare_populations,
+    exclude_cases,
+    get_matching_report,
+    get_results_report,
+    get_shard_results_path,
+    import_dataframe,
+    resolve_dataframe,
+    sort_cases,
+    write_stratum_table,
+)
+from osmatching.partition import partition_controls
+from osmatching.utils import (
+    ROW_NUMBER_VARIABLE,
+    MatchConfig,
+    import_match_variables,
+    load_dataframe,
+    parse_and_validate_config,
+    read_schema,
+    report_validation_errors,
+    write_arrow,
+    write_output_file,
+    write_output_files,
+)
+from osmatching.validation import (
+    ValidationType,
+    merge_errors,
+    validate_case_columns,
+    validate_match_columns,
+)
+
+
+def get_shard_suffix(match_config: MatchConfig, shard_number: int) -> str:
+    return f"{match_config.output_suffix}_shard_{shard_number}"
+
+
+def get_manifest_path(match_config: MatchConfig) -> Path:
+    return match_config.output_path / f"shards{match_config.output_suffix}.json"
+
+
+def get_column_types(categories: dict[str, pd.Index], dtypes: dict) -> dict:
+    return {
+        "categories": {var: values.tolist() for var, values in categories.items()},
+        "dtypes": {column: str(dtype) for column, dtype in dtypes.items()},
+    }
+
+
+def restore_column_types(df: pd.DataFrame, column_types: dict) -> pd.DataFrame:
+    """
+    Sets the types of the columns of a dataset combined from several shards to
+    those of the whole dataset, as saved in the manifest by get_column_types.
+    """
+    for var, categories in column_types["categories"].items():
+        if var in df.columns:
+            df[var] = pd.Categorical(df[var], categories=categories)
+    for column, dtype in column_types["dtypes"].items():
+        if column in df.columns and str(df[column].dtype) != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def validate_sharding(match_config: MatchConfig, num_shards: int) -> MatchConfig:
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
+    errors = defaultdict(list)
+    if num_shards < 1:
+        errors["shards"].append("The number of shards must be a positive integer")
+    # controls are sampled from each stratum in turn, from a single random sequence
+    if match_config.control_pool_multiple is not None:
+        errors["control_pool_multiple"].append(
+            "`control_pool_multiple` cannot be used when matching in shards"
+        )
+    if match_config.populations:
+        errors["populations"].append(
+            "`populations` cannot be used when matching in shards"
+        )
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+        raise ValueError("There was an error in one or more config values")
+    return match_config
+
+
+def shard(
+    case_df: "pd.DataFrame | Future[pd.DataFrame]",
+    controls_path: Path,
+    match_config: MatchConfig,
+    num_shards: int,
+    columns: list[str] | None = None,
+) -> dict:
+    """
+    Splits the cases, and the controls in controls_path, into num_shards shards by
+    stratum, and writes the files of each shard and the manifest to the output
+    path. If columns are given, only those columns of the controls file are read.
+    Strata are assigned to the shard with the fewest controls so far; cases with
+    no matching stratum, which are never matched, are in the first shard. Returns
+    the manifest.
+    """
+    match_config = validate_sharding(match_config, num_shards)
+    assert match_config.match_variables is not None  # guaranteed by validation
+
+    sharding_started = datetime.now()
+
+    cases = resolve_dataframe(case_df)
+    controls_columns = columns or read_schema(controls_path).names
+    errors = merge_errors(
+        validate_case_columns(cases.columns, match_config),
+        validate_match_columns(controls_columns, match_config),
+    )
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+    # the cases are written to the shard files as they were loaded
+    imported = import_dataframe(cases.copy(), match_config)
+
+    excluded_ids = pd.Index([])
+    if match_config.drop_cases_from_matches:
+        excluded_ids = imported.index
+
+    # the order in which the cases are matched, as when matching all of them at
+    # once; cases excluded by date are never matched, and are numbered last
+    to_match = imported.reset_index(drop=True)
+    if match_config.date_exclusion_variables:
+        to_match = exclude_cases(to_match, match_config)
+    order = sort_cases(to_match, match_config).index.to_numpy()
+    excluded = np.setdiff1d(np.arange(len(cases)), order)
+    row_numbers = np.empty(len(cases), dtype=np.int64)
+    row_numbers[np.concatenate([order, excluded])] = np.arange(len(cases))
+    cases = cases.assign(**{ROW_NUMBER_VARIABLE: row_numbers})
+
+    match_config.output_path.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(
+        dir=match_config.output_path, prefix=".shards"
+    ) as directory:
+        # Cases are matched only within their own shard, so controls that are cases
+        # in any shard are dropped, rather than being dropped by matching
+        partitioned = partition_controls(
+            controls_path,
+            columns,
+            copy.deepcopy(match_config),
+            Path(directory),
+            excluded_ids,
+            num_buckets=num_shards,
+            drop_excluded=True,
+        )
+        case_shards = partitioned.get_case_buckets(
+            imported,
+            get_category_variables(
+                import_match_variables(match_config.match_variables)
+            ),
+        )
+        case_shards[case_shards == NO_STRATUM] = 0
+        for shard_number in range(num_shards):
+            suffix = get_shard_suffix(match_config, shard_number + 1)
+            write_output_file(
+                cases[case_shards == shard_number],
+                match_config.output_path / f"cases{suffix}.arrow",
+            )
+            bucket_path = partitioned.get_bucket_path(shard_number)
+            shard_path = match_config.output_path / f"controls{suffix}.arrow"
+            if bucket_path.exists():
+                bucket_path.replace(shard_path)
+            else:
+                write_arrow(partitioned.schema.empty_table(), shard_path)
+
+    # the sections of the matching report that come before matching
+    report = [
+        [f"Matching started at: {sharding_started}"],
+        [
+            "Data import:",
+            f"Completed {datetime.now()}",
+            f"Cases    {len(imported)}",
+            f"Matches  {partitioned.num_controls}",
+        ],
+        [
+            "Dropping cases from matches:",
+            f"Completed {datetime.now()}",
+            f"Cases    {len(imported)}",
+            f"Matches  {partitioned.num_available}",
+        ],
+    ]
+    if match_config.date_exclusion_variables:
+        report.append(
+            [
+                "Date exclusions for cases:",
+                f"Completed {datetime.now()}",
+                f"Cases    {len(to_match)}",
+                f"Matches  {partitioned.num_available}",
+            ]
+        )
+    shard_counts = pd.DataFrame(
+        {
+            "shard": range(1, num_shards + 1),
+            "cases": np.bincount(case_shards, minlength=num_shards),
+            "matches": partitioned.bucket_rows,
+        }
+    )
+    report.append(
+        [
+            "Sharding:",
+            f"Completed {datetime.now()}",
+            f"Shards   {num_shards}\n",
+            "Cases and matches in each shard:",
+            shard_counts.to_string(index=False),
+        ]
+    )
+
+    manifest = {
+        "num_shards": num_shards,
+        "report": report,
+        "cases": get_column_types(
+            {
+                column: dtype.categories
+                for column, dtype in imported.dtypes.items()
+                if isinstance(dtype, pd.CategoricalDtype)
+            },
+            {
+                column: dtype
+                for column, dtype in imported.dtypes.items()
+                if not isinstance(dtype, pd.CategoricalDtype)
+            },
+        ),
+        "matches": get_column_types(partitioned.categories, partitioned.dtypes),
+    }
+    get_manifest_path(match_config).write_text(json.dumps(manifest, indent=2))
+    for section in report:
+        print("\n".join(section) + "\n\n")
+    return manifest
+
+
+def combine_shards(paths: list[Path], column_types: dict) -> pd.DataFrame:
+    """Combines the outputs of the shards, in their original order"""
+    dfs = [load_dataframe(path) for path in paths]
+    # shards with no rows are left out, unless all are empty
+    df = pd.concat([df for df in dfs if len(df)] or dfs)
+    df = df.sort_values(ROW_NUMBER_VARIABLE, kind="stable")
+    return restore_column_types(df.drop(columns=ROW_NUMBER_VARIABLE), column_types)
+
+
+def merge(match_config: MatchConfig) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Combines the outputs of matching each shard (see shard) into the outputs of
+    matching all the cases at once, and writes them, with a matching report, the
+    stratum table and the metrics. The outputs of the shards are read from the
+    output path, and must be arrow files, which keep the types of their columns;
+    the number of matches of each case and the stratum table of each shard are
+    read from its results file (see osmatching.write_shard_results).
+    """
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
+
+    metrics = MatchingMetrics()
+    errors = defaultdict(list)
+    manifest_path = get_manifest_path(match_config)
+    if not manifest_path.exists():
+        errors["shards"].append(f"Shard manifest not found: {manifest_path}")
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+    manifest = json.loads(manifest_path.read_text())
+
+    shard_paths: dict[str, list[Path]] = defaultdict(list)
+    for shard_number in range(1, manifest["num_shards"] + 1):
+        suffix = get_shard_suffix(match_config, shard_number)
+        for name in ["matched_cases", "matched_matches"]:
+            shard_paths[name].append(match_config.output_path / f"{name}{suffix}.arrow")
+        shard_paths["results"].append(
+            get_shard_results_path(match_config.output_path, suffix)
+        )
+        shard_paths["metrics"].append(
+            get_metrics_path(match_config.output_path, suffix)
+        )
+    for path in [path for paths in shard_paths.values() for path in paths]:
+        if not path.exists():
+            errors["shards"].append(f"Shard output not found: {path}")
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.DATA)
+        raise ValueError("Errors encountered in the input datasets")
+
+    # the metrics of matching are those of the shards, followed by merging
+    for path in shard_paths["metrics"]:
+        metrics.add(json.loads(path.read_text()))
+    matched_cases = combine_shards(shard_paths["matched_cases"], manifest["cases"])
+    matched_matches = combine_shards(
+        shard_paths["matched_matches"], manifest["matches"]
+    )
+    results = [json.loads(path.read_text()) for path in shard_paths["results"]]
+    match_counts: Counter = Counter()
+    for shard_results in results:
+        match_counts.update(
+            {
+                float(value): count
+                for value, count in shard_results["match_counts"].items()
+            }
+        )
+    match_counts_series = pd.Series(
+        match_counts, name="count", dtype="int64"
+    ).rename_axis("match_counts")
+    # as with partitions, the strata of each shard follow those of the one before
+    stratum_tables = [
+        pd.DataFrame(shard_results["strata"]) for shard_results in results
+    ]
+    stratum_table = pd.concat(
+        [table for table in stratum_tables if len(table)] or stratum_tables,
+        ignore_index=True,
+    )
+    metrics.lap("merge_shards", cases=len(matched_cases), matches=len(matched_matches))
+
+    matching_report = get_matching_report(match_config)
+    for section_number, section in enumerate(manifest["report"]):
+        matching_report(section, erase=section_number == 0)
+    matching_report(
+        [
+            "Merging shards:",
+            f"Completed {datetime.now()}",
+            f"Shards   {manifest['num_shards']}",
+        ]
+    )
+    # closest match variables that aren't in the outputs can't be compared
+    closest_match_variables = [
+        var
+        for var in match_config.closest_match_variables
+        if var in matched_cases.columns and var in matched_matches.columns
+    ]
+    balance_variables = [
+        var
+        for var in get_balance_variables(match_config)
+        if var in matched_cases.columns and var in matched_matches.columns
+    ]
+    matching_report(
+        get_results_report(
+            matched_cases,
+            matched_matches,
+            match_counts_series.sort_index().sort_values(
+                ascending=False, kind="stable"
+            ),
+            compare_populations(
+                matched_cases[closest_match_variables],
+                matched_matches[closest_match_variables],
+                closest_match_variables,
+            ),
+            get_balance_report(
+                get_balance_table(
+                    matched_cases[balance_variables],
+                    matched_matches[balance_variables],
+                    balance_variables,
+                )
+            ),
+            match_config,
+        )
+    )
+    metrics.lap(
+        "results_report", cases=len(matched_cases), matches=len(matched_matches)
+    )
+
+    write_output_files(matched_cases, matched_matches, match_config, metrics)
+    write_stratum_table(stratum_table, match_config)
+    metrics.lap("write_outputs")
+    metrics.write(
+        get_metrics_path(match_config.output_path, match_config.output_suffix)
+    )
+    return matched_cases, matched_matches
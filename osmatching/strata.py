@@ -0,0 +1,133 @@
+"""
+A table of the results of matching in each stratum (see osmatching.index), to show
+which strata drive the time of matching and poor match rates.
+
+The table is computed from the arrays of the matching loop: the stratum of each
+case, the time spent matching it, its number of matches, and the stratum and
+availability of each control. Each stratum of the cases has a row with its values
+of the category match variables, and cases whose stratum has no controls (or with
+missing category values) are in a row with missing values. The rows are written
+in order of their category values (see sort_strata), whatever order the strata
+were matched in.
+
+The table is written to matching_strata<output_suffix>.<output_format>, with
+small-number suppression, so that it can be released as a moderately sensitive
+output: counts of SUPPRESSION_THRESHOLD or less are redacted, and others are
+rounded to the nearest ROUNDING_BASE. The mean number of matches per case is
+computed from the rounded counts, so that the unrounded counts can't be derived
+from it, and it is redacted if either of them is. The time spent matching a
+stratum is redacted if any of its counts are, as it would disclose them.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from osmatching.index import NO_STRATUM, ControlIndex
+
+
+SUPPRESSION_THRESHOLD = 7
+ROUNDING_BASE = 5
+COUNT_COLUMNS = ["cases", "eligible_controls", "matched_cases", "matched_controls"]
+
+
+def get_strata_path(output_path: Path, output_suffix: str, output_format: str) -> Path:
+    return output_path / f"matching_strata{output_suffix}.{output_format}"
+
+
+def get_case_strata(cases: pd.DataFrame, control_index: ControlIndex) -> np.ndarray:
+    """
+    The stratum id of each case (its position in control_index.stratum_keys), or
+    NO_STRATUM if no controls are in its stratum or any of its category values are
+    missing.
+    """
+    if not control_index.category_variables:
+        return np.zeros(len(cases), dtype=np.int64)
+    strata = pd.MultiIndex.from_tuples(
+        control_index.stratum_keys, names=control_index.category_variables
+    )
+    return strata.get_indexer(
+        pd.MultiIndex.from_frame(cases[control_index.category_variables])
+    )
+
+
+def get_stratum_table(
+    control_index: ControlIndex,
+    case_strata: np.ndarray,
+    case_seconds: np.ndarray,
+    matched_cases: np.ndarray,
+    eligible_controls: np.ndarray,
+    matched_controls: np.ndarray,
+) -> pd.DataFrame:
+    """
+    The (unsuppressed) table of the strata of the cases. matched_cases is a boolean
+    array of the cases that are matched, and eligible_controls and matched_controls
+    boolean arrays of the controls that were available before matching, and were
+    matched.
+    """
+    num_strata = len(control_index.stratum_keys)
+
+    def count(stratum_ids: np.ndarray, weights=None) -> np.ndarray:
+        # NO_STRATUM is counted in an extra last stratum
+        stratum_ids = np.where(stratum_ids == NO_STRATUM, num_strata, stratum_ids)
+        return np.bincount(stratum_ids, weights, minlength=num_strata + 1)
+
+    no_stratum = (None,) * len(control_index.category_variables)
+    table = pd.DataFrame(
+        control_index.stratum_keys + [no_stratum],
+        columns=control_index.category_variables,
+    )
+    table["cases"] = count(case_strata)
+    # controls with missing category values never match, so aren't eligible
+    eligible_controls = eligible_controls & (control_index.stratum_ids != NO_STRATUM)
+    table["eligible_controls"] = count(control_index.stratum_ids[eligible_controls])
+    table["matched_cases"] = count(case_strata[matched_cases])
+    table["matched_controls"] = count(control_index.stratum_ids[matched_controls])
+    table["seconds"] = count(case_strata, case_seconds)
+    # only the strata of the cases are included
+    return table[table["cases"] > 0].reset_index(drop=True)
+
+
+def sort_strata(table: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sorts the strata by the values of their category match variables, in turn, with
+    the row of cases with no stratum last.
+    """
+    category_variables = list(table.columns.drop([*COUNT_COLUMNS, "seconds"]))
+    return table.sort_values(
+        category_variables, na_position="last", kind="stable"
+    ).reset_index(drop=True)
+
+
+def suppress_small_numbers(table: pd.DataFrame) -> pd.DataFrame:
+    """
+    Redacts counts of SUPPRESSION_THRESHOLD or less and rounds the others to the
+    nearest ROUNDING_BASE, and adds the mean number of matches per matched case
+    (from the rounded counts). Times are rounded to milliseconds, and redacted
+    with any of the counts of their stratum.
+    """
+    table = table.copy()
+    for column in COUNT_COLUMNS:
+        counts = table[column]
+        rounded = np.floor(counts / ROUNDING_BASE + 0.5) * ROUNDING_BASE
+        table[column] = rounded.where(counts > SUPPRESSION_THRESHOLD).astype("Int64")
+    # redacted counts are missing, so the mean is missing if either of them is
+    table["mean_matches_per_case"] = (
+        table["matched_controls"].astype(float) / table["matched_cases"].astype(float)
+    ).round(2)
+    redacted = table[COUNT_COLUMNS].isna().any(axis=1)
+    table["seconds"] = table["seconds"].round(3).where(~redacted)
+    return table[
+        [
+            *table.columns.drop([*COUNT_COLUMNS, "seconds", "mean_matches_per_case"]),
+            *COUNT_COLUMNS,
+            "mean_matches_per_case",
+            "seconds",
+        ]
+    ]
+
+
+def to_stratum_table(table: pd.DataFrame) -> pa.Table:
+    return pa.Table.from_pandas(table, preserve_index=False).replace_schema_metadata()
@@ -0,0 +1,316 @@
+"""
+Sweeps over a grid of matching parameters, to help choose matches_per_case,
+min_matches_per_case and the ranges of scalar match variables.
+
+The input datasets are loaded, imported and indexed once, and the cases matched
+with the parameters of each grid point in turn, in parallel worker processes.
+Instead of the full matching outputs, a table of the match rates and balance (see
+osmatching.balance) for each grid point is written.
+
+The worker processes are spawned, rather than forked from a process that may have
+threads running (e.g. those loading the datasets), and load the imported data and
+control index from files written to a temporary directory before they start. Only
+the columns that matching and the summary of each grid point use are kept, and
+they are written to uncompressed arrow files, which the workers memory-map: their
+numeric and date columns are views of the files, shared by all the workers, rather
+than copies in each. As each worker still has its own copy of the other columns
+and of its matching state, a small number of workers (SWEEP_WORKERS) are run by
+default.
+"""
+
+import copy
+import itertools
+import multiprocessing
+import tempfile
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from osmatching.balance import (
+    SMD_THRESHOLD,
+    get_balance_table,
+    get_balance_variables,
+)
+from osmatching.index import ControlIndex, build_control_index
+from osmatching.osmatching import (
+    NOT_PREVIOUSLY_MATCHED,
+    add_variables,
+    assign_matches,
+    exclude_cases,
+    import_data,
+    sort_cases,
+    thin_control_pool,
+)
+from osmatching.utils import MatchConfig, report_validation_errors
+from osmatching.validation import (
+    ValidationType,
+    is_scalar_match_type,
+    parse_and_validate_config,
+)
+
+
+# config options that can be swept, as well as the ranges of scalar match
+# variables, given as "match_variables.<variable>"
+SWEEP_OPTIONS = ["matches_per_case", "min_matches_per_case"]
+MATCH_VARIABLE_PREFIX = "match_variables."
+# The default number of worker processes
+SWEEP_WORKERS = 2
+
+# The data of the grid points matched by this process; set by load_sweep_data in
+# each worker process
+SWEEP_DATA: dict = {}
+
+
+def get_grid_points(grid: dict[str, list]) -> list[dict]:
+    """All combinations of the values of each parameter in the grid"""
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def get_grid_point_config(match_config: MatchConfig, point: dict) -> MatchConfig:
+    config = copy.deepcopy(match_config)
+    assert config.match_variables is not None  # guaranteed by validation
+    for parameter, value in point.items():
+        if parameter.startswith(MATCH_VARIABLE_PREFIX):
+            config.match_variables[parameter.removeprefix(MATCH_VARIABLE_PREFIX)] = (
+                value
+            )
+        else:
+            setattr(config, parameter, value)
+    config.validated = False
+    config, _ = parse_and_validate_config(config)
+    return config
+
+
+def validate_grid(grid, match_config: MatchConfig):
+    errors = defaultdict(list)
+    if not isinstance(grid, dict) or not grid:
+        errors["grid"].append(
+            "The grid must be a dict of parameters to lists of values"
+        )
+        return errors
+    assert match_config.match_variables is not None  # guaranteed by validation
+    for parameter, values in grid.items():
+        variable = parameter.removeprefix(MATCH_VARIABLE_PREFIX)
+        if parameter.startswith(MATCH_VARIABLE_PREFIX):
+            if not isinstance(match_config.match_variables.get(variable), int):
+                errors["grid"].append(
+                    f"`{variable}` is not a scalar match variable; only the ranges of scalar match variables can be swept"
+                )
+            elif any(variable in tier for tier in match_config.tiers):
+                errors["grid"].append(
+                    f"The range of `{variable}` is set by `tiers`, so it cannot be swept"
+                )
+        elif parameter not in SWEEP_OPTIONS:
+            errors["grid"].append(
+                f"`{parameter}` cannot be swept. Allowed are {', '.join(SWEEP_OPTIONS)} and match_variables.<variable>"
+            )
+        if (
+            not isinstance(values, list)
+            or not values
+            or not all(is_scalar_match_type(value) for value in values)
+        ):
+            errors["grid"].append(f"`{parameter}` must be a list of integers")
+    if errors:
+        return errors
+
+    for point in get_grid_points(grid):
+        _, point_errors = parse_and_validate_config(
+            get_grid_point_config(match_config, point)
+        )
+        for field_errors in point_errors.values():
+            for error in field_errors:
+                errors["grid"].append(f"{point}: {error}")
+    return errors
+
+
+def summarise(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    match_counts: np.ndarray,
+    set_ids: np.ndarray,
+    config: MatchConfig,
+) -> dict:
+    """
+    Match rates for one grid point, and the difference and standardised difference
+    of each variable (or level of a categorical variable) of the balance table of
+    the matched cases and matches (see osmatching.balance).
+    """
+    matched_cases = match_counts >= config.min_matches_per_case
+    # cases that are the set_id of at least one match
+    labelled_cases = match_counts >= max(config.min_matches_per_case, 1)
+    matched_matches = set_ids != NOT_PREVIOUSLY_MATCHED
+    num_cases = len(cases)
+    summary = {
+        "cases": num_cases,
+        "matched_cases": int(matched_cases.sum()),
+        "match_rate": matched_cases.sum() / num_cases if num_cases else np.nan,
+        "cases_with_all_matches": int((match_counts == config.matches_per_case).sum()),
+        "matches": int(matched_matches.sum()),
+        "mean_matches_per_case": (
+            matched_matches.sum() / labelled_cases.sum()
+            if labelled_cases.any()
+            else np.nan
+        ),
+    }
+    balance_variables = get_balance_variables(config)
+    balance = get_balance_table(
+        cases.loc[matched_cases, balance_variables],
+        matches.loc[matched_matches, balance_variables],
+        balance_variables,
+    )
+    summary["imbalanced_variables"] = balance.loc[
+        balance["smd"].abs() > SMD_THRESHOLD, "variable"
+    ].nunique()
+    for row in balance.itertuples():
+        name = f"{row.variable}_{row.level}" if row.level else row.variable
+        summary[f"{name}_difference"] = row.difference
+        summary[f"{name}_smd"] = row.smd
+    return summary
+
+
+def get_sweep_columns(df: pd.DataFrame, match_config: MatchConfig) -> list[str]:
+    """
+    The columns of an imported dataset that are used to match the grid points and
+    to summarise them
+    """
+    used = {
+        *get_balance_variables(match_config),
+        *match_config.date_exclusion_variables,
+        match_config.index_date_variable,
+        match_config.indicator_variable_name,
+        "set_id",
+    }
+    return [column for column in df.columns if column in used]
+
+
+def write_shared_dataframe(df: pd.DataFrame, file_path: Path):
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    feather.write_feather(table, file_path, compression="uncompressed")
+
+
+def read_shared_dataframe(file_path: Path) -> pd.DataFrame:
+    """
+    Reads a dataframe written by write_shared_dataframe, with its numeric and date
+    columns as (read-only) views of the memory-mapped file
+    """
+    table = feather.read_table(file_path, memory_map=True)
+    return table.to_pandas(split_blocks=True)
+
+
+def write_sweep_data(
+    data_path: Path,
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    control_index: ControlIndex,
+    available: np.ndarray,
+):
+    """Writes the data shared by the grid points, for load_sweep_data"""
+    write_shared_dataframe(cases, data_path / "cases.arrow")
+    write_shared_dataframe(matches, data_path / "matches.arrow")
+    control_index.write(data_path / "control_index.arrow")
+    np.save(data_path / "available.npy", available)
+
+
+def load_sweep_data(data_path: Path, match_config: MatchConfig):
+    """Loads the data written by write_sweep_data, in a worker process"""
+    SWEEP_DATA.update(
+        cases=read_shared_dataframe(data_path / "cases.arrow"),
+        matches=read_shared_dataframe(data_path / "matches.arrow"),
+        config=match_config,
+        control_index=ControlIndex.read(data_path / "control_index.arrow"),
+        available=np.load(data_path / "available.npy"),
+    )
+
+
+def run_grid_point(point: dict) -> dict:
+    cases = SWEEP_DATA["cases"]
+    # the set_id (and index date and tier) columns of the matches are replaced
+    # by matching, so a shallow copy keeps those of the shared matches
+    matches = SWEEP_DATA["matches"].copy(deep=False)
+    config = get_grid_point_config(SWEEP_DATA["config"], point)
+    control_index = SWEEP_DATA["control_index"]
+    available = SWEEP_DATA["available"].copy()
+    # control pools are thinned for the matches_per_case of each grid point
+    if config.control_pool_multiple:
+        thin_control_pool(cases, config, control_index, available)
+    match_counts, _ = assign_matches(cases, matches, config, control_index, available)
+    set_ids = matches["set_id"].to_numpy()
+    return {**point, **summarise(cases, matches, match_counts, set_ids, config)}
+
+
+def sweep(
+    case_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_df: "pd.DataFrame | Future[pd.DataFrame]",
+    match_config: MatchConfig,
+    grid: dict[str, list],
+    workers: int | None = None,
+    control_index: ControlIndex | None = None,
+) -> pd.DataFrame:
+    """
+    Matches the cases with the parameters of each point in the grid, which is a
+    dict of parameters (see SWEEP_OPTIONS) to lists of values, e.g.
+    {"matches_per_case": [1, 2], "match_variables.age": [1, 3, 5]}. Writes and
+    returns a table with a row for each grid point. The grid points are matched in
+    workers processes (SWEEP_WORKERS by default).
+    """
+    if not match_config.validated:
+        match_config, errors = parse_and_validate_config(match_config)
+        if errors:
+            report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+            raise ValueError("There was an error in one or more config values")
+    errors = validate_grid(grid, match_config)
+    if errors:
+        report_validation_errors(errors, validation_type=ValidationType.CONFIG)
+        raise ValueError("There was an error in one or more config values")
+
+    cases, matches = import_data(case_df, match_df, match_config)
+    available = np.ones(len(matches), dtype=bool)
+    if match_config.drop_cases_from_matches:
+        available &= ~matches.index.isin(cases.index)
+    cases, matches = add_variables(cases, matches, match_config.indicator_variable_name)
+    if control_index is None or not control_index.is_valid_for(matches, match_config):
+        control_index = build_control_index(matches, match_config)
+    if match_config.date_exclusion_variables:
+        cases = exclude_cases(cases, match_config)
+    cases = sort_cases(cases, match_config)
+    cases = cases[get_sweep_columns(cases, match_config)]
+    matches = matches[get_sweep_columns(matches, match_config)]
+
+    points = get_grid_points(grid)
+    workers = min(workers or SWEEP_WORKERS, len(points))
+    match_config.output_path.mkdir(parents=True, exist_ok=True)
+    if workers == 1:
+        SWEEP_DATA.update(
+            cases=cases,
+            matches=matches,
+            config=match_config,
+            control_index=control_index,
+            available=available,
+        )
+        try:
+            rows = list(map(run_grid_point, points))
+        finally:
+            SWEEP_DATA.clear()
+    else:
+        with tempfile.TemporaryDirectory(
+            dir=match_config.output_path, prefix=".sweep"
+        ) as directory:
+            write_sweep_data(Path(directory), cases, matches, control_index, available)
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_sweep_data,
+                initargs=(Path(directory), match_config),
+            ) as executor:
+                rows = list(executor.map(run_grid_point, points))
+
+    results = pd.DataFrame(rows)
+    results_path = match_config.output_path / f"sweep{match_config.output_suffix}.csv"
+    results.to_csv(results_path, index=False)
+    print(results.to_string(index=False))
+    return results
@@ -1,10 +1,30 @@
+import copy
+import csv
+import fnmatch
+import gzip
+import hashlib
+import io
+import os
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
 
-from osmatching.validation import ValidationType, parse_and_validate_config
+from osmatching.metrics import MatchingMetrics
+from osmatching.validation import (
+    ValidationType,
+    get_required_columns,
+    parse_and_validate_config,
+)
 
 
 @dataclass
@@ -13,6 +33,7 @@ class MatchConfig:
     match_variables: dict | None = None
     index_date_variable: str | None = None
     closest_match_variables: list[str] = field(default_factory=list)
+    balance_variables: list[str] = field(default_factory=list)
     date_exclusion_variables: dict[Any, Any] = field(default_factory=dict)
     min_matches_per_case: int = 0
     generate_match_index_date: str = ""
@@ -22,20 +43,42 @@ class MatchConfig:
     output_path: Path = Path("output")
     drop_cases_from_matches: bool = False
     output_format: str = "arrow"
+    output_compression: str = "lz4"
+    output_columns: dict[str, list[str]] = field(default_factory=dict)
+    control_cache_path: str = ""
+    control_cache_max_size_mb: int = 10240
+    populations: dict[str, dict] = field(default_factory=dict)
+    reuse_controls_across_populations: bool = True
+    tiers: list[dict[str, int]] = field(default_factory=list)
+    control_pool_multiple: int | None = None
+    partition_memory_mb: int | None = None
+    engine: str = "pandas"
+    checkpoint_interval: int | None = None
+    resume: bool = False
+    profile: bool = False
+    loop_counters: bool = False
     validated: bool = False
 
     @classmethod
     def from_dict(cls, config_dict):
         output_path = Path(config_dict.pop("output_path", None) or "output")
         closest_match_variables = config_dict.pop("closest_match_variables", None) or []
+        balance_variables = config_dict.pop("balance_variables", None) or []
         date_exclusion_variables = (
             config_dict.pop("date_exclusion_variables", None) or {}
         )
+        output_columns = config_dict.pop("output_columns", None) or {}
+        populations = config_dict.pop("populations", None) or {}
+        tiers = config_dict.pop("tiers", None) or []
         return cls(
             **config_dict,
             output_path=output_path,
             closest_match_variables=closest_match_variables,
+            balance_variables=balance_variables,
             date_exclusion_variables=date_exclusion_variables,
+            output_columns=output_columns,
+            populations=populations,
+            tiers=tiers,
         )
 
     @staticmethod
@@ -47,7 +90,42 @@ DATAFRAME_READER: dict[str, tuple] = {
     ".csv": ("read_csv", {"engine": "pyarrow"}),
     ".arrow": ("read_feather", {}),
 }
-DATAFRAME_WRITER: dict[str, str] = {".csv": "to_csv", ".arrow": "to_feather"}
+READ_COLUMNS_ARGUMENT: dict[str, str] = {".csv": "usecols", ".arrow": "columns"}
+
+# Number of rows written to each record batch of csv output, and to each
+# independently compressed gzip member of csv.gz output
+CSV_BATCH_SIZE = 100_000
+CSV_GZIP_COMPRESSLEVEL = 6
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+# Values read as missing from csv files (as by pd.read_csv)
+CSV_NULL_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+# Column added to the outputs of matching in tiers
+MATCH_TIER_VARIABLE = "match_tier"
+# Seed for the random sampling of controls
+RANDOM_SEED = 123
+# Column added to partitioned controls and to shard files (see osmatching.partition
+# and osmatching.shard), to restore the original order of their rows
+ROW_NUMBER_VARIABLE = "__osmatching_row_number"
 
 
 def load_config(match_config: dict) -> MatchConfig:
@@ -67,23 +145,445 @@ def load_config(match_config: dict) -> MatchConfig:
     return parse_and_validate_config(MatchConfig.from_dict(match_config))
 
 
+def import_match_variables(match_variables: dict) -> dict:
+    """
+    Replaces month_only match variables with the categorical month variables
+    extracted from them by import_dataframe.
+    """
+    match_variables = copy.deepcopy(match_variables)
+    month_only = [
+        var for var, match_type in match_variables.items() if match_type == "month_only"
+    ]
+    for var in month_only:
+        del match_variables[var]
+        match_variables[f"{var}_m"] = "category"
+    return match_variables
+
+
+def file_digest(file_path: Path) -> str:
+    """A hash of the contents of a file"""
+    digest = hashlib.blake2b(digest_size=16)
+    with file_path.open("rb") as infile:
+        while chunk := infile.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stamp(file_path: Path) -> str:
+    """
+    The size and modification time of a file, which change whenever its contents
+    do (and sometimes when they don't), and are much cheaper than hashing them
+    """
+    stat = file_path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
 def file_suffix(file_path: Path):
     return "".join(file_path.suffixes)
 
 
-def load_dataframe(file_path: Path):
+def select_output_columns(columns: list[str], config: MatchConfig) -> list[str]:
+    """
+    Selects the columns to include in the output files, in their original order.
+    Columns matching any of the `include` patterns (all columns, by default) are
+    selected, unless they match any of the `exclude` patterns. Patterns are
+    shell-style wildcards, e.g. "previous_*". The set_id, indicator variable,
+    match tier and row number columns are always selected.
+    """
+    include = config.output_columns.get("include") or ["*"]
+    exclude = config.output_columns.get("exclude") or []
+
+    def matches_any(column, patterns):
+        return any(fnmatch.fnmatchcase(column, pattern) for pattern in patterns)
+
+    return [
+        column
+        for column in columns
+        if column
+        in [
+            "set_id",
+            config.indicator_variable_name,
+            MATCH_TIER_VARIABLE,
+            ROW_NUMBER_VARIABLE,
+        ]
+        or (matches_any(column, include) and not matches_any(column, exclude))
+    ]
+
+
+def select_input_columns(columns: list[str], config: MatchConfig) -> list[str] | None:
+    """
+    Selects the columns to load from an input file; those required for matching
+    and those selected for output. Returns None (load all columns) if no
+    output_columns are configured.
+    """
+    if not config.output_columns:
+        return None
+    required = get_required_columns(config) | {
+        "patient_id",
+        config.index_date_variable,
+    }
+    output_columns = select_output_columns(columns, config)
+    return [
+        column for column in columns if column in required or column in output_columns
+    ]
+
+
+def load_dataframe(file_path: Path, columns: list[str] | None = None):
+    """
+    Loads a data file into a dataframe indexed by patient_id. If columns are
+    given, only those columns are read from the file.
+    """
     suffix = file_suffix(file_path).split(".gz")[0]
     read_method, kwargs = DATAFRAME_READER[suffix]
+    if columns is not None:
+        kwargs = {**kwargs, READ_COLUMNS_ARGUMENT[suffix]: columns}
     dataframe = getattr(pd, read_method)(file_path, **kwargs)
     dataframe.set_index("patient_id", inplace=True)
     return dataframe
 
 
-def write_output_file(df, file_path):
+def iter_record_batches(
+    file_path: Path, columns: list[str] | None = None
+) -> Iterator[pa.RecordBatch]:
+    """
+    Reads a data file in record batches, without loading it all into memory. If
+    columns are given, only those columns are read. Values are read as by
+    load_dataframe, except that the column types of csv files are inferred from
+    the first block of rows only (as by read_schema); an error is raised if the
+    values in later blocks don't fit those types.
+    """
+    suffix = file_suffix(file_path).split(".gz")[0]
+    if suffix == ".arrow":
+        with pa.memory_map(str(file_path)) as source:
+            reader = pa.ipc.open_file(source)
+            for batch_number in range(reader.num_record_batches):
+                batch = reader.get_batch(batch_number)
+                yield batch if columns is None else batch.select(columns)
+        return
+
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=columns,
+        null_values=CSV_NULL_VALUES,
+        strings_can_be_null=True,
+    )
+    with pa_csv.open_csv(file_path, convert_options=convert_options) as reader:
+        for batch in reader:
+            yield pa.RecordBatch.from_arrays(
+                [
+                    column.cast(pa.float64())
+                    if pa.types.is_null(column.type)
+                    else column
+                    for column in batch.columns
+                ],
+                names=batch.schema.names,
+            )
+
+
+def read_schema(file_path: Path) -> pa.Schema:
+    """
+    Reads the schema of a data file without loading its data. For arrow files,
+    this is read from the file footer; for csv files, column types are inferred
+    from the header and first block of rows only.
+    """
+    suffix = file_suffix(file_path).split(".gz")[0]
+    if suffix == ".arrow":
+        with pa.memory_map(str(file_path)) as source:
+            return pa.ipc.open_file(source).schema
+    # compression is detected from the file extension
+    with pa_csv.open_csv(file_path) as reader:
+        return reader.schema
+
+
+def to_output_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Converts a dataframe to an arrow table with the index (patient_id) as the first
+    column, without the copy made by df.reset_index().
+    """
+    # drop the pandas metadata, so that patient_id is read back as a column
+    table = pa.Table.from_pandas(df, preserve_index=True).replace_schema_metadata()
+    # index columns are added after the data columns; move them to the front
+    num_index_columns = df.index.nlevels
+    num_data_columns = table.num_columns - num_index_columns
+    return table.select(
+        list(range(num_data_columns, table.num_columns)) + list(range(num_data_columns))
+    )
+
+
+def format_csv_column(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    """
+    Timestamps are written as DataFrame.to_csv writes them: as dates where they
+    have no time component (as they always do when parsed from input dates), and
+    otherwise to the second, rather than arrow's default nanosecond format.
+    Categorical columns are written as their values.
+    """
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if not pa.types.is_timestamp(column.type):
+        return column
+    if pc.all(pc.equal(column, pc.floor_temporal(column, unit="day"))).as_py() in [
+        True,
+        None,
+    ]:
+        return column.cast(pa.date32())
+    if pc.all(pc.equal(column, pc.floor_temporal(column, unit="second"))).as_py():
+        return column.cast(pa.timestamp("s", tz=column.type.tz))
+    return column
+
+
+def format_csv_values(values: pa.Array) -> pa.Array:
+    """
+    Formats booleans and floats as DataFrame.to_csv does (True and False, and as
+    repr() formats floats, e.g. 1.0 and 1e-05), rather than as arrow does (true
+    and false, 1 and 0.00001).
+    """
+    if pa.types.is_boolean(values.type):
+        return pc.if_else(values, "True", "False")
+    if pa.types.is_floating(values.type):
+        # numpy formats floats as repr() does
+        floats = values.to_numpy(zero_copy_only=False)
+        return pa.array(floats.astype(str), mask=np.isnan(floats))
+    return values
+
+
+def encode_csv_header(names: list[str]) -> bytes:
+    # quoted only where needed, as DataFrame.to_csv does
+    header = io.StringIO()
+    csv.writer(header, lineterminator="\n").writerow(names)
+    return header.getvalue().encode()
+
+
+def encode_csv(batch: pa.RecordBatch) -> bytes:
+    """
+    Encodes the rows of a batch as DataFrame.to_csv does. Arrow quotes every
+    string, so values are written unquoted by arrow, and a batch with any values
+    that need quoting (with commas, quotes or newlines) is quoted by pandas.
+    """
+    batch = pa.RecordBatch.from_arrays(
+        [format_csv_values(column) for column in batch.columns],
+        names=batch.schema.names,
+    )
+    sink = pa.BufferOutputStream()
+    try:
+        pa_csv.write_csv(
+            batch,
+            sink,
+            write_options=pa_csv.WriteOptions(
+                include_header=False, quoting_style="none"
+            ),
+        )
+    except pa.ArrowInvalid:
+        # arrow formats the values, and pandas quotes them
+        strings = pa.table(
+            [column.cast(pa.string()) for column in batch.columns],
+            names=batch.schema.names,
+        )
+        return (
+            strings.to_pandas()
+            .to_csv(header=False, index=False, lineterminator="\n")
+            .encode()
+        )
+    return sink.getvalue().to_pybytes()
+
+
+def compress_csv(data: bytes) -> bytes:
+    return gzip.compress(data, compresslevel=CSV_GZIP_COMPRESSLEVEL)
+
+
+def write_csv(table: pa.Table, file_path: Path, index: bool = True):
+    """
+    Writes a table to csv in record batches of CSV_BATCH_SIZE rows, in the format
+    of DataFrame.to_csv. If index is True, the rows are numbered in an unnamed
+    first column, as DataFrame.reset_index().to_csv() numbers them.
+
+    For .csv.gz files, each batch is encoded and compressed as an independent gzip
+    member in a pool of threads, and members are streamed to the file in order.
+    A gzip file can consist of any number of members, and is decompressed as the
+    concatenation of them all.
+    """
+    table = pa.table(
+        [format_csv_column(column) for column in table.columns],
+        names=table.column_names,
+    )
+    if index:
+        table = table.add_column(0, "", pa.array(np.arange(table.num_rows)))
+    header = encode_csv_header(table.column_names)
+    batches = table.to_batches(max_chunksize=CSV_BATCH_SIZE)
+
+    if not file_suffix(file_path).endswith(".gz"):
+        with file_path.open("wb") as outfile:
+            outfile.write(header)
+            for batch in batches:
+                outfile.write(encode_csv(batch))
+        return
+
+    def encode_and_compress(batch: pa.RecordBatch) -> bytes:
+        return compress_csv(encode_csv(batch))
+
+    max_workers = os.cpu_count() or 1
+    with (
+        ThreadPoolExecutor(max_workers=max_workers) as executor,
+        file_path.open("wb") as outfile,
+    ):
+        outfile.write(compress_csv(header))
+        # Limit the number of batches held in memory while waiting to be written
+        pending: deque = deque()
+        for batch in batches:
+            pending.append(executor.submit(encode_and_compress, batch))
+            if len(pending) >= 2 * max_workers:
+                outfile.write(pending.popleft().result())
+        while pending:
+            outfile.write(pending.popleft().result())
+
+
+def promote_output_types(tables: list[pa.Table]) -> list[pa.Table]:
+    """
+    Columns with no values (e.g. read from an empty csv column) are given the null
+    type, which can be promoted to any other type. Any remaining columns with types
+    that cannot be promoted to a common type are cast to strings, as pd.concat would
+    combine them into an object column, and integer columns that are missing (or
+    have no values) in any table are cast to floats, as pd.concat would fill them
+    with NaN.
+    """
+    tables = [
+        pa.table(
+            [
+                pa.nulls(len(column))
+                if table.num_rows and column.null_count == table.num_rows
+                else column
+                for column in table.columns
+            ],
+            names=table.column_names,
+        )
+        for table in tables
+    ]
+    with_missing_values = {
+        name
+        for table in tables
+        for name in {name for other in tables for name in other.column_names}
+        if name not in table.column_names
+        or pa.types.is_null(table.schema.field(name).type)
+    }
+    conflicting = set()
+    fields: dict[str, pa.Field] = {}
+    for table in tables:
+        for table_field in table.schema:
+            if table_field.name in fields:
+                try:
+                    pa.unify_schemas(
+                        [
+                            pa.schema([fields[table_field.name]]),
+                            pa.schema([table_field]),
+                        ],
+                        promote_options="permissive",
+                    )
+                except (pa.ArrowTypeError, pa.ArrowInvalid):
+                    conflicting.add(table_field.name)
+            fields[table_field.name] = table_field
+    return [
+        pa.table(
+            [
+                column.cast(pa.string())
+                if name in conflicting
+                else column.cast(pa.float64())
+                if name in with_missing_values and pa.types.is_integer(column.type)
+                else column
+                for name, column in zip(table.column_names, table.columns)
+            ],
+            names=table.column_names,
+        )
+        for table in tables
+    ]
+
+
+def combine_output_tables(tables: list[pa.Table]) -> pa.Table:
+    """
+    Appends the record batches of the given tables, without copying them. As
+    with pd.concat, columns missing from any table are filled with nulls and
+    differing column types are promoted to a common type (see
+    promote_output_types). Categorical columns stay dictionary-encoded, with a
+    single dictionary across all batches (as required for arrow files). Empty
+    tables are skipped, unless all are empty.
+    """
+    tables = [table for table in tables if table.num_rows] or tables
+    combined = pa.concat_tables(
+        promote_output_types(tables), promote_options="permissive"
+    )
+    if not combined.num_rows:
+        # there are no dictionaries to unify (and categorical columns with no
+        # categories have null dictionaries, which can't be unified)
+        return combined.schema.empty_table()
+    return combined.unify_dictionaries()
+
+
+def write_arrow(table: pa.Table, file_path: Path, compression: str = "lz4"):
+    options = pa.ipc.IpcWriteOptions(
+        compression=None if compression == "uncompressed" else compression
+    )
+    with pa.ipc.new_file(file_path, table.schema, options=options) as writer:
+        writer.write_table(table)
+
+
+def write_output_file(
+    df: pd.DataFrame | pa.Table,
+    file_path: Path,
+    compression: str = "lz4",
+    index: bool = True,
+):
+    """
+    Writes a dataframe (or a table from to_output_table) to file_path, in the
+    format given by its suffix. compression applies to arrow files only; csv.gz
+    files are always gzip-compressed. index applies to csv files only (see
+    write_csv).
+    """
+    table = to_output_table(df) if isinstance(df, pd.DataFrame) else df
     suffix = file_suffix(file_path).split(".gz")[0]
-    # feather requires that we reset the index before writing
-    writer = getattr(df.reset_index(), DATAFRAME_WRITER[suffix])
-    writer(file_path)
+    if suffix == ".csv":
+        write_csv(table, file_path, index)
+    else:
+        write_arrow(table, file_path, compression)
+
+
+def write_output_files(
+    matched_cases: pd.DataFrame,
+    matched_matches: pd.DataFrame,
+    config: MatchConfig,
+    metrics: MatchingMetrics | None = None,
+):
+    """
+    Writes the matched cases, matched matches and matched combined output files
+    concurrently. The combined file is written from the record batches of the
+    other two tables. If metrics are given, the writing of each file is recorded
+    as a stage.
+    """
+    cases_table = to_output_table(matched_cases)
+    matches_table = to_output_table(matched_matches)
+    outputs = {
+        "matched_cases": cases_table,
+        "matched_matches": matches_table,
+        "matched_combined": combine_output_tables([cases_table, matches_table]),
+    }
+    file_suffix_ext = f"{config.output_suffix}.{config.output_format}"
+
+    def write_output(name: str, table: pa.Table):
+        stage = (
+            metrics.thread_stage(f"write_{name}", rows=table.num_rows)
+            if metrics is not None
+            else nullcontext()
+        )
+        with stage:
+            write_output_file(
+                table,
+                config.output_path / f"{name}{file_suffix_ext}",
+                config.output_compression,
+            )
+
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        futures = [
+            executor.submit(write_output, name, table)
+            for name, table in outputs.items()
+        ]
+        for future in futures:
+            future.result()
 
 
 def report_validation_errors(errors: dict[str, list], validation_type: ValidationType):
@@ -1,9 +1,12 @@
+import copy
+import dataclasses
 from collections import defaultdict
+from collections.abc import Collection
 from enum import Enum
 from pathlib import Path
 from typing import TYPE_CHECKING
 
-import pandas as pd
+import pyarrow as pa
 
 
 if TYPE_CHECKING:  # pragma: no cover
@@ -15,6 +18,21 @@ if TYPE_CHECKING:  # pragma: no cover
     from osmatching.utils import MatchConfig
 
 
+# compression options for arrow output files
+OUTPUT_COMPRESSION = ["lz4", "zstd", "uncompressed"]
+# matching engines (see osmatching.ENGINES)
+MATCHING_ENGINES = ["pandas", "arrow"]
+# config options that apply to all populations, and can't be overridden for one
+SHARED_CONFIG_OPTIONS = [
+    "populations",
+    "reuse_controls_across_populations",
+    "control_cache_path",
+    "control_cache_max_size_mb",
+    "match_index_date_offset",
+    "validated",
+]
+
+
 class ValidationType(Enum):
     CONFIG = "configuration"
     DATA = "input data"
@@ -52,6 +70,93 @@ def validate_match_variables(match_variables):
             yield match_var, match_type
 
 
+def validate_output_columns(output_columns):
+    if not isinstance(output_columns, dict):
+        yield "`output_columns` must be a dict with `include` and/or `exclude` lists"
+        return
+    for key, patterns in output_columns.items():
+        if key not in ["include", "exclude"]:
+            yield f"Invalid key '{key}'. Allowed are 'include' and 'exclude'"
+        elif not isinstance(patterns, list) or not all(
+            isinstance(pattern, str) for pattern in patterns
+        ):
+            yield f"`{key}` must be a list of column names or patterns"
+
+
+def validate_population_overrides(overrides, config):
+    if not isinstance(overrides, dict):
+        yield "overrides must be a dict of config options"
+        return
+    options = {config_field.name for config_field in dataclasses.fields(config)}
+    for option in overrides:
+        if option not in options or option in SHARED_CONFIG_OPTIONS:
+            yield f"`{option}` cannot be set for a population"
+
+
+def validate_tiers(tiers, config):
+    if not isinstance(tiers, list) or not all(isinstance(tier, dict) for tier in tiers):
+        yield "`tiers` must be a list of dicts of match variables to ranges"
+        return
+    if tiers and config.min_matches_per_case < 1:
+        yield "`min_matches_per_case` must be at least 1 to match in tiers"
+    match_variables = config.match_variables or {}
+    for tier_number, tier in enumerate(tiers, start=1):
+        for var, match_range in tier.items():
+            if not is_scalar_match_type(match_variables.get(var)):
+                yield f"Tier {tier_number}: `{var}` is not a scalar match variable"
+            elif not is_scalar_match_type(match_range) or match_range < 0:
+                yield f"Tier {tier_number}: the range of `{var}` must be a non-negative integer"
+
+
+def validate_partition_memory(config):
+    if config.partition_memory_mb is None:
+        return
+    if (
+        not is_scalar_match_type(config.partition_memory_mb)
+        or config.partition_memory_mb < 1
+    ):
+        yield "`partition_memory_mb` must be a positive integer"
+    match_types = (config.match_variables or {}).values()
+    if not any(match_type in ["category", "month_only"] for match_type in match_types):
+        yield "`partition_memory_mb` requires at least one 'category' or 'month_only' match variable, to partition the controls by"
+    if config.control_pool_multiple is not None:
+        yield "`partition_memory_mb` cannot be used with `control_pool_multiple`"
+    if config.populations:
+        yield "`partition_memory_mb` cannot be used with `populations`"
+
+
+def validate_checkpoint(config):
+    if config.checkpoint_interval is None:
+        return
+    if (
+        not is_scalar_match_type(config.checkpoint_interval)
+        or config.checkpoint_interval < 1
+    ):
+        yield "`checkpoint_interval` must be a positive integer"
+    if config.partition_memory_mb is not None:
+        yield "`checkpoint_interval` cannot be used with `partition_memory_mb`"
+
+
+def is_scalar_match_type(match_type) -> bool:
+    return isinstance(match_type, int) and not isinstance(match_type, bool)
+
+
+def get_population_config(config: "MatchConfig", name: str) -> "MatchConfig":
+    """
+    The config for one population of cases (see osmatching.match_populations); the
+    config with the population's overrides. Each population's outputs are written
+    with its own suffix, by default the config output_suffix followed by
+    `_{name}`.
+    """
+    overrides = {
+        "output_suffix": f"{config.output_suffix}_{name}",
+        **config.populations.get(name, {}),
+    }
+    return dataclasses.replace(
+        copy.deepcopy(config), **overrides, populations={}, validated=False
+    )
+
+
 def get_match_index_date_offset(offset_str):
     match offset_str:
         case "" | None:
@@ -100,7 +205,11 @@ def parse_and_validate_config(config: "MatchConfig"):
 
     # ensure we don't have None values where we expect empty lists/dicts
     replace_none_with_default(config, "closest_match_variables", [])
+    replace_none_with_default(config, "balance_variables", [])
     replace_none_with_default(config, "date_exclusion_variables", {})
+    replace_none_with_default(config, "output_columns", {})
+    replace_none_with_default(config, "populations", {})
+    replace_none_with_default(config, "tiers", [])
 
     # validate date exclusion types
     for exclusion_var, invalid_when in validate_date_exclusions(
@@ -116,6 +225,81 @@ def parse_and_validate_config(config: "MatchConfig"):
             f"Invalid match type '{invalid_type}' for variable `{match_var}`. Allowed are 'category', 'month_only', and integers."
         )
 
+    # validate arrow output compression
+    if config.output_compression not in OUTPUT_COMPRESSION:
+        errors["output_compression"].append(
+            f"Invalid output compression '{config.output_compression}'. Allowed are {', '.join(OUTPUT_COMPRESSION)}"
+        )
+
+    if config.engine not in MATCHING_ENGINES:
+        errors["engine"].append(
+            f"Invalid engine '{config.engine}'. Allowed are {', '.join(MATCHING_ENGINES)}"
+        )
+
+    if not isinstance(config.balance_variables, list) or not all(
+        isinstance(var, str) for var in config.balance_variables
+    ):
+        errors["balance_variables"].append(
+            "`balance_variables` must be a list of column names"
+        )
+        config.balance_variables = []
+
+    # validate output column selection
+    for error in validate_output_columns(config.output_columns):
+        errors["output_columns"].append(error)
+
+    if not is_scalar_match_type(config.control_cache_max_size_mb):
+        errors["control_cache_max_size_mb"].append(
+            "`control_cache_max_size_mb` must be an integer"
+        )
+    elif config.control_cache_max_size_mb < 0:
+        errors["control_cache_max_size_mb"].append(
+            "`control_cache_max_size_mb` must not be negative"
+        )
+
+    for error in validate_tiers(config.tiers, config):
+        errors["tiers"].append(error)
+
+    if config.control_pool_multiple is not None and (
+        not is_scalar_match_type(config.control_pool_multiple)
+        or config.control_pool_multiple < 1
+    ):
+        errors["control_pool_multiple"].append(
+            "`control_pool_multiple` must be a positive integer"
+        )
+
+    for error in validate_partition_memory(config):
+        errors["partition_memory_mb"].append(error)
+
+    for error in validate_checkpoint(config):
+        errors["checkpoint_interval"].append(error)
+
+    # validate each population's config, with its overrides
+    if not isinstance(config.populations, dict):
+        errors["populations"].append(
+            "`populations` must be a dict of population names to config overrides"
+        )
+        config.populations = {}
+    output_suffixes = set()
+    for name, overrides in config.populations.items():
+        override_errors = list(validate_population_overrides(overrides, config))
+        if not override_errors:
+            population_config, population_errors = parse_and_validate_config(
+                get_population_config(config, name)
+            )
+            override_errors = [
+                error
+                for field_errors in population_errors.values()
+                for error in field_errors
+            ]
+            if population_config.output_suffix in output_suffixes:
+                override_errors.append(
+                    f"`output_suffix` '{population_config.output_suffix}' is used by more than one population"
+                )
+            output_suffixes.add(population_config.output_suffix)
+        for error in override_errors:
+            errors["populations"].append(f"`{name}`: {error}")
+
     # validate offset units for replace_match_index_date_with_case
     # and populate the match_index_date_offset tuple
     try:
@@ -133,60 +317,187 @@ def parse_and_validate_config(config: "MatchConfig"):
     return config, errors
 
 
-def validate_input_data(
-    cases_df: pd.DataFrame, matches_df: pd.DataFrame, config: "MatchConfig"
-):
+def get_required_columns(config: "MatchConfig") -> set[str]:
+    """
+    Columns (other than index_date_variable) that must be present in both datasets;
+    any of those in match_variables, closest_match_variables, balance_variables and
+    date_exclusion_variables
     """
-    Perfom some basic checks on the input dataframes before we start the calculations.
-    These checks just ensure that we have the appropriate columns present in the two
-    datasets. We don't yet perform any column type validation here.
+    # Explicit empty set for match_variables because it has a None default
+    match_variables = set(config.match_variables) if config.match_variables else set()
+    return match_variables.union(
+        set(config.closest_match_variables),
+        set(config.balance_variables),
+        set(config.date_exclusion_variables),
+    ) - {config.index_date_variable}
 
-    1) config.index_date_variable must be a column in cases_df
-    2) config.index_date_variable must be present in matches_df *unless*
-       config.generate_match_index_date is specified
-    3) Any matching variables specified (excluding index_date_variable) must be present
-       in both datasets, that is, any variables in:
-       - match_variables.keys()
-       - closest_match_variables
-       - date_exclusion_variables.keys()
+
+def format_missing_columns(required_columns, columns):
+    missing = required_columns - set(columns)
+    if missing:
+        return ", ".join([f"`{col}`" for col in sorted(missing)])
+
+
+def validate_case_columns(cases_columns: Collection[str], config: "MatchConfig"):
+    """
+    Check that the cases dataset has the index_date_variable and all the
+    required columns. See validate_input_schema.
     """
     errors = defaultdict(list)
 
-    if config.index_date_variable not in cases_df.columns:
+    if config.index_date_variable not in cases_columns:
         errors["index_date_variable"].append(
             f"column `{config.index_date_variable}` not found in cases dataset"
         )
 
+    columns_missing_from_cases = format_missing_columns(
+        get_required_columns(config), cases_columns
+    )
+    if columns_missing_from_cases:
+        errors["required_columns"].append(
+            f"column(s) {columns_missing_from_cases} not found in cases dataset"
+        )
+
+    return errors
+
+
+def validate_match_columns(matches_columns: Collection[str], config: "MatchConfig"):
+    """
+    Check that the matches dataset has the index_date_variable (unless
+    generate_match_index_date is specified) and all the required columns.
+    See validate_input_schema.
+    """
+    errors = defaultdict(list)
+
     if (
         not config.generate_match_index_date
-        and config.index_date_variable not in matches_df.columns
+        and config.index_date_variable not in matches_columns
     ):
         errors["index_date_variable"].append(
             f"column `{config.index_date_variable}` not found in matches dataset (required when `generate_match_index_date` is not specified)"
         )
 
-    # Explicit empty set for match_variables because it has a None default
-    match_variables = set(config.match_variables) if config.match_variables else set()
-    # required columns are any of those in match_variables, closest_match_variables and
-    # date_exclusion_variables
-    required_columns = match_variables.union(
-        set(config.closest_match_variables), set(config.date_exclusion_variables)
-    ) - {config.index_date_variable}
-
-    def format_missing_columns(df):
-        missing = required_columns - set(df.columns)
-        if missing:
-            return ", ".join([f"`{col}`" for col in sorted(missing)])
-
-    columns_missing_from_cases = format_missing_columns(cases_df)
-    if columns_missing_from_cases:
-        errors["required_columns"].append(
-            f"column(s) {columns_missing_from_cases} not found in cases dataset"
-        )
-    columns_missing_from_matches = format_missing_columns(matches_df)
+    columns_missing_from_matches = format_missing_columns(
+        get_required_columns(config), matches_columns
+    )
     if columns_missing_from_matches:
         errors["required_columns"].append(
             f"column(s) {columns_missing_from_matches} not found in matches dataset"
         )
 
     return errors
+
+
+def validate_previous_run_columns(
+    matches_columns: Collection[str], cases_columns: Collection[str] | None = None
+):
+    """
+    Check that the outputs of a previous matching run have the columns needed to
+    match incrementally; see match_incremental.
+    """
+    errors = defaultdict(list)
+    missing_from_matches = format_missing_columns(
+        {"patient_id", "set_id"}, matches_columns
+    )
+    if missing_from_matches:
+        errors["previous_matches"].append(
+            f"column(s) {missing_from_matches} not found in previous matches dataset"
+        )
+    if cases_columns is not None and "patient_id" not in cases_columns:
+        errors["previous_cases"].append(
+            "column(s) `patient_id` not found in previous cases dataset"
+        )
+    return errors
+
+
+def merge_errors(*error_dicts: dict[str, list]):
+    errors = defaultdict(list)
+    for error_dict in error_dicts:
+        for key, errorlist in error_dict.items():
+            errors[key].extend(errorlist)
+    return errors
+
+
+def get_expected_column_types(config: "MatchConfig") -> dict[str, str]:
+    """
+    The kind of data ("numeric" or "date") expected in each column that is used
+    in a calculation. Category match variables can be of any type.
+    """
+    expected_types: dict = {config.index_date_variable: "date"}
+    for match_var, match_type in (config.match_variables or {}).items():
+        if match_type == "month_only":
+            expected_types[match_var] = "date"
+        elif isinstance(match_type, int):
+            expected_types[match_var] = "numeric"
+    for var in config.closest_match_variables:
+        expected_types[var] = "numeric"
+    for var in config.date_exclusion_variables:
+        expected_types[var] = "date"
+    return expected_types
+
+
+def is_expected_type(data_type: pa.DataType, expected_type: str) -> bool:
+    # Columns with no values (e.g. an empty csv column) are inferred as null
+    if pa.types.is_null(data_type):
+        return True
+    if expected_type == "numeric":
+        return pa.types.is_integer(data_type) or pa.types.is_floating(data_type)
+    # dates may be read as dates, timestamps or "YYYY-MM-DD" strings
+    return (
+        pa.types.is_date(data_type)
+        or pa.types.is_timestamp(data_type)
+        or pa.types.is_string(data_type)
+        or pa.types.is_large_string(data_type)
+    )
+
+
+def validate_column_types(schema: pa.Schema, config: "MatchConfig", dataset: str):
+    for column, expected_type in get_expected_column_types(config).items():
+        if column not in schema.names:
+            # missing columns are reported by validate_case/match_columns
+            continue
+        data_type = schema.field(column).type
+        if not is_expected_type(data_type, expected_type):
+            yield f"column `{column}` in {dataset} dataset has type {data_type}; expected {expected_type} values"
+
+
+def validate_input_schema(
+    cases_schema: pa.Schema, matches_schema: pa.Schema, config: "MatchConfig"
+):
+    """
+    Preflight checks on the schemas of the input files, which can be read without
+    loading any data (see utils.read_schema):
+
+    1) config.index_date_variable must be a column of the cases
+    2) config.index_date_variable must be a column of the matches *unless*
+       config.generate_match_index_date is specified
+    3) Any matching variables specified (excluding index_date_variable) must be present
+       in both datasets, that is, any variables in:
+       - match_variables.keys()
+       - closest_match_variables
+       - balance_variables
+       - date_exclusion_variables.keys()
+    4) Columns used in calculations must have numeric or date types
+
+    Loaded datasets are checked for 1-3 as they are imported (see
+    osmatching.import_data).
+    """
+    errors = merge_errors(
+        validate_case_columns(cases_schema.names, config),
+        validate_match_columns(matches_schema.names, config),
+    )
+    for schema, dataset in [(cases_schema, "cases"), (matches_schema, "matches")]:
+        for error in validate_column_types(schema, config, dataset):
+            errors["column_types"].append(error)
+    return errors
+
+
+def validate_matches_schema(matches_schema: pa.Schema, config: "MatchConfig"):
+    """
+    Preflight checks on the schema of the matches file alone, for commands that do
+    not use a cases file (see validate_input_schema).
+    """
+    errors = validate_match_columns(matches_schema.names, config)
+    for error in validate_column_types(matches_schema, config, "matches"):
+        errors["column_types"].append(error)
+    return errors
@@ -9,7 +9,7 @@ with open(os.path.join("osmatching", "VERSION")) as f:
 setup(
     name="opensafely_matching",
     version=version,
-    packages=find_namespace_packages(exclude=["tests"]),
+    packages=find_namespace_packages(exclude=["tests", "benchmarks"]),
     url="https://github.com/opensafely/matching",
     description="Command line tool for matching cases to controls",
     author="OpenSAFELY",
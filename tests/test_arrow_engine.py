@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from osmatching import arrow_engine
+from osmatching.metrics import LoopCounters
+from osmatching.osmatching import get_closest_matches, pick_matches
+from osmatching.utils import MatchConfig
+
+
+def test_get_case_rows():
+    cases = pd.DataFrame(
+        {
+            "sex": pd.Categorical(["F", None]),
+            "age": [30.0, np.nan],
+            "indexdate": pd.to_datetime(["2020-01-01", None]),
+            "other": ["a", "b"],
+        },
+        index=pd.Index([5, 7], name="patient_id"),
+    )
+    config = MatchConfig(
+        match_variables={"sex": "category", "age": 5},
+        index_date_variable="indexdate",
+        closest_match_variables=["age"],
+    )
+    rows = list(arrow_engine.get_case_rows(cases, config))
+    assert rows == [
+        (5, {"sex": "F", "age": 30.0, "indexdate": pd.Timestamp("2020-01-01")}),
+        (7, {"sex": None, "age": None, "indexdate": pd.NaT}),
+    ]
+
+
+@pytest.mark.parametrize(
+    "values,n,expected",
+    [
+        ([3, 1, 2, 1], 2, [1, 3]),
+        # values tied with the largest of the n smallest are included
+        ([3, 1, 2, 2, 1, 2], 3, [1, 4, 2, 3, 5]),
+        # missing values are only included if there are too few other values
+        ([None, 2, 1, None], 2, [2, 1]),
+        ([None, 2, 1, None], 3, [2, 1, 0, 3]),
+        ([None, None], 1, [0, 1]),
+        ([3, 1], 0, []),
+    ],
+)
+def test_get_smallest(values, n, expected):
+    result = arrow_engine.get_smallest(pa.array(values, pa.float64()), n)
+    assert result.tolist() == expected
+    if n:
+        expected_rows = pd.Series(values, dtype="float64").nsmallest(n, keep="all")
+        assert sorted(result) == sorted(expected_rows.index)
+
+
+def test_get_closest_positions():
+    """
+    The closest positions are the rows picked by DataFrame.nsmallest(keep="all"),
+    in the same order whenever there are more of them than are picked.
+    """
+    rng = np.random.default_rng(1)
+    for _ in range(500):
+        size = rng.integers(1, 30)
+        n = rng.integers(1, 8)
+        df = pd.DataFrame(
+            rng.integers(0, 4, (size, rng.integers(1, 4))).astype("float64")
+        )
+        df = df.mask(rng.random(df.shape) < 0.1)
+        differences = [pa.array(df[column], from_pandas=True) for column in df]
+        expected = df.nsmallest(n, list(df.columns), keep="all").index
+        result = arrow_engine.get_closest_positions(differences, n)
+        if len(expected) > n:
+            assert result.tolist() == expected.tolist()
+        else:
+            assert sorted(result) == sorted(expected)
+
+
+@pytest.mark.parametrize(
+    "closest_match_variables,case_values",
+    [
+        ([], {"age": 36, "weight": 70.0}),
+        (["age"], {"age": 36, "weight": 70.0}),
+        (["weight", "age"], {"age": 36, "weight": 70.0}),
+        (["age", "weight"], {"age": 36, "weight": np.nan}),
+    ],
+)
+def test_pick_matches(closest_match_variables, case_values):
+    """The arrow engine picks the same matches as the pandas engine"""
+    rng = np.random.default_rng(2)
+    matches = pd.DataFrame(
+        {
+            "age": pd.array(rng.integers(30, 40, 200), dtype="Int64"),
+            "weight": rng.integers(60, 80, 200).astype("float64"),
+        }
+    )
+    matches.loc[::9, "weight"] = np.nan
+    positions = np.sort(rng.choice(200, 150, replace=False))
+    case_row = pd.Series(case_values, dtype="object")
+
+    counters = LoopCounters()
+    expected = pick_matches(
+        3,
+        get_closest_matches(matches, closest_match_variables),
+        positions,
+        case_row,
+        closest_match_variables,
+        counters,
+    )
+    arrow_counters = LoopCounters()
+    case_values = {
+        var: None if pd.isna(value) else value for var, value in case_values.items()
+    }
+    result = arrow_engine.pick_matches(
+        3,
+        arrow_engine.get_closest_matches(matches, closest_match_variables),
+        positions,
+        case_values,
+        closest_match_variables,
+        arrow_counters,
+    )
+    assert len(result) == 3
+    assert result.tolist() == expected.tolist()
+    assert arrow_counters.sampled_from == counters.sampled_from
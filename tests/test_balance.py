@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from osmatching.balance import (
+    get_balance_report,
+    get_balance_table,
+    get_balance_variables,
+)
+from osmatching.utils import MatchConfig
+
+
+def test_get_balance_variables():
+    config = MatchConfig(
+        match_variables={"sex": "category", "age": 5, "indexdate": "month_only"},
+        index_date_variable="indexdate",
+        closest_match_variables=["age"],
+        balance_variables=["bmi", "sex"],
+    )
+    assert get_balance_variables(config) == ["sex", "age", "bmi"]
+
+
+def test_get_balance_table():
+    cases = pd.DataFrame(
+        {
+            "age": [20, 30, 40],
+            "bmi": pd.array([25, None, 27], dtype="Int64"),
+            "event_date": pd.to_datetime(["2020-01-01", "2020-01-03", "2020-01-05"]),
+            "sex": pd.Categorical(["F", "M", "F"]),
+        }
+    )
+    matches = pd.DataFrame(
+        {
+            "age": [20, 20, 40, 40],
+            "bmi": pd.array([24, 26, None, None], dtype="Int64"),
+            "event_date": pd.to_datetime(["2020-01-02"] * 4),
+            "sex": pd.Categorical(["F", "F", "F", None]),
+        }
+    )
+    table = get_balance_table(
+        cases, matches, ["sex", "age", "bmi", "event_date"]
+    ).set_index(["variable", "level"])
+    assert list(table.index) == [
+        ("sex", "F"),
+        ("sex", "M"),
+        ("sex", "nan"),
+        ("age", ""),
+        ("bmi", ""),
+        ("event_date", ""),
+    ]
+    # numeric variables are compared by their means and variances
+    age = table.loc[("age", "")]
+    assert (age["cases"], age["matches"], age["difference"]) == (30, 30, 0)
+    assert age["smd"] == 0
+    assert age["variance_ratio"] == pytest.approx(100 / (400 / 3))
+    # missing values are left out
+    bmi = table.loc[("bmi", "")]
+    assert bmi["difference"] == 1
+    assert bmi["smd"] == pytest.approx(1 / np.sqrt(2))
+    # dates are compared in days
+    assert table.loc[("event_date", ""), "difference"] == 1
+    assert table.loc[("event_date", ""), "variance_ratio"] == np.inf
+    # categorical variables are compared by the proportion of each level
+    female = table.loc[("sex", "F")]
+    assert female["difference"] == pytest.approx(2 / 3 - 3 / 4)
+    assert female["smd"] == pytest.approx(
+        (2 / 3 - 3 / 4) / np.sqrt((2 / 9 + 3 / 16) / 2)
+    )
+    assert np.isnan(female["variance_ratio"])
+    assert table.loc[("sex", "M"), "matches"] == 0
+    assert table.loc[("sex", "nan"), "cases"] == 0
+
+
+def test_get_balance_table_with_categorical_variables_only():
+    cases = pd.DataFrame({"region": ["North", "South"]})
+    matches = pd.DataFrame({"region": ["North", "North"]})
+    table = get_balance_table(cases, matches, ["region"])
+    assert list(table["level"]) == ["North", "South"]
+    assert table["variance_ratio"].isna().all()
+    assert get_balance_report(table)[-1] == "\nVariables with |SMD| > 0.1  1"
+
+
+def test_get_balance_table_without_matches():
+    cases = pd.DataFrame({"sex": pd.Categorical(["F", "M"]), "age": [20, 30]})
+    table = get_balance_table(cases, cases.iloc[:0], ["sex", "age"])
+    assert list(table["cases"]) == [0.5, 0.5, 25]
+    assert table[["matches", "difference", "smd"]].isna().all().all()
+
+
+def test_get_balance_report_without_variables():
+    table = get_balance_table(pd.DataFrame(), pd.DataFrame(), [])
+    assert get_balance_report(table) == []
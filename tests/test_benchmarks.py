@@ -0,0 +1,168 @@
+import json
+from pathlib import Path
+
+import pyarrow.feather as feather
+import pytest
+
+from benchmarks import cohort
+from benchmarks.cohort import CohortSpec, write_cohort
+from benchmarks.run import (
+    BENCHMARK_CONFIG,
+    STAGE_METRICS,
+    STAGES,
+    compare_results,
+    main,
+    run_benchmark,
+    run_stages,
+)
+from osmatching.utils import load_dataframe
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+
+def test_write_cohort(tmp_path, monkeypatch):
+    monkeypatch.setattr(cohort, "BATCH_SIZE", 1000)
+    spec = CohortSpec(num_controls=2500, controls_per_case=10, num_regions=3)
+    cases_path, controls_path = write_cohort(spec, tmp_path)
+    cases = load_dataframe(cases_path)
+    controls = load_dataframe(controls_path)
+    assert len(controls) == 2500
+    assert len(cases) == 250
+    assert list(controls.index[[0, -1]]) == [1, 2500]
+    assert list(cases.index[[0, -1]]) == [2501, 2750]
+    assert set(controls["region"]) == {"Region 1", "Region 2", "Region 3"}
+    # the largest region is twice the size of the next
+    region_counts = controls["region"].value_counts()
+    assert 1.6 < region_counts["Region 1"] / region_counts["Region 2"] < 2.4
+    assert controls["age"].between(0, cohort.MAX_AGE).all()
+    assert 0.05 < controls["died_date_ons"].notna().mean() < 0.15
+    assert cases["indexdate"].notna().all()
+
+    # the datasets have the types of the columns of ehrQL outputs
+    fixture_schema = feather.read_table(FIXTURE_PATH / "input_controls.arrow").schema
+    cases_schema = feather.read_table(cases_path).schema
+    assert cases_schema == fixture_schema
+    controls_schema = feather.read_table(controls_path).schema
+    assert controls_schema == fixture_schema.remove(
+        fixture_schema.get_field_index("indexdate")
+    )
+
+    # the cohort is reused, and generated again the same
+    modified = controls_path.stat().st_mtime_ns
+    assert write_cohort(spec, tmp_path) == (cases_path, controls_path)
+    assert controls_path.stat().st_mtime_ns == modified
+    _, regenerated_path = write_cohort(spec, tmp_path / "regenerated")
+    assert load_dataframe(regenerated_path).equals(controls)
+    # batches differ
+    ages = controls["age"].to_numpy()
+    assert (ages[:1000] != ages[1000:2000]).any()
+
+
+def test_run_benchmark(tmp_path):
+    spec = CohortSpec(num_controls=1000, controls_per_case=50)
+    results = run_benchmark(spec, tmp_path, repeat=2, output_format="csv")
+    assert list(results["stages"]) == STAGES
+    for stage_results in results["stages"].values():
+        assert len(stage_results["times"]) == 2
+        assert stage_results["min"] == min(stage_results["times"])
+    assert results["rows"]["cases"] == 20
+    assert 0 < results["rows"]["matched_cases"] <= 20
+    assert results["config"]["output_format"] == "csv"
+    assert results["process_peak_rss_mb"] > 0
+
+
+def test_run_stages(tmp_path):
+    spec = CohortSpec(num_controls=1000, controls_per_case=50)
+    cases_path, controls_path = write_cohort(spec, tmp_path / "data")
+    config = {
+        **BENCHMARK_CONFIG,
+        "drop_cases_from_matches": True,
+        "control_pool_multiple": 2,
+    }
+    timings, rows = run_stages(cases_path, controls_path, config, tmp_path)
+    assert rows["cases"] == 20
+    assert rows["controls"] == 1000
+    # each stage of the metrics of match() is in a stage of the benchmarks, other
+    # than those of writing each output, which are within write_outputs
+    metrics = json.loads((tmp_path / "matching_metrics.json").read_text())["stages"]
+    benchmarked = {name for names in STAGE_METRICS.values() for name in names}
+    assert {
+        name for name in metrics if not name.startswith("write_")
+    } - benchmarked == set()
+    assert "write_outputs" in metrics
+    assert timings["index"] == metrics["build_control_index"]["wall_seconds"]
+    assert timings["match"] == pytest.approx(
+        sum(
+            metrics[name]["wall_seconds"]
+            for name in ["case_exclusions", "sort_cases", "thinning", "matching"]
+        )
+    )
+
+
+def test_compare_results():
+    baseline = {"stages": {stage: {"min": 1.0} for stage in STAGES}}
+    current = {"stages": {stage: {"min": 1.05} for stage in STAGES}}
+    current["stages"]["match"]["min"] = 1.5
+    comparison, regressions = compare_results(baseline, current)
+    assert regressions == ["match"]
+    assert comparison.set_index("stage").loc["match", "ratio"] == 1.5
+    _, regressions = compare_results(baseline, current, threshold=0.01)
+    assert regressions == STAGES
+
+
+def test_main(tmp_path, capsys):
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "generate_match_index_date": "no_offset",
+        "drop_cases_from_matches": True,
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    # the baseline is run with the default config
+    for name, config_args in [
+        ("baseline", []),
+        ("current", ["--config-file", str(tmp_path / "config.json")]),
+    ]:
+        exit_code = main(
+            [
+                "run",
+                "--controls",
+                "500",
+                "--controls-per-case",
+                "25",
+                "--regions",
+                "2",
+                "--repeat",
+                "1",
+                *config_args,
+                "--data-path",
+                str(tmp_path / "data"),
+                "--output",
+                str(tmp_path / f"{name}.json"),
+            ]
+        )
+        assert exit_code == 0
+    baseline = json.loads((tmp_path / "baseline.json").read_text())
+    assert baseline["config"]["matches_per_case"] == 3
+    results = json.loads((tmp_path / "current.json").read_text())
+    assert results["config"]["matches_per_case"] == 1
+    assert results["cohort"]["num_regions"] == 2
+
+    # a large threshold, so that differences in timings aren't regressions
+    args = [str(tmp_path / "baseline.json"), str(tmp_path / "current.json")]
+    assert main(["compare", *args, "--threshold", "1000"]) == 0
+    results["stages"]["index"]["min"] = baseline["stages"]["index"]["min"] * 2000
+    (tmp_path / "current.json").write_text(json.dumps(results))
+    assert main(["compare", *args, "--threshold", "1000"]) == 1
+    assert "Slower than the baseline: index" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("args", [[], ["unknown"]])
+def test_main_usage(capsys, args):
+    assert main(args) == 2
+    assert (
+        "Usage: python -m benchmarks {run,compare,differential}"
+        in capsys.readouterr().out
+    )
@@ -0,0 +1,151 @@
+import os
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from osmatching import cache
+from osmatching.osmatching import import_dataframe, match
+from osmatching.utils import MatchConfig, load_dataframe, parse_and_validate_config
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+
+def get_config(tmp_path, **kwargs):
+    config, _ = parse_and_validate_config(
+        MatchConfig(
+            matches_per_case=3,
+            match_variables={"sex": "category", "age": 5, "indexdate": "month_only"},
+            closest_match_variables=["age"],
+            index_date_variable="indexdate",
+            date_exclusion_variables={"died_date_ons": "before"},
+            output_path=tmp_path / "output",
+            control_cache_path=str(tmp_path / "cache"),
+            **kwargs,
+        )
+    )
+    return config
+
+
+@pytest.mark.parametrize("suffix", ["csv", "csv.gz", "arrow"])
+def test_load_cached_controls(tmp_path, suffix):
+    controls_path = FIXTURE_PATH / f"input_controls.{suffix}"
+    expected = import_dataframe(load_dataframe(controls_path), get_config(tmp_path))
+
+    # first load imports the data and caches it
+    controls = cache.load_cached_controls(controls_path, None, get_config(tmp_path))
+    pd.testing.assert_frame_equal(controls, expected)
+    assert len(list((tmp_path / "cache").glob("*.arrow"))) == 1
+
+    # second load reads from the cache
+    cached = cache.load_cached_controls(controls_path, None, get_config(tmp_path))
+    pd.testing.assert_frame_equal(cached, expected)
+    assert len(list((tmp_path / "cache").glob("*.arrow"))) == 1
+    # numeric columns are views of the memory-mapped cache file
+    assert not cached["age"].to_numpy().flags.writeable
+
+    # and it is not imported again
+    config = get_config(tmp_path)
+    assert import_dataframe(cached, config) is cached
+
+
+def test_cache_key(tmp_path):
+    controls_path = FIXTURE_PATH / "input_controls.csv"
+    key = cache.get_cache_key(controls_path, None, get_config(tmp_path))
+    assert key == cache.get_cache_key(controls_path, None, get_config(tmp_path))
+    # Changes to the file contents, loaded columns or import config change the key
+    other_path = tmp_path / "input_controls.csv"
+    other_path.write_text(controls_path.read_text() + "1001,male,30,,,,\n")
+    assert key != cache.get_cache_key(other_path, None, get_config(tmp_path))
+    assert key != cache.get_cache_key(
+        controls_path, ["patient_id", "sex"], get_config(tmp_path)
+    )
+    config = get_config(tmp_path)
+    config.date_exclusion_variables = {}
+    assert key != cache.get_cache_key(controls_path, None, config)
+    # Other config doesn't
+    assert key == cache.get_cache_key(
+        controls_path, None, get_config(tmp_path, output_suffix="_other")
+    )
+
+
+def test_file_digest_is_saved(tmp_path, monkeypatch):
+    hashed = []
+    monkeypatch.setattr(
+        cache, "file_digest", lambda file_path: hashed.append(file_path) or "digest"
+    )
+    controls_path = tmp_path / "input_controls.csv"
+    controls_path.write_text((FIXTURE_PATH / "input_controls.csv").read_text())
+    cache_path = tmp_path / "cache"
+
+    # the file is hashed once, and not again while its size and mtime are unchanged
+    assert cache.get_file_digest(cache_path, controls_path) == "digest"
+    assert cache.get_file_digest(cache_path, controls_path) == "digest"
+    assert hashed == [controls_path]
+
+    # the file is hashed again when it changes
+    os.utime(controls_path, ns=(0, 0))
+    cache.get_file_digest(cache_path, controls_path)
+    assert hashed == [controls_path, controls_path]
+
+    # and when the saved digest can't be read
+    cache.get_digest_path(cache_path, controls_path).write_text("not json")
+    cache.get_file_digest(cache_path, controls_path)
+    assert len(hashed) == 3
+
+
+def test_match_with_cached_controls(tmp_path):
+    controls_path = FIXTURE_PATH / "input_controls.arrow"
+    expected_cases, expected_matches = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(controls_path),
+        get_config(tmp_path),
+    )
+    for _ in range(2):
+        config = get_config(tmp_path)
+        matched_cases, matched_matches = match(
+            load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+            cache.load_cached_controls(controls_path, None, config),
+            config,
+        )
+        pd.testing.assert_frame_equal(matched_cases, expected_cases)
+        pd.testing.assert_frame_equal(matched_matches, expected_matches)
+
+
+def test_cache_eviction(tmp_path):
+    cache_path = tmp_path / "cache"
+    cache_path.mkdir()
+    for i, name in enumerate(["oldest", "old", "recent"]):
+        path = cache_path / f"{name}.arrow"
+        path.write_bytes(b"x" * 1024 * 1024)
+        os.utime(path, (i, i))
+
+    config = get_config(tmp_path, control_cache_max_size_mb=2)
+    cache.load_cached_controls(FIXTURE_PATH / "input_controls.arrow", None, config)
+
+    # the least recently used files are removed, to keep the cache under 2MB
+    remaining = sorted(path.name for path in cache_path.glob("*.arrow"))
+    assert len(remaining) == 2
+    assert "recent.arrow" in remaining
+
+    # the new cache file is kept, even if it exceeds the maximum size
+    config = get_config(tmp_path, control_cache_max_size_mb=0)
+    cache.load_cached_controls(FIXTURE_PATH / "input_controls.csv", None, config)
+    assert len(list(cache_path.glob("*.arrow"))) == 1
+
+
+def test_cache_eviction_of_removed_files(tmp_path):
+    cache_path = tmp_path / "cache"
+    cache_path.mkdir()
+    (cache_path / "old.arrow").write_bytes(b"x" * 1024 * 1024)
+    os.utime(cache_path / "old.arrow", (0, 0))
+    # a file that another run removed after it was listed
+    (cache_path / "removed.arrow").symlink_to(tmp_path / "missing.arrow")
+
+    config = get_config(tmp_path, control_cache_max_size_mb=0)
+    cache.load_cached_controls(FIXTURE_PATH / "input_controls.arrow", None, config)
+    remaining = sorted(path.name for path in cache_path.glob("*.arrow"))
+    assert len(remaining) == 2
+    assert "removed.arrow" in remaining
+    assert "old.arrow" not in remaining
@@ -0,0 +1,195 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from osmatching import osmatching
+from osmatching.checkpoint import Checkpoint
+from osmatching.osmatching import match
+from osmatching.utils import MatchConfig, load_dataframe
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+CONFIGS = [
+    {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 5},
+        "closest_match_variables": ["age"],
+        "date_exclusion_variables": {
+            "died_date_ons": "before",
+            "previous_event": "after",
+        },
+    },
+    {
+        "matches_per_case": 1,
+        "min_matches_per_case": 1,
+        "match_variables": {"region": "category", "age": 0},
+        "tiers": [{"age": 0}, {"age": 3}],
+        "generate_match_index_date": "1_year_earlier",
+        "drop_cases_from_matches": True,
+    },
+]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def get_config(tmp_path, **kwargs):
+    return MatchConfig(
+        **{"index_date_variable": "indexdate", "output_path": tmp_path, **kwargs}
+    )
+
+
+def run_match(output_path, config):
+    return match(
+        load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        load_dataframe(FIXTURE_PATH / "input_controls.csv"),
+        get_config(output_path, **config),
+    )
+
+
+def interrupt_after(monkeypatch, num_cases):
+    """Makes matching fail when picking the matches of case num_cases + 1"""
+    pick_matches = osmatching.greedily_pick_matches
+    picked = []
+
+    def interrupted_pick_matches(*args):
+        if len(picked) == num_cases:
+            raise Interrupted()
+        picked.append(True)
+        return pick_matches(*args)
+
+    monkeypatch.setattr(osmatching, "greedily_pick_matches", interrupted_pick_matches)
+
+
+@pytest.mark.parametrize(
+    "config,num_cases,checkpoint",
+    [
+        (CONFIGS[0], 0, None),
+        (CONFIGS[0], 3, None),
+        (CONFIGS[0], 4, ["Cases    4"]),
+        (CONFIGS[0], 9, ["Cases    8"]),
+        # the 20 cases are matched in the first tier, and 8 in the second
+        (CONFIGS[1], 13, ["Tier     1", "Cases    12"]),
+        (CONFIGS[1], 20, ["Tier     1", "Cases    20"]),
+        (CONFIGS[1], 23, ["Tier     1", "Cases    20"]),
+        (CONFIGS[1], 27, ["Tier     2", "Cases    4"]),
+        (
+            {**CONFIGS[1], "generate_match_index_date": ""},
+            23,
+            ["Tier     1", "Cases    20"],
+        ),
+    ],
+)
+def test_resume(tmp_path, monkeypatch, capsys, config, num_cases, checkpoint):
+    expected = run_match(tmp_path / "uninterrupted", config)
+
+    config = {**config, "checkpoint_interval": 4}
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, num_cases)
+        with pytest.raises(Interrupted):
+            run_match(tmp_path, config)
+    checkpoint_path = tmp_path / ".checkpoint.npz"
+    assert checkpoint_path.exists() == (checkpoint is not None)
+
+    capsys.readouterr()
+    resumed = run_match(tmp_path, {**config, "resume": True})
+    for expected_df, resumed_df in zip(expected, resumed):
+        pd.testing.assert_frame_equal(resumed_df, expected_df)
+    for name in ["matched_cases", "matched_matches", "matched_combined"]:
+        assert (tmp_path / f"{name}.arrow").read_bytes() == (
+            tmp_path / "uninterrupted" / f"{name}.arrow"
+        ).read_bytes()
+    assert not checkpoint_path.exists()
+
+    output = capsys.readouterr().out
+    resumed_report = output[output.index("Resuming from checkpoint:") :].split("\n\n")[
+        0
+    ]
+    if checkpoint is None:
+        assert "No checkpoint of this run found" in resumed_report
+    else:
+        assert resumed_report.splitlines()[2:] == checkpoint
+
+
+def test_resume_after_matching(tmp_path, monkeypatch):
+    # matching is interrupted while writing the outputs, after the last checkpoint
+    config = {**CONFIGS[1], "checkpoint_interval": 1000}
+    expected = run_match(tmp_path / "uninterrupted", config)
+
+    def interrupted_write(*args):
+        raise Interrupted()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(osmatching, "write_matching_results", interrupted_write)
+        with pytest.raises(Interrupted):
+            run_match(tmp_path, config)
+    with np.load(tmp_path / ".checkpoint.npz") as checkpoint:
+        # the last tier
+        assert checkpoint["stage"] == 2
+
+    with monkeypatch.context() as patch:
+        # no cases are matched again
+        interrupt_after(patch, 0)
+        resumed = run_match(tmp_path, {**config, "resume": True})
+    for expected_df, resumed_df in zip(expected, resumed):
+        pd.testing.assert_frame_equal(resumed_df, expected_df)
+
+
+def test_resume_with_different_config(tmp_path, monkeypatch, capsys):
+    config = {**CONFIGS[0], "checkpoint_interval": 5}
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 8)
+        with pytest.raises(Interrupted):
+            run_match(tmp_path, config)
+
+    # the checkpoint is not used with a different config
+    changed_config = {**config, "matches_per_case": 2, "resume": True}
+    expected = run_match(tmp_path / "uninterrupted", changed_config)
+    capsys.readouterr()
+    resumed = run_match(tmp_path, changed_config)
+    assert "No checkpoint of this run found" in capsys.readouterr().out
+    for expected_df, resumed_df in zip(expected, resumed):
+        pd.testing.assert_frame_equal(resumed_df, expected_df)
+
+
+def test_checkpoint_without_resume(tmp_path, monkeypatch):
+    # without resume, an existing checkpoint is ignored, and replaced
+    config = {**CONFIGS[0], "checkpoint_interval": 5}
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 8)
+        with pytest.raises(Interrupted):
+            run_match(tmp_path, config)
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 7)
+        with pytest.raises(Interrupted):
+            run_match(tmp_path, config)
+    with np.load(tmp_path / ".checkpoint.npz") as checkpoint:
+        assert checkpoint["position"] == 5
+
+
+def test_checkpoint_file(tmp_path):
+    checkpoint = Checkpoint(tmp_path / ".checkpoint.npz", "key", interval=2)
+    assert not checkpoint.resume()
+    checkpoint.context = {"tier_set_ids": np.array([1, 2])}
+    checkpoint.update(1, 3, {"set_ids": np.array([3, 4])})
+    assert not checkpoint.path.exists()
+    checkpoint.update(1, 4, {"set_ids": np.array([3, 4])})
+
+    loaded = Checkpoint(checkpoint.path, "key", interval=2)
+    assert loaded.resume()
+    assert loaded.get_state(0) is None
+    state = loaded.get_state(1)
+    assert state is not None
+    assert state["position"] == 4
+    np.testing.assert_array_equal(state["tier_set_ids"], [1, 2])
+    np.testing.assert_array_equal(state["set_ids"], [3, 4])
+    # only the checkpoint file is left
+    assert list(tmp_path.iterdir()) == [checkpoint.path]
+
+    assert not Checkpoint(checkpoint.path, "other key", interval=2).resume()
+    checkpoint.remove()
+    assert not checkpoint.path.exists()
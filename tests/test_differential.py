@@ -0,0 +1,346 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks import differential
+from benchmarks.cohort import CohortSpec
+from benchmarks.differential import (
+    DIFFERENTIAL_CONFIGS,
+    Divergence,
+    find_divergence,
+    get_bool_index,
+    get_eligible_matches,
+    import_reference_data,
+    pre_calculate_indices,
+    reference_engine,
+    run_differential,
+)
+from benchmarks.run import main
+from osmatching import partition
+from osmatching.osmatching import NOT_PREVIOUSLY_MATCHED
+from osmatching.utils import MatchConfig, load_dataframe
+
+
+SPEC = CohortSpec(num_controls=2000, controls_per_case=20, num_regions=3)
+
+
+def test_run_differential_partitioned(tmp_path, monkeypatch):
+    # the controls are split into several partitions
+    monkeypatch.setattr(partition, "BYTES_PER_MB", 20_000)
+    divergences = run_differential(
+        SPEC, tmp_path / "data", tmp_path / "output", differential.partitioned_engine
+    )
+    assert divergences == {name: None for name in DIFFERENTIAL_CONFIGS}
+    # every config matches some of the cases
+    for name in DIFFERENTIAL_CONFIGS:
+        matches = load_dataframe(
+            tmp_path / "output" / name / "reference" / "matched_matches.arrow"
+        )
+        assert len(matches) > 0, name
+        combined = load_dataframe(
+            tmp_path / "output" / name / "reference" / "matched_combined.arrow"
+        )
+        assert combined.index.equals(
+            load_dataframe(
+                tmp_path / "output" / name / "reference" / "matched_cases.arrow"
+            ).index.append(matches.index)
+        ), name
+    # the controls are only changed for the configs that need it
+    cohort_path = next((tmp_path / "data").iterdir())
+    assert sorted(path.name for path in cohort_path.iterdir()) == [
+        "cases.arrow",
+        "controls.arrow",
+        "controls_with_index_dates.arrow",
+        "controls_with_index_dates_with_cases.arrow",
+    ]
+    # both changes are made to the controls of drop_cases_from_matches
+    controls = load_dataframe(cohort_path / "controls.arrow")
+    cases = load_dataframe(cohort_path / "cases.arrow")
+    controls_with_cases = load_dataframe(
+        cohort_path / "controls_with_index_dates_with_cases.arrow"
+    )
+    assert len(controls_with_cases) == len(controls) + len(cases)
+    assert controls_with_cases["indexdate"].notna().all()
+    assert (
+        controls_with_cases["indexdate"]
+        .iloc[len(controls) :]
+        .equals(cases["indexdate"])
+    )
+
+
+def test_run_differential_arrow(tmp_path):
+    divergences = run_differential(
+        SPEC, tmp_path / "data", tmp_path / "output", differential.arrow_engine
+    )
+    assert divergences == {name: None for name in DIFFERENTIAL_CONFIGS}
+
+
+def swap_set_ids(cases_path, controls_path, config):
+    matched_cases, matched_matches = reference_engine(cases_path, controls_path, config)
+    set_ids = matched_matches["set_id"].to_numpy().copy()
+    set_ids[[2, 3]] = set_ids[[3, 2]]
+    return matched_cases, matched_matches.assign(set_id=set_ids)
+
+
+def test_run_differential_reports_first_divergence(tmp_path):
+    divergences = run_differential(
+        SPEC,
+        tmp_path / "data",
+        tmp_path / "output",
+        swap_set_ids,
+        {"category_scalar": DIFFERENTIAL_CONFIGS["category_scalar"]},
+    )
+    divergence = divergences["category_scalar"]
+    assert divergence is not None
+    matches = load_dataframe(
+        tmp_path / "output" / "category_scalar" / "reference" / "matched_matches.arrow"
+    )
+    expected_set_ids = matches["set_id"].to_numpy()
+    assert expected_set_ids[2] != expected_set_ids[3]
+    assert divergence == Divergence(
+        "matched_matches",
+        2,
+        matches.index[2],
+        "set_id",
+        expected_set_ids[2],
+        expected_set_ids[3],
+    )
+    assert str(divergence) == (
+        f"matched_matches: row 2 (patient_id {matches.index[2]}), column `set_id` "
+        f"differs; expected {expected_set_ids[2]!r}, got {expected_set_ids[3]!r}"
+    )
+
+
+def test_import_reference_data():
+    # as from a csv file, without categories, and without index dates of the matches
+    cases = pd.DataFrame(
+        {"sex": ["F", "M"], "indexdate": ["2020-01-15", "2020-03-01"]},
+        index=pd.Index([1, 2], name="patient_id"),
+    )
+    matches = pd.DataFrame({"sex": ["M"]}, index=pd.Index([3], name="patient_id"))
+    config = MatchConfig.from_dict(
+        {
+            "matches_per_case": 1,
+            "match_variables": {"sex": "category", "indexdate": "month_only"},
+            "index_date_variable": "indexdate",
+        }
+    )
+    cases, matches = import_reference_data(cases, matches, config)
+    assert config.match_variables == {"sex": "category", "indexdate_m": "category"}
+    assert cases["sex"].dtype.name == matches["sex"].dtype.name == "category"
+    assert list(cases["indexdate_m"]) == ["01", "03"]
+    assert cases["indexdate"].dtype.kind == "M"
+    assert matches["indexdate"].isna().all()
+
+
+def test_categorical_get_bool_index():
+    """
+    Runs get_eligible_matches on synthetic categorical data and compares the test_data
+    with manually entered boolean Series.
+    """
+    match_type = "category"
+    value = "F"
+    match_var = "sex"
+    matches = pd.DataFrame.from_records(
+        [["F"], ["M"], ["F"], ["M"], ["F"]], columns=["sex"]
+    )
+
+    bool_index = get_bool_index(match_type, value, match_var, matches)
+
+    assert bool_index.equals(pd.Series([True, False, True, False, True]))
+
+
+def test_scalar_get_bool_index():
+    """
+    Runs get_eligible_matches on synthetic integer data and compares the test_data
+    with manually entered boolean Series.
+    """
+    match_type = 5
+    value = 36
+    match_var = "age"
+    matches = pd.DataFrame.from_records([[30], [36], [39], [61], [75]], columns=["age"])
+
+    bool_index = get_bool_index(match_type, value, match_var, matches)
+
+    assert bool_index.equals(pd.Series([False, True, True, False, False]))
+
+
+def test_pre_calculate_indices():
+    """
+    Test that the test_data booleans match with a predetermined series for a simple
+    categorical variable with 2 categories. (other comparison types are tested in
+    get_bool_index)
+    """
+    cases = pd.DataFrame.from_records([["F"], ["M"]], columns=["sex"])
+    matches = pd.DataFrame.from_records(
+        [["F"], ["M"], ["F"], ["M"], ["F"]], columns=["sex"]
+    )
+    match_variables = {"sex": "category"}
+
+    indices_dict = pre_calculate_indices(cases, matches, match_variables)
+
+    assert indices_dict["sex"]["F"].equals(pd.Series([True, False, True, False, True]))
+    assert indices_dict["sex"]["M"].equals(pd.Series([False, True, False, True, False]))
+
+
+def test_get_eligible_matches():
+    """
+    Runs get_eligible_matches on synthetic data and compares the test_data with
+    manually entered boolean Series.
+    """
+    cases = pd.DataFrame.from_records(
+        [
+            {"sex": "M", "age": 36},
+        ]
+    )
+    case_row = cases.iloc[0]
+    matches = pd.DataFrame.from_records(
+        [
+            {"sex": "M", "age": 37, "set_id": NOT_PREVIOUSLY_MATCHED},
+            {"sex": "M", "age": 57, "set_id": NOT_PREVIOUSLY_MATCHED},
+            {"sex": "F", "age": 32, "set_id": NOT_PREVIOUSLY_MATCHED},
+            {"sex": "F", "age": 81, "set_id": NOT_PREVIOUSLY_MATCHED},
+            {"sex": "M", "age": 37, "set_id": 1},
+        ]
+    )
+    match_variables = {"sex": "category", "age": 5}
+    indices = {
+        "sex": {"M": pd.Series([True, True, False, False, True])},
+        "age": {36: pd.Series([True, False, True, False, True])},
+    }
+
+    eligible_matches = get_eligible_matches(case_row, matches, match_variables, indices)
+
+    assert eligible_matches.equals(pd.Series([True, False, False, False, False]))
+
+
+@pytest.fixture
+def expected():
+    return pd.DataFrame(
+        {
+            "sex": pd.Categorical(["F", "M", "F"]),
+            "age": [20.0, np.nan, 30.0],
+            "indexdate": pd.to_datetime(["2020-01-01", None, "2020-03-01"]),
+        },
+        index=pd.Index([1, 2, 3], name="patient_id"),
+    )
+
+
+def test_find_divergence_same(expected):
+    # missing values are equal, and categories are compared by their values
+    actual = expected.copy()
+    actual["sex"] = actual["sex"].cat.set_categories(["M", "F"])
+    assert find_divergence("matched_cases", expected, actual) is None
+
+
+@pytest.mark.parametrize(
+    "change,divergence,message",
+    [
+        (
+            lambda df: df.drop(columns="age"),
+            ("age", ["sex", "age", "indexdate"], ["sex", "indexdate"]),
+            "matched_cases: column `age` differs; expected ['sex', 'age', "
+            "'indexdate'], got ['sex', 'indexdate']",
+        ),
+        (
+            lambda df: df.assign(extra=1),
+            (
+                "extra",
+                ["sex", "age", "indexdate"],
+                ["sex", "age", "indexdate", "extra"],
+            ),
+            None,
+        ),
+        (
+            lambda df: df.assign(age=df["age"].astype("float32")),
+            ("age", "float64", "float32"),
+            "matched_cases: column `age` differs; expected 'float64', got 'float32'",
+        ),
+    ],
+)
+def test_find_divergence_columns(expected, change, divergence, message):
+    column, expected_value, actual_value = divergence
+    result = find_divergence("matched_cases", expected, change(expected.copy()))
+    assert result == Divergence(
+        "matched_cases", None, None, column, expected_value, actual_value
+    )
+    if message:
+        assert str(result) == message
+
+
+def test_find_divergence_rows(expected):
+    actual = expected.copy()
+    actual.loc[3, "age"] = np.nan
+    divergence = find_divergence("matched_cases", expected, actual)
+    assert divergence is not None
+    assert (divergence.row, divergence.patient_id, divergence.column) == (2, 3, "age")
+    assert divergence.expected == 30.0
+    assert np.isnan(divergence.actual)
+
+    # the patient id is compared first
+    actual = expected.rename(index={2: 4})
+    actual.loc[4, "age"] = 1.0
+    assert find_divergence("matched_cases", expected, actual) == Divergence(
+        "matched_cases", 1, 2, "patient_id", 2, 4
+    )
+
+    divergence = find_divergence("matched_cases", expected, expected.iloc[:2])
+    assert divergence == Divergence("matched_cases", 2, 3, None, "a row", "no row")
+    assert str(divergence) == (
+        "matched_cases: row 2 (patient_id 3) differs; expected 'a row', got 'no row'"
+    )
+    assert find_divergence("matched_cases", expected.iloc[:1], expected) == (
+        Divergence("matched_cases", 1, 2, None, "no row", "a row")
+    )
+
+
+def test_main_differential(tmp_path, monkeypatch, capsys):
+    args = [
+        "differential",
+        "--controls",
+        str(SPEC.num_controls),
+        "--controls-per-case",
+        str(SPEC.controls_per_case),
+        "--regions",
+        str(SPEC.num_regions),
+        "--configs",
+        "month_only",
+        "drop_cases_from_matches",
+        "--data-path",
+        str(tmp_path / "data"),
+        "--output-path",
+        str(tmp_path / "output"),
+    ]
+    assert main([*args, "--engine", "match"]) == 0
+    output = capsys.readouterr().out
+    assert "month_only               same\ndrop_cases_from_matches  same\n" in output
+    # the matching reports are written, but not printed
+    assert "After matching" not in output
+    assert (
+        tmp_path / "output" / "month_only" / "engine" / "matching_report.txt"
+    ).exists()
+    assert sorted(path.name for path in (tmp_path / "output").iterdir()) == [
+        "drop_cases_from_matches",
+        "month_only",
+    ]
+
+    # the cohort and the controls of each config are reused
+    monkeypatch.setitem(differential.ENGINES, "partitioned", swap_set_ids)
+    assert main([*args, "--engine", "partitioned"]) == 1
+    output = capsys.readouterr().out
+    assert "month_only               matched_matches: row 2" in output
+    assert (
+        "partitioned differs from the reference: month_only, drop_cases_from_matches"
+        in output
+    )
+
+    # by default, all the configs are compared
+    monkeypatch.setattr(
+        differential,
+        "DIFFERENTIAL_CONFIGS",
+        {"tiers": DIFFERENTIAL_CONFIGS["tiers"]},
+    )
+    configs_start = args.index("--configs")
+    default_args = args[:configs_start] + args[configs_start + 3 :]
+    assert main([*default_args, "--engine", "reference"]) == 0
+    assert "tiers                    same\n" in capsys.readouterr().out
@@ -0,0 +1,197 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from osmatching import dry_run as dry_run_module
+from osmatching.dry_run import dry_run
+from osmatching.index import build_control_index
+from osmatching.osmatching import import_dataframe, match
+from osmatching.utils import MatchConfig, load_dataframe, parse_and_validate_config
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+
+def load_fixtures():
+    return (
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+    )
+
+
+@pytest.mark.parametrize(
+    "config,expected_matched,expected_exhausted",
+    [
+        (
+            {
+                "matches_per_case": 3,
+                "match_variables": {"sex": "category", "age": 5},
+                "closest_match_variables": ["age"],
+                "date_exclusion_variables": {"died_date_ons": "before"},
+                "generate_match_index_date": "no_offset",
+            },
+            10,
+            0,
+        ),
+        (
+            {
+                "matches_per_case": 20,
+                "match_variables": {"sex": "category", "region": "category", "age": 2},
+            },
+            0,
+            4,
+        ),
+        # without category or scalar match variables
+        ({"matches_per_case": 5, "match_variables": {"age": 1}}, 19, 0),
+        ({"matches_per_case": 60, "match_variables": {"sex": "category"}}, 13, 3),
+    ],
+)
+def test_dry_run_estimates_matching(
+    tmp_path, config, expected_matched, expected_exhausted
+):
+    estimate = dry_run(
+        *load_fixtures(),
+        MatchConfig(index_date_variable="indexdate", output_path=tmp_path, **config),
+    )
+    assert estimate.expected_matched == expected_matched
+    assert len(estimate.exhausted) == expected_exhausted
+    assert estimate.seconds_per_case > 0
+    report = (tmp_path / "dry_run.txt").read_text()
+    assert f"Strata likely to be exhausted  {expected_exhausted}\n" in report
+    assert "Estimated matching time        0:00:00" in report
+
+    # the estimates are close to the results of matching; date exclusions are only
+    # applied approximately
+    matched_cases, _ = match(
+        *load_fixtures(),
+        MatchConfig(index_date_variable="indexdate", output_path=tmp_path, **config),
+    )
+    fully_matched = (matched_cases["match_counts"] >= config["matches_per_case"]).sum()
+    assert abs(estimate.expected_matched - fully_matched) <= 1
+    assert estimate.num_cases == len(matched_cases)
+
+
+def test_dry_run_exhausted_strata(tmp_path, monkeypatch):
+    monkeypatch.setattr(dry_run_module, "DRY_RUN_REPORT_STRATA", 2)
+    estimate = dry_run(
+        *load_fixtures(),
+        MatchConfig(
+            matches_per_case=20,
+            match_variables={"sex": "category", "region": "category", "age": 2},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+            output_suffix="_test",
+        ),
+    )
+    # strata are ordered by shortfall, the difference between demand and supply
+    shortfall = estimate.exhausted["demand"] - estimate.exhausted["supply"]
+    assert shortfall.is_monotonic_decreasing
+    assert (shortfall > 0).all()
+    report = (tmp_path / "dry_run_test.txt").read_text()
+    assert "Strata likely to be exhausted (by shortfall):" in report
+    assert "... and 2 more" in report
+
+
+def test_dry_run_with_thinning_and_tiers(tmp_path):
+    config = {
+        "matches_per_case": 2,
+        "min_matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 0},
+        "index_date_variable": "indexdate",
+        "date_exclusion_variables": {"died_date_ons": "before"},
+        "generate_match_index_date": "1_year_earlier",
+        "output_path": tmp_path,
+    }
+    tiers = dry_run(
+        *load_fixtures(), MatchConfig(**config, tiers=[{"age": 0}, {"age": 10}])
+    )
+    # the ranges of the last tier are used
+    last_tier = dry_run(
+        *load_fixtures(),
+        MatchConfig(**{**config, "match_variables": {"sex": "category", "age": 10}}),
+    )
+    pd.testing.assert_frame_equal(tiers.strata, last_tier.strata)
+    assert (
+        tiers.expected_matched
+        > dry_run(*load_fixtures(), MatchConfig(**config)).expected_matched
+    )
+
+    thinned = dry_run(
+        *load_fixtures(),
+        MatchConfig(**config, control_pool_multiple=1, drop_cases_from_matches=True),
+    )
+    assert (thinned.strata["supply"] <= thinned.strata["demand"]).all()
+
+
+def test_dry_run_without_cases(tmp_path):
+    cases, controls = load_fixtures()
+    estimate = dry_run(
+        cases.iloc[:0],
+        controls,
+        MatchConfig(
+            matches_per_case=1,
+            match_variables={"sex": "category"},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+        ),
+    )
+    assert estimate.num_cases == 0
+    assert estimate.seconds_per_case == 0
+    assert np.isnan(estimate.match_rate)
+
+
+def test_dry_run_with_control_index(tmp_path):
+    config, _ = parse_and_validate_config(
+        MatchConfig(
+            matches_per_case=2,
+            match_variables={"sex": "category", "age": 2},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+        )
+    )
+    cases, controls = load_fixtures()
+    control_index = build_control_index(
+        import_dataframe(controls.copy(), config), config
+    )
+    estimate = dry_run(cases, controls, config, control_index=control_index)
+    expected = dry_run(
+        *load_fixtures(),
+        MatchConfig(
+            matches_per_case=2,
+            match_variables={"sex": "category", "age": 2},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+        ),
+    )
+    pd.testing.assert_frame_equal(estimate.strata, expected.strata)
+
+
+def test_count_candidates_with_missing_values(tmp_path):
+    config, _ = parse_and_validate_config(
+        MatchConfig(
+            matches_per_case=2,
+            match_variables={"age": 2},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+        )
+    )
+    cases, controls = load_fixtures()
+    controls.loc[controls.index[:3], "age"] = np.nan
+    control_index = build_control_index(import_dataframe(controls, config), config)
+    stratum_cases = pd.DataFrame({"age": [np.nan, 40.0, 1000.0]})
+    candidates = dry_run_module.count_candidates(
+        stratum_cases,
+        np.arange(len(controls)),
+        control_index,
+        config.match_variables,
+    )
+    # missing values never match, including those of the controls
+    expected = (controls["age"] - 40).abs().le(2).sum()
+    assert list(candidates) == [0, expected, 0]
+
+
+def test_dry_run_with_config_errors(tmp_path):
+    with pytest.raises(ValueError, match="error in one or more config values"):
+        dry_run(*load_fixtures(), MatchConfig(output_path=tmp_path))
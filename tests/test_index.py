@@ -0,0 +1,226 @@
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.differential import get_eligible_matches, pre_calculate_indices
+from osmatching import index
+from osmatching.osmatching import add_variables, date_exclusions, import_data, match
+from osmatching.utils import (
+    MatchConfig,
+    file_digest,
+    file_stamp,
+    load_dataframe,
+    parse_and_validate_config,
+)
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+
+def get_config(tmp_path, **kwargs):
+    config_kwargs = {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 5, "indexdate": "month_only"},
+        "closest_match_variables": ["age"],
+        "index_date_variable": "indexdate",
+        "date_exclusion_variables": {
+            "died_date_ons": "before",
+            "previous_event": "after",
+        },
+        "output_path": tmp_path / "output",
+        **kwargs,
+    }
+    config, _ = parse_and_validate_config(MatchConfig(**config_kwargs))
+    return config
+
+
+def load_imported_data(config):
+    cases, matches = import_data(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        config,
+    )
+    return add_variables(cases, matches, config.indicator_variable_name)
+
+
+@pytest.mark.parametrize(
+    "match_variables,date_exclusion_variables",
+    [
+        ({"sex": "category", "age": 5, "indexdate": "month_only"}, {}),
+        ({"sex": "category", "region": "category"}, {"died_date_ons": "before"}),
+        ({"age": 2}, {"previous_event": "after"}),
+        ({"age": 10, "sex": "category"}, {"died_date_ons": "before"}),
+    ],
+)
+def test_get_candidates(tmp_path, match_variables, date_exclusion_variables):
+    config = get_config(
+        tmp_path,
+        match_variables=match_variables,
+        date_exclusion_variables=date_exclusion_variables,
+    )
+    cases, matches = load_imported_data(config)
+    control_index = index.build_control_index(matches, config)
+    indices = pre_calculate_indices(cases, matches, config.match_variables)
+
+    for _, case_row in cases.iterrows():
+        expected = matches.index[
+            get_eligible_matches(case_row, matches, config.match_variables, indices)
+        ]
+        candidates = control_index.get_candidates(case_row, config.match_variables)
+        assert list(matches.index[candidates]) == list(expected)
+
+        for index_date in [None, case_row["indexdate"]]:
+            if index_date is None:
+                index_dates = matches.loc[expected, "indexdate"]
+            else:
+                index_dates = index_date
+            expected_exclusions = date_exclusions(
+                matches.loc[expected], date_exclusion_variables, index_dates
+            )
+            exclusions = control_index.get_exclusions(candidates, index_date)
+            assert list(exclusions) == list(expected_exclusions)
+
+
+def test_get_candidates_with_missing_values(tmp_path):
+    config = get_config(
+        tmp_path,
+        match_variables={"sex": "category", "age": 5},
+        date_exclusion_variables={},
+    )
+    matches = pd.DataFrame(
+        {
+            "sex": ["F", "F", None, "F", "M"],
+            "age": pd.array([20, None, 20, 22, 20], dtype="Int64"),
+            "indexdate": pd.to_datetime(["2020-01-01"] * 5),
+        },
+        index=pd.Index([1, 2, 3, 4, 5], name="patient_id"),
+    )
+    control_index = index.build_control_index(matches, config)
+    # missing values in the controls never match
+    case_row = pd.Series({"sex": "F", "age": 21})
+    candidates = control_index.get_candidates(case_row, config.match_variables)
+    assert list(candidates) == [0, 3]
+    # nor do missing values in the cases
+    for case_row in [pd.Series({"sex": None, "age": 21}), pd.Series({"sex": "F"})]:
+        case_row = case_row.reindex(["sex", "age"])
+        candidates = control_index.get_candidates(case_row, config.match_variables)
+        assert len(candidates) == 0
+    # nor do unknown categories
+    case_row = pd.Series({"sex": "X", "age": 20})
+    assert len(control_index.get_candidates(case_row, config.match_variables)) == 0
+
+
+@pytest.mark.parametrize(
+    "match_variables,date_exclusion_variables",
+    [
+        ({"sex": "category", "age": 5, "indexdate": "month_only"}, {}),
+        ({"age": 5}, {"died_date_ons": "before", "previous_event": "after"}),
+        ({"sex": "category"}, {}),
+    ],
+)
+def test_write_and_read(tmp_path, match_variables, date_exclusion_variables):
+    config = get_config(
+        tmp_path,
+        match_variables=match_variables,
+        date_exclusion_variables=date_exclusion_variables,
+    )
+    _, matches = load_imported_data(config)
+    control_index = index.build_control_index(matches, config, "digest")
+    control_index.write(tmp_path / "controls.index")
+    read_index = index.ControlIndex.read(tmp_path / "controls.index")
+
+    assert read_index.key == control_index.key
+    assert read_index.source_digest == "digest"
+    assert read_index.strata.keys() == control_index.strata.keys()
+    for key, positions in control_index.strata.items():
+        assert np.array_equal(read_index.strata[key], positions)
+    for name in ["patient_ids", "stratum_ids", "index_dates"]:
+        assert np.array_equal(getattr(read_index, name), getattr(control_index, name))
+    for name in ["exclude_before", "exclude_after"]:
+        expected = getattr(control_index, name)
+        if expected is None:
+            assert getattr(read_index, name) is None
+        else:
+            assert np.array_equal(getattr(read_index, name), expected, equal_nan=True)
+    assert read_index.is_valid_for(matches, config)
+
+
+@pytest.mark.parametrize("drop_cases_from_matches", [False, True])
+def test_match_with_control_index(tmp_path, drop_cases_from_matches):
+    _, matches = load_imported_data(get_config(tmp_path))
+    control_index = index.build_control_index(matches, get_config(tmp_path))
+    expected = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        get_config(tmp_path, drop_cases_from_matches=drop_cases_from_matches),
+    )
+    matched = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        get_config(tmp_path, drop_cases_from_matches=drop_cases_from_matches),
+        control_index=control_index,
+    )
+    for expected_df, matched_df in zip(expected, matched):
+        pd.testing.assert_frame_equal(matched_df, expected_df)
+
+
+def test_control_index_is_valid_for(tmp_path):
+    config = get_config(tmp_path)
+    _, matches = load_imported_data(get_config(tmp_path))
+    control_index = index.build_control_index(matches, config)
+    assert control_index.is_valid_for(matches, config)
+    # not if built from different matches, or with different variables
+    assert not control_index.is_valid_for(matches.iloc[1:], config)
+    assert not control_index.is_valid_for(
+        matches, get_config(tmp_path, date_exclusion_variables={})
+    )
+    # scalar match ranges can change without rebuilding the index
+    assert control_index.is_valid_for(
+        matches,
+        get_config(
+            tmp_path,
+            match_variables={"sex": "category", "age": 2, "indexdate": "month_only"},
+        ),
+    )
+
+
+def test_load_control_index(tmp_path, capsys, monkeypatch):
+    controls_path = tmp_path / "input_controls.csv"
+    shutil.copy(FIXTURE_PATH / "input_controls.csv", controls_path)
+    config = get_config(tmp_path)
+    assert index.load_control_index(controls_path, config) is None
+
+    _, matches = load_imported_data(get_config(tmp_path))
+    control_index = index.build_control_index(
+        matches, config, file_digest(controls_path), file_stamp(controls_path)
+    )
+    control_index.write(index.get_index_path(controls_path))
+    assert (tmp_path / "input_controls.csv.index").exists()
+    loaded = index.load_control_index(controls_path, config)
+    assert loaded is not None and loaded.key == control_index.key
+    assert loaded.source_stamp == file_stamp(controls_path)
+
+    # the controls file is only hashed if its size or modification time changes
+    hashed = []
+    monkeypatch.setattr(
+        index, "file_digest", lambda path: hashed.append(path) or file_digest(path)
+    )
+    assert index.load_control_index(controls_path, config) is not None
+    assert hashed == []
+    os.utime(controls_path, (0, 0))
+    assert index.load_control_index(controls_path, config) is not None
+    assert hashed == [controls_path]
+
+    # an index built with different match variables is not used
+    other_config = get_config(tmp_path, match_variables={"sex": "category"})
+    assert index.load_control_index(controls_path, other_config) is None
+    assert "was built with a different config" in capsys.readouterr().out
+
+    # nor is an index of an older version of the controls file
+    controls_path.write_text(controls_path.read_text() + "1001,male,30,,,,\n")
+    assert index.load_control_index(controls_path, config) is None
+    assert "is out of date" in capsys.readouterr().out
@@ -1,10 +1,14 @@
 import json
+import shutil
 import sys
+import threading
 from argparse import ArgumentTypeError
 from pathlib import Path
 
+import pandas as pd
 import pytest
 
+from osmatching import utils
 from osmatching.__main__ import main
 
 
@@ -80,6 +84,61 @@ def test_cli_output_format(tmp_path, include_cli_arg):
     assert (tmp_path / "matched_cases.arrow").exists() == (not include_cli_arg)
 
 
+def test_resume(tmp_path, capsys):
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path),
+        "checkpoint_interval": 5,
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+        "--resume",
+    ]
+    main()
+    assert "Resuming from checkpoint:" in capsys.readouterr().out
+    assert (tmp_path / "matched_cases.arrow").exists()
+    assert not (tmp_path / ".checkpoint.npz").exists()
+
+
+def test_profile_and_loop_counters(tmp_path):
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path),
+        "output_suffix": "_test",
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+        "--profile",
+        "--loop-counters",
+    ]
+    main()
+    profile_path = tmp_path / "profiles_test"
+    assert (profile_path / "matching.prof").exists()
+    summary = (profile_path / "matching.txt").read_text()
+    assert "assign_matches" in summary
+    assert "Top allocations by line:" in summary
+    # the stages loaded once for each dataset are profiled as one stage
+    assert "Run 2:" in (profile_path / "load.txt").read_text()
+    report = (tmp_path / "matching_report_test.txt").read_text()
+    assert "Matching loop counters:" in report
+
+
 def test_input_file_does_not_exist():
     sys.argv = [
         "match",
@@ -213,6 +272,25 @@ Please correct these errors and try again
     )
 
 
+def test_config_validated_before_loading_data(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(
+        "osmatching.__main__.load_dataframe", lambda path: loaded.append(path)
+    )
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config",
+        json.dumps({"matches_per_case": 1}),
+    ]
+    with pytest.raises(SystemExit):
+        main()
+    assert loaded == []
+
+
 def test_input_data_validation_errors(capsys):
     sys.argv = [
         "match",
@@ -245,3 +323,629 @@ Errors were found in the provided input data:
 Please correct these errors and try again
 """
     )
+
+
+def test_check(tmp_path, capsys):
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path),
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv.gz"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+        "--check",
+    ]
+    main()
+    assert "The input data and configuration are valid" in capsys.readouterr().out
+    # no matching is run
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_check_column_type_errors(capsys):
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(
+            {
+                "matches_per_case": 1,
+                "index_date_variable": "indexdate",
+                "match_variables": {"sex": 5},
+            }
+        ),
+        "--check",
+    ]
+    with pytest.raises(ValueError):
+        main()
+
+    output = capsys.readouterr().out
+    assert (
+        output
+        == """
+Errors were found in the provided input data:
+
+  column_types
+  * column `sex` in cases dataset has type string; expected numeric values
+  * column `sex` in matches dataset has type dictionary<values=string, indices=int8, ordered=1>; expected numeric values
+
+Please correct these errors and try again
+"""
+    )
+
+
+def test_output_columns_only_loads_required_columns(tmp_path, monkeypatch):
+    loaded_columns = []
+
+    def load_dataframe(path, columns):
+        loaded_columns.append(columns)
+        return utils.load_dataframe(path, columns)
+
+    monkeypatch.setattr("osmatching.__main__.load_dataframe", load_dataframe)
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category"},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path),
+        "output_columns": {"include": ["region"]},
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config",
+        json.dumps(config),
+    ]
+    main()
+    assert sorted(loaded_columns) == [["patient_id", "sex", "indexdate", "region"]] * 2
+    combined = pd.read_feather(tmp_path / "matched_combined.arrow")
+    assert list(combined.columns) == ["patient_id", "region", "set_id", "case"]
+
+
+def test_unreadable_cases_fail_without_waiting_for_controls(tmp_path, monkeypatch):
+    release_controls = threading.Event()
+    controls_loaded = threading.Event()
+
+    def load_controls(controls, columns, config):
+        release_controls.wait(timeout=10)
+        controls_loaded.set()
+
+    def load_dataframe(path, columns):
+        raise OSError(f"can't read {path.name}")
+
+    monkeypatch.setattr("osmatching.__main__.load_controls", load_controls)
+    monkeypatch.setattr("osmatching.__main__.load_dataframe", load_dataframe)
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category"},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path),
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+    ]
+    try:
+        with pytest.raises(OSError, match="can't read input_cases.arrow"):
+            main()
+        # the error is raised while the controls are still loading
+        assert not controls_loaded.is_set()
+    finally:
+        release_controls.set()
+        controls_loaded.wait(timeout=10)
+
+
+def test_control_cache(tmp_path):
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path / "output"),
+        "control_cache_path": str(tmp_path / "cache"),
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+    ]
+    main()
+    assert len(list((tmp_path / "cache").glob("*.arrow"))) == 1
+
+
+def test_index_command(tmp_path, monkeypatch, capsys):
+    controls_path = tmp_path / "input_controls.arrow"
+    shutil.copy(FIXTURE_PATH / "input_controls.arrow", controls_path)
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "date_exclusion_variables": {"died_date_ons": "before"},
+        "output_path": str(tmp_path / "output"),
+    }
+    sys.argv = [
+        "match",
+        "index",
+        "--controls",
+        str(controls_path),
+        "--config",
+        json.dumps(config),
+    ]
+    main()
+    assert (tmp_path / "input_controls.arrow.index").exists()
+    assert "Control index written to" in capsys.readouterr().out
+
+    # matching loads the index instead of building it
+    def build_control_index(*args):  # pragma: no cover
+        assert False, "index should not be rebuilt"
+
+    monkeypatch.setattr(
+        "osmatching.osmatching.build_control_index", build_control_index
+    )
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(controls_path),
+        "--config",
+        json.dumps(config),
+    ]
+    main()
+    assert (tmp_path / "output" / "matched_combined.arrow").exists()
+
+
+def test_index_command_input_data_errors(tmp_path):
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"unknown": "category"},
+        "index_date_variable": "indexdate",
+    }
+    sys.argv = [
+        "match",
+        "index",
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+    ]
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        main()
+    assert not (FIXTURE_PATH / "input_controls.arrow.index").exists()
+
+
+def test_multiple_populations(tmp_path):
+    for name in ["covid", "flu"]:
+        shutil.copy(FIXTURE_PATH / "input_cases.arrow", tmp_path / f"{name}.arrow")
+    controls_path = tmp_path / "input_controls.arrow"
+    shutil.copy(FIXTURE_PATH / "input_controls.arrow", controls_path)
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path / "output"),
+        "populations": {"flu": {"matches_per_case": 2}},
+        "reuse_controls_across_populations": False,
+    }
+    # the controls are indexed once, for all populations
+    sys.argv = [
+        "match",
+        "index",
+        "--controls",
+        str(controls_path),
+        "--config",
+        json.dumps(config),
+    ]
+    main()
+    sys.argv = [
+        "match",
+        "--cases",
+        str(tmp_path / "covid.arrow"),
+        str(tmp_path / "flu.arrow"),
+        "--controls",
+        str(controls_path),
+        "--config",
+        json.dumps(config),
+    ]
+    main()
+    covid = pd.read_feather(tmp_path / "output" / "matched_matches_covid.arrow")
+    flu = pd.read_feather(tmp_path / "output" / "matched_matches_flu.arrow")
+    assert flu.groupby("set_id").size().max() == 2
+    assert set(covid["patient_id"]).isdisjoint(flu["patient_id"])
+
+
+def test_multiple_populations_errors(tmp_path, capsys):
+    shutil.copy(FIXTURE_PATH / "input_cases.arrow", tmp_path / "input_cases.arrow")
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category"},
+        "index_date_variable": "indexdate",
+        "populations": {"covid": {}},
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        str(tmp_path / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+    ]
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        main()
+    assert (
+        capsys.readouterr().out
+        == """
+Errors were found in the provided configuration:
+
+  cases
+  * Cases files must have different names
+
+  populations
+  * No cases file found for population `covid`
+
+Please correct these errors and try again
+"""
+    )
+
+
+def test_partitioned_matching(tmp_path):
+    config = {
+        "matches_per_case": 2,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_columns": {"exclude": ["previous_event"]},
+    }
+    for output, partition_memory_mb in [("in_memory", None), ("partitioned", 1)]:
+        sys.argv = [
+            "match",
+            "--cases",
+            str(FIXTURE_PATH / "input_cases.csv"),
+            "--controls",
+            str(FIXTURE_PATH / "input_controls.csv"),
+            "--config",
+            json.dumps(
+                {
+                    **config,
+                    "output_path": str(tmp_path / output),
+                    "partition_memory_mb": partition_memory_mb,
+                }
+            ),
+        ]
+        main()
+    for name in ["matched_cases", "matched_matches", "matched_combined"]:
+        assert (tmp_path / "partitioned" / f"{name}.arrow").read_bytes() == (
+            tmp_path / "in_memory" / f"{name}.arrow"
+        ).read_bytes()
+
+
+def test_partitioned_matching_with_multiple_cases_files(tmp_path, capsys):
+    shutil.copy(FIXTURE_PATH / "input_cases.arrow", tmp_path / "flu.arrow")
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category"},
+        "index_date_variable": "indexdate",
+        "partition_memory_mb": 1,
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        str(tmp_path / "flu.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+    ]
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        main()
+    assert (
+        "Only one cases file can be matched with `partition_memory_mb`"
+        in capsys.readouterr().out
+    )
+
+
+def test_incremental_matching(tmp_path, capsys):
+    config = {
+        "matches_per_case": 2,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path),
+        "output_format": "csv",
+    }
+    previous_cases = pd.read_csv(FIXTURE_PATH / "input_cases.csv").iloc[:10]
+    previous_cases.to_csv(tmp_path / "previous_cases.csv", index=False)
+    sys.argv = [
+        "match",
+        "--cases",
+        str(tmp_path / "previous_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config",
+        json.dumps({**config, "output_suffix": "_previous"}),
+    ]
+    main()
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config",
+        json.dumps(config),
+        "--previous-matches",
+        str(tmp_path / "matched_matches_previous.csv"),
+        "--previous-cases",
+        str(tmp_path / "previous_cases.csv"),
+    ]
+    capsys.readouterr()
+    main()
+    assert "Dropping cases of a previous run:" in capsys.readouterr().out
+    previous_matches = pd.read_csv(tmp_path / "matched_matches_previous.csv")
+    matched_cases = pd.read_csv(tmp_path / "matched_cases.csv")
+    matched_matches = pd.read_csv(tmp_path / "matched_matches.csv")
+    assert len(matched_cases) > 0
+    assert not matched_cases["patient_id"].isin(previous_cases["patient_id"]).any()
+    assert not matched_matches["patient_id"].isin(previous_matches["patient_id"]).any()
+
+
+@pytest.mark.parametrize(
+    "config,previous_cases,error",
+    [
+        (
+            {"populations": {"input_cases": {"matches_per_case": 2}}},
+            None,
+            "Only one population of cases can be matched with `--previous-matches`",
+        ),
+        (
+            {"partition_memory_mb": 1},
+            None,
+            "`partition_memory_mb` cannot be used with `--previous-matches`",
+        ),
+        (
+            {},
+            None,
+            "column(s) `set_id` not found in previous matches dataset",
+        ),
+        (
+            {},
+            pd.DataFrame({"id": [1]}),
+            "column(s) `patient_id` not found in previous cases dataset",
+        ),
+    ],
+)
+def test_incremental_matching_errors(tmp_path, capsys, config, previous_cases, error):
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config",
+        json.dumps(
+            {
+                "matches_per_case": 1,
+                "match_variables": {"sex": "category"},
+                "index_date_variable": "indexdate",
+                **config,
+            }
+        ),
+        "--previous-matches",
+        str(FIXTURE_PATH / "input_controls.csv"),
+    ]
+    if previous_cases is not None:
+        previous_cases.to_csv(tmp_path / "previous_cases.csv", index=False)
+        sys.argv.extend(["--previous-cases", str(tmp_path / "previous_cases.csv")])
+    with pytest.raises(ValueError):
+        main()
+    assert error in capsys.readouterr().out
+
+
+def test_previous_cases_requires_previous_matches(capsys):
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config-file",
+        str(FIXTURE_PATH / "config.json"),
+        "--previous-cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+    ]
+    with pytest.raises(SystemExit):
+        main()
+    assert "--previous-cases requires --previous-matches" in capsys.readouterr().err
+
+
+def test_dry_run(tmp_path, capsys):
+    for name in ["covid", "flu"]:
+        shutil.copy(FIXTURE_PATH / "input_cases.arrow", tmp_path / f"{name}.arrow")
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path / "output"),
+        "populations": {"flu": {"matches_per_case": 2}},
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(tmp_path / "covid.arrow"),
+        str(tmp_path / "flu.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+        "--dry-run",
+    ]
+    main()
+    # each population is estimated, and nothing is matched
+    assert sorted(path.name for path in (tmp_path / "output").iterdir()) == [
+        "dry_run_covid.txt",
+        "dry_run_flu.txt",
+    ]
+    flu_report = (tmp_path / "output" / "dry_run_flu.txt").read_text()
+    assert "Matches per case               2\n" in flu_report
+    assert "Dry run estimates:" in capsys.readouterr().out
+
+
+def test_dry_run_with_previous_matches(capsys):
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config-file",
+        str(FIXTURE_PATH / "config.json"),
+        "--previous-matches",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--dry-run",
+    ]
+    with pytest.raises(SystemExit):
+        main()
+    assert "--dry-run cannot be used with --previous-matches" in (
+        capsys.readouterr().err
+    )
+
+
+def test_shard_and_merge_commands(tmp_path):
+    config = {
+        "matches_per_case": 2,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_columns": {"exclude": ["previous_event"]},
+        "output_format": "csv",
+    }
+    sys.argv = [
+        "match",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config",
+        json.dumps({**config, "output_path": str(tmp_path / "single")}),
+    ]
+    main()
+
+    config["output_path"] = str(tmp_path / "shards")
+    sys.argv = [
+        "match",
+        "shard",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.csv"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.csv"),
+        "--config",
+        json.dumps(config),
+        "--shards",
+        "2",
+    ]
+    main()
+    for shard_number in [1, 2]:
+        sys.argv = [
+            "match",
+            "--cases",
+            str(tmp_path / "shards" / f"cases_shard_{shard_number}.arrow"),
+            "--controls",
+            str(tmp_path / "shards" / f"controls_shard_{shard_number}.arrow"),
+            "--config",
+            json.dumps({**config, "output_suffix": f"_shard_{shard_number}"}),
+            # the outputs of the shards are merged from arrow files
+            "--output-format",
+            "arrow",
+        ]
+        main()
+    sys.argv = ["match", "merge", "--config", json.dumps(config)]
+    main()
+
+    for name in ["matched_cases", "matched_matches", "matched_combined"]:
+        assert (tmp_path / "shards" / f"{name}.csv").read_bytes() == (
+            tmp_path / "single" / f"{name}.csv"
+        ).read_bytes()
+    assert (tmp_path / "shards" / "matching_report.txt").exists()
+
+
+@pytest.mark.parametrize("from_file", [False, True])
+def test_sweep_command(tmp_path, from_file):
+    config = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "index_date_variable": "indexdate",
+        "output_path": str(tmp_path / "output"),
+    }
+    grid = {"match_variables.age": [1, 2]}
+    if from_file:
+        (tmp_path / "grid.json").write_text(json.dumps(grid))
+        grid_args = ["--grid-file", str(tmp_path / "grid.json")]
+    else:
+        grid_args = ["--grid", json.dumps(grid)]
+    sys.argv = [
+        "match",
+        "sweep",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(config),
+        "--workers",
+        "1",
+        *grid_args,
+    ]
+    main()
+    results = pd.read_csv(tmp_path / "output" / "sweep.csv")
+    assert list(results["match_variables.age"]) == [1, 2]
+    # only the sweep table is written
+    assert list((tmp_path / "output").iterdir()) == [tmp_path / "output" / "sweep.csv"]
+
+
+@pytest.mark.parametrize(
+    "grid_args,error",
+    [
+        (["--grid", "{bad"], "Could not parse {bad"),
+        (["--grid-file", "unknown.json"], "Grid file not found: unknown.json"),
+    ],
+)
+def test_sweep_command_bad_grid(grid_args, error, capsys):
+    sys.argv = [
+        "match",
+        "sweep",
+        "--cases",
+        str(FIXTURE_PATH / "input_cases.arrow"),
+        "--controls",
+        str(FIXTURE_PATH / "input_controls.arrow"),
+        "--config",
+        json.dumps(
+            {
+                "matches_per_case": 1,
+                "match_variables": {"age": 5},
+                "index_date_variable": "indexdate",
+            }
+        ),
+        *grid_args,
+    ]
+    with pytest.raises(SystemExit):
+        main()
+    assert error in capsys.readouterr().err
@@ -1,18 +1,24 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytest
 
+from osmatching import metrics
+from osmatching.index import build_control_index
 from osmatching.osmatching import (
     NOT_PREVIOUSLY_MATCHED,
+    assign_matches,
     date_exclusions,
-    get_bool_index,
     get_date_offset,
-    get_eligible_matches,
     greedily_pick_matches,
     match,
-    pre_calculate_indices,
+    match_incremental,
+    match_populations,
+    thin_control_pool,
 )
 from osmatching.utils import MatchConfig, load_dataframe, parse_and_validate_config
 
@@ -91,6 +97,356 @@ def test_match_smoke_test(
     assert len(report_text.split("\n")) == len(report_text1.split("\n"))
 
 
+def test_match_with_futures(tmp_path):
+    """Test that match() accepts input datasets that are still loading."""
+    test_matching = {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 5, "indexdate": "month_only"},
+        "closest_match_variables": ["age"],
+        "index_date_variable": "indexdate",
+        "output_path": tmp_path,
+    }
+    expected_cases, expected_matches = match(
+        case_df=load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        match_df=load_dataframe(FIXTURE_PATH / "input_controls.csv"),
+        match_config=MatchConfig(**test_matching),
+    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        matched_cases, matched_matches = match(
+            case_df=executor.submit(load_dataframe, FIXTURE_PATH / "input_cases.csv"),
+            match_df=executor.submit(
+                load_dataframe, FIXTURE_PATH / "input_controls.csv"
+            ),
+            match_config=MatchConfig(**test_matching),
+        )
+    pd.testing.assert_frame_equal(matched_cases, expected_cases)
+    pd.testing.assert_frame_equal(matched_matches, expected_matches)
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {
+            "matches_per_case": 3,
+            "match_variables": {"sex": "category", "age": 5, "indexdate": "month_only"},
+            "closest_match_variables": ["age"],
+            "date_exclusion_variables": {
+                "died_date_ons": "before",
+                "previous_event": "after",
+            },
+        },
+        {
+            "matches_per_case": 2,
+            "min_matches_per_case": 1,
+            "match_variables": {"region": "category", "age": 0},
+            "closest_match_variables": ["age"],
+            "tiers": [{"age": 0}, {"age": 3}],
+            "generate_match_index_date": "1_year_earlier",
+            "drop_cases_from_matches": True,
+        },
+    ],
+)
+def test_match_engines(tmp_path, config):
+    """The arrow engine matches the same cases and matches as the pandas engine"""
+    outputs = {}
+    for engine in ["pandas", "arrow"]:
+        outputs[engine] = match(
+            load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+            load_dataframe(FIXTURE_PATH / "input_controls.csv"),
+            MatchConfig(
+                **config,
+                index_date_variable="indexdate",
+                output_path=tmp_path / engine,
+                engine=engine,
+            ),
+        )
+    assert len(outputs["pandas"][1]) > 0
+    for expected, result in zip(outputs["pandas"], outputs["arrow"]):
+        pd.testing.assert_frame_equal(result, expected)
+
+
+def test_match_output_columns(tmp_path):
+    test_matching = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 5},
+        "closest_match_variables": ["age"],
+        "index_date_variable": "indexdate",
+        "output_path": tmp_path,
+        "output_columns": {"include": ["sex", "region"]},
+    }
+    matched_cases, matched_matches = match(
+        case_df=load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        match_df=load_dataframe(FIXTURE_PATH / "input_controls.csv"),
+        match_config=MatchConfig(**test_matching),
+    )
+    assert list(matched_cases.columns) == ["sex", "region", "set_id", "case"]
+    assert list(matched_matches.columns) == ["sex", "region", "set_id", "case"]
+    combined = pd.read_feather(tmp_path / "matched_combined.arrow")
+    assert list(combined.columns) == ["patient_id", "sex", "region", "set_id", "case"]
+    # closest match variables are still compared in the report, even if they are
+    # not included in the output
+    assert "age comparison:" in (tmp_path / "matching_report.txt").read_text()
+
+
+def test_match_metrics(tmp_path):
+    test_matching = {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 5},
+        "closest_match_variables": ["age"],
+        "index_date_variable": "indexdate",
+        "date_exclusion_variables": {"died_date_ons": "before"},
+        "output_path": tmp_path,
+        "output_suffix": "_test",
+    }
+    match(
+        case_df=load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        match_df=load_dataframe(FIXTURE_PATH / "input_controls.csv"),
+        match_config=MatchConfig(**test_matching),
+    )
+    metrics = json.loads((tmp_path / "matching_metrics_test.json").read_text())
+    stages = metrics["stages"]
+    # the output files are written concurrently, in any order
+    assert sorted(stages) == sorted(
+        [
+            "load",
+            "import_data",
+            "drop_cases",
+            "build_control_index",
+            "case_exclusions",
+            "sort_cases",
+            "matching",
+            "results_report",
+            "write_matched_cases",
+            "write_matched_matches",
+            "write_matched_combined",
+            "write_outputs",
+        ]
+    )
+    assert stages["import_data"]["rows"] == {"cases": 20, "matches": 1000}
+    assert stages["case_exclusions"]["rows"] == {"cases": 10}
+    assert stages["matching"]["rows"] == {
+        "cases": 10,
+        "matched_cases": 10,
+        "matches": 30,
+    }
+    assert stages["write_matched_combined"]["rows"] == {"rows": 40}
+    for stage_metrics in [*stages.values(), metrics["total"]]:
+        assert stage_metrics["wall_seconds"] >= 0
+        assert stage_metrics["cpu_seconds"] >= 0
+        assert stage_metrics["process_peak_rss_mb"] > 0
+    assert metrics["total"]["wall_seconds"] >= stages["matching"]["wall_seconds"]
+
+
+def test_match_strata(tmp_path):
+    match(
+        case_df=load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        match_df=load_dataframe(FIXTURE_PATH / "input_controls.csv"),
+        match_config=MatchConfig(
+            matches_per_case=2,
+            min_matches_per_case=1,
+            match_variables={"sex": "category", "region": "category", "age": 2},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+            output_suffix="_test",
+            output_format="csv",
+        ),
+    )
+    strata = pd.read_csv(tmp_path / "matching_strata_test.csv")
+    assert list(strata.columns) == [
+        "sex",
+        "region",
+        "cases",
+        "eligible_controls",
+        "matched_cases",
+        "matched_controls",
+        "mean_matches_per_case",
+        "seconds",
+    ]
+    # each case is in one stratum, in order of the category values, and small
+    # numbers are suppressed
+    assert len(strata) == 4
+    assert strata[["sex", "region"]].equals(
+        strata[["sex", "region"]].sort_values(["sex", "region"])
+    )
+    assert strata["eligible_controls"].tolist() == [25, 20, 30, 20]
+    assert strata["cases"].isna().sum() == 3
+    # the times of strata with redacted counts are redacted
+    redacted = (
+        strata[["cases", "eligible_controls", "matched_cases", "matched_controls"]]
+        .isna()
+        .any(axis=1)
+    )
+    assert strata["seconds"][redacted].isna().all()
+    assert (strata["seconds"][~redacted] >= 0).all()
+
+
+def test_match_balance(tmp_path):
+    match(
+        case_df=load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        match_df=load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        match_config=MatchConfig(
+            matches_per_case=2,
+            match_variables={"sex": "category", "age": 5},
+            index_date_variable="indexdate",
+            date_exclusion_variables={"died_date_ons": "before"},
+            balance_variables=["died_date_ons", "region"],
+            output_path=tmp_path,
+        ),
+    )
+    report = (tmp_path / "matching_report.txt").read_text()
+    balance = report[report.index("Balance after matching:") :].splitlines()
+    assert balance[1].split() == [
+        "variable",
+        "level",
+        "cases",
+        "matches",
+        "difference",
+        "smd",
+        "variance_ratio",
+    ]
+    # the match variables and the balance variables are compared, a numeric
+    # variable in one row, and each level of a categorical variable in its own
+    variables = [line.split()[0] for line in balance[2:] if line]
+    assert list(dict.fromkeys(variables)) == [
+        "sex",
+        "age",
+        "died_date_ons",
+        "region",
+        "Variables",
+    ]
+    assert variables.count("age") == variables.count("died_date_ons") == 1
+    assert variables.count("sex") == 4
+
+
+def test_match_loop_counters(tmp_path):
+    cases = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3],
+            "sex": "F",
+            "indexdate": ["2020-01-01", "2020-02-01", "2020-03-01"],
+            "died_date_ons": None,
+        }
+    ).set_index("patient_id")
+    # the last control died before any case's index date
+    controls = pd.DataFrame(
+        {
+            "patient_id": [11, 12, 13, 14],
+            "sex": "F",
+            "died_date_ons": [None, None, None, "2019-01-01"],
+        }
+    ).set_index("patient_id")
+    match(
+        cases,
+        controls,
+        MatchConfig(
+            matches_per_case=2,
+            match_variables={"sex": "category"},
+            index_date_variable="indexdate",
+            generate_match_index_date="no_offset",
+            date_exclusion_variables={"died_date_ons": "before"},
+            output_path=tmp_path,
+            loop_counters=True,
+        ),
+    )
+    # the first case's matches are sampled from its 3 candidates, the second is
+    # matched to the one that's left, and the third has none left
+    counters = json.loads((tmp_path / "matching_metrics.json").read_text())[
+        "loop_counters"
+    ]
+    assert counters == {
+        "cases": 3,
+        "exhausted": 1,
+        "sampled": 1,
+        "histograms": {
+            "candidates": {"0": 0, "1": 1, "2-3": 1, "4-7": 1},
+            "date_excluded": {"0": 0, "1": 3},
+            "sampled_from": {"0": 0, "1": 0, "2-3": 1},
+        },
+    }
+    report = (tmp_path / "matching_report.txt").read_text()
+    assert "Matching loop counters:\nCases              3\n" in report
+    assert "Stratum exhausted  1\n" in report
+
+    # cases are counted in each tier they're matched in
+    config = MatchConfig(
+        matches_per_case=1,
+        min_matches_per_case=1,
+        match_variables={"sex": "category", "age": 0},
+        index_date_variable="indexdate",
+        output_path=tmp_path / "tiers",
+        tiers=[{"age": 0}, {"age": 5}],
+        loop_counters=True,
+    )
+    matched_cases, _ = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        config,
+    )
+    counters = json.loads((tmp_path / "tiers" / "matching_metrics.json").read_text())[
+        "loop_counters"
+    ]
+    # cases without matches in the first tier are counted again in the second
+    assert counters["cases"] == 20 + (matched_cases["match_tier"] == 2).sum() + (
+        20 - len(matched_cases)
+    )
+    # without date exclusions, none are counted
+    assert counters["histograms"]["date_excluded"] == {"0": 0}
+
+
+def test_match_progress(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "PROGRESS_INTERVAL_SECONDS", 0)
+    match(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        MatchConfig(
+            matches_per_case=1,
+            min_matches_per_case=1,
+            match_variables={"sex": "category", "age": 0},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+            tiers=[{"age": 0}, {"age": 5}],
+        ),
+    )
+    progress = [
+        line
+        for line in capsys.readouterr().out.splitlines()
+        if line.startswith("Matching progress")
+    ]
+    assert progress[0].startswith("Matching progress (tier 1): 1/20 cases (5.0%)")
+    assert progress[19].startswith("Matching progress (tier 1): 20/20 cases")
+    assert progress[20].startswith("Matching progress (tier 2): 1/")
+    # progress isn't added to the report
+    assert "Matching progress" not in (tmp_path / "matching_report.txt").read_text()
+
+
+def test_match_cases_with_same_index_date(tmp_path):
+    """
+    Cases with the same index date are matched in the order of pandas' default
+    (unstable) sort by index date, which isn't the order of the cases file.
+    """
+    cases = pd.DataFrame(
+        {"sex": "F", "indexdate": "2020-01-01"},
+        index=pd.Index(range(1, 21), name="patient_id"),
+    )
+    controls = pd.DataFrame(
+        {"sex": "F", "indexdate": "2020-01-01"},
+        index=pd.Index(range(101, 106), name="patient_id"),
+    )
+    matched_cases, _ = match(
+        cases,
+        controls,
+        MatchConfig(
+            matches_per_case=1,
+            min_matches_per_case=1,
+            match_variables={"sex": "category"},
+            index_date_variable="indexdate",
+            output_path=tmp_path,
+        ),
+    )
+    # only the first five cases matched get a control
+    assert sorted(matched_cases.index) == [1, 15, 16, 17, 18]
+
+
 @pytest.mark.parametrize(
     "min_per_case,match_count",
     [
@@ -310,87 +666,6 @@ def test_match_on_index_date_with_no_control_index_date(tmp_path):
     assert matched_matches.empty
 
 
-def test_categorical_get_bool_index():
-    """
-    Runs get_eligible_matches on synthetic categorical data and compares the test_data
-    with manually entered boolean Series.
-    """
-    match_type = "category"
-    value = "F"
-    match_var = "sex"
-    matches = pd.DataFrame.from_records(
-        [["F"], ["M"], ["F"], ["M"], ["F"]], columns=["sex"]
-    )
-
-    bool_index = get_bool_index(match_type, value, match_var, matches)
-
-    assert bool_index.equals(pd.Series([True, False, True, False, True]))
-
-
-def test_scalar_get_bool_index():
-    """
-    Runs get_eligible_matches on synthetic integer data and compares the test_data
-    with manually entered boolean Series.
-    """
-    match_type = 5
-    value = 36
-    match_var = "age"
-    matches = pd.DataFrame.from_records([[30], [36], [39], [61], [75]], columns=["age"])
-
-    bool_index = get_bool_index(match_type, value, match_var, matches)
-
-    assert bool_index.equals(pd.Series([False, True, True, False, False]))
-
-
-def test_pre_calculate_indices():
-    """
-    Test that the test_data booleans match with a predetermined series for a simple
-    categorical variable with 2 categories. (other comparison types are tested in
-    get_bool_index)
-    """
-    cases = pd.DataFrame.from_records([["F"], ["M"]], columns=["sex"])
-    matches = pd.DataFrame.from_records(
-        [["F"], ["M"], ["F"], ["M"], ["F"]], columns=["sex"]
-    )
-    match_variables = {"sex": "category"}
-
-    indices_dict = pre_calculate_indices(cases, matches, match_variables)
-
-    assert indices_dict["sex"]["F"].equals(pd.Series([True, False, True, False, True]))
-    assert indices_dict["sex"]["M"].equals(pd.Series([False, True, False, True, False]))
-
-
-def test_get_eligible_matches():
-    """
-    Runs get_eligible_matches on synthetic data and compares the test_data with
-    manually entered boolean Series.
-    """
-    cases = pd.DataFrame.from_records(
-        [
-            {"sex": "M", "age": 36},
-        ]
-    )
-    case_row = cases.iloc[0]
-    matches = pd.DataFrame.from_records(
-        [
-            {"sex": "M", "age": 37, "set_id": NOT_PREVIOUSLY_MATCHED},
-            {"sex": "M", "age": 57, "set_id": NOT_PREVIOUSLY_MATCHED},
-            {"sex": "F", "age": 32, "set_id": NOT_PREVIOUSLY_MATCHED},
-            {"sex": "F", "age": 81, "set_id": NOT_PREVIOUSLY_MATCHED},
-            {"sex": "M", "age": 37, "set_id": 1},
-        ]
-    )
-    match_variables = {"sex": "category", "age": 5}
-    indices = {
-        "sex": {"M": pd.Series([True, True, False, False, True])},
-        "age": {36: pd.Series([True, False, True, False, True])},
-    }
-
-    eligible_matches = get_eligible_matches(case_row, matches, match_variables, indices)
-
-    assert eligible_matches.equals(pd.Series([True, False, False, False, False]))
-
-
 def test_date_exclusions():
     """
     Runs date_exclusions on synthetic data and compares the test_data with
@@ -515,3 +790,306 @@ def test_match_with_config_errors():
         ValueError, match="There was an error in one or more config values"
     ):
         match(cases, matches, MatchConfig())
+
+
+def test_match_with_input_data_errors(tmp_path):
+    cases = pd.DataFrame.from_records(
+        [{"patient_id": 1, "index_date": "2024-01-01"}]
+    ).set_index("patient_id")
+    matches = pd.DataFrame.from_records(
+        [{"patient_id": 2, "age": 30, "index_date": "2024-02-01"}]
+    ).set_index("patient_id")
+    config = MatchConfig(
+        matches_per_case=1,
+        match_variables={"age": 5},
+        index_date_variable="index_date",
+        output_path=tmp_path,
+    )
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        match(cases, matches, config)
+    # nothing is written
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("reuse_controls", [True, False])
+def test_match_populations(tmp_path, reuse_controls):
+    test_matching = {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 10},
+        "closest_match_variables": ["age"],
+        "index_date_variable": "indexdate",
+        "output_path": tmp_path,
+        "output_suffix": "_study",
+        "populations": {"flu": {"matches_per_case": 2}},
+        "reuse_controls_across_populations": reuse_controls,
+    }
+    cases = load_dataframe(FIXTURE_PATH / "input_cases.arrow")
+    matched = match_populations(
+        populations={"covid": cases.copy(), "flu": cases.copy()},
+        match_df=load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        match_config=MatchConfig(**test_matching),
+    )
+    assert list(matched) == ["covid", "flu"]
+    for name in ["covid", "flu"]:
+        assert (tmp_path / f"matched_cases_study_{name}.arrow").exists()
+        assert (tmp_path / f"matching_report_study_{name}.txt").exists()
+
+    # the first population is matched as if it was the only one
+    covid_config = MatchConfig(**{**test_matching, "output_path": tmp_path / "covid"})
+    expected_cases, expected_matches = match(
+        cases.copy(),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        covid_config,
+    )
+    pd.testing.assert_frame_equal(matched["covid"][0], expected_cases)
+    pd.testing.assert_frame_equal(matched["covid"][1], expected_matches)
+
+    # populations have their own config overrides
+    flu_cases, flu_matches = matched["flu"]
+    assert flu_matches.groupby("set_id").size().max() == 2
+
+    # matches are only reused if allowed; the same cases are in both populations,
+    # so some of the same matches are picked if they are available
+    reused = matched["covid"][1].index.intersection(flu_matches.index)
+    assert (len(reused) > 0) == reuse_controls
+
+
+def test_match_populations_with_input_data_errors(tmp_path):
+    matches = pd.DataFrame([{"patient_id": 2, "sex": "F"}]).set_index("patient_id")
+    config_kwargs = {
+        "matches_per_case": 1,
+        "match_variables": {"age": 5},
+        "index_date_variable": "index_date",
+        "output_path": tmp_path,
+    }
+    config = MatchConfig(**config_kwargs)
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        match_populations({"covid": matches}, matches, config)
+    config = MatchConfig(
+        **config_kwargs, populations={"covid": {"min_matches_per_case": 2}}
+    )
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        match_populations({"covid": matches}, matches, config)
+
+
+@pytest.mark.parametrize("with_previous_cases", [True, False])
+def test_match_incremental(tmp_path, capsys, with_previous_cases):
+    test_matching = {
+        "matches_per_case": 3,
+        "min_matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 2},
+        "index_date_variable": "indexdate",
+        "drop_cases_from_matches": True,
+    }
+    cases = load_dataframe(FIXTURE_PATH / "input_cases.arrow")
+    controls = load_dataframe(FIXTURE_PATH / "input_controls.arrow")
+    # the previous run had the first 12 cases; the updated cases have all 20
+    previous_cases = cases.iloc[:12]
+    match(
+        previous_cases.copy(),
+        controls.copy(),
+        MatchConfig(**test_matching, output_path=tmp_path / "previous"),
+    )
+    previous_matched_cases = load_dataframe(
+        tmp_path / "previous" / "matched_cases.arrow"
+    )
+    previous_matches = load_dataframe(tmp_path / "previous" / "matched_matches.arrow")
+    assert 0 < len(previous_matched_cases) < 12
+
+    capsys.readouterr()
+    matched_cases, matched_matches = match_incremental(
+        cases.copy(),
+        controls.copy(),
+        MatchConfig(**test_matching, output_path=tmp_path),
+        previous_matches=previous_matches,
+        previous_cases=previous_cases if with_previous_cases else None,
+    )
+    output = capsys.readouterr().out
+    # only new cases (and, without previous_cases, previously unmatched cases) are
+    # matched again
+    dropped_cases = previous_cases if with_previous_cases else previous_matched_cases
+    assert (
+        f"Cases    {20 - len(dropped_cases)}"
+        in output.split("Dropping cases of a previous run:")[1].split("\n\n")[0]
+    )
+    assert len(matched_cases) > 0
+    assert not matched_cases.index.isin(dropped_cases.index).any()
+    # previous matches, and previous cases, are not used again
+    assert not matched_matches.index.isin(previous_matches.index).any()
+    assert not matched_matches.index.isin(dropped_cases.index).any()
+    assert (tmp_path / "matched_cases.arrow").exists()
+
+
+def test_match_incremental_with_errors(tmp_path, capsys):
+    cases = load_dataframe(FIXTURE_PATH / "input_cases.arrow")
+    config = MatchConfig(
+        matches_per_case=1,
+        match_variables={"sex": "category"},
+        index_date_variable="indexdate",
+        output_path=tmp_path,
+    )
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        match_incremental(cases, cases, config, previous_matches=cases)
+    assert (
+        "column(s) `set_id` not found in previous matches dataset"
+        in capsys.readouterr().out
+    )
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        match_incremental(cases, cases, MatchConfig(), previous_matches=cases)
+
+
+@pytest.mark.parametrize("generate_match_index_date", ["", "no_offset"])
+def test_match_in_tiers(tmp_path, generate_match_index_date):
+    test_matching = {
+        "generate_match_index_date": generate_match_index_date,
+        "matches_per_case": 3,
+        "min_matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 0},
+        "closest_match_variables": ["age"],
+        "index_date_variable": "indexdate",
+        "output_path": tmp_path,
+    }
+    matched_cases, matched_matches = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        MatchConfig(**test_matching, tiers=[{"age": 0}, {"age": 2}, {"age": 10}]),
+    )
+    # each matched set is labelled with the tier that produced it
+    assert set(matched_cases["match_tier"]) <= {1, 2, 3}
+    set_tiers = matched_cases.loc[matched_matches["set_id"], "match_tier"]
+    assert list(matched_matches["match_tier"]) == list(set_tiers)
+    differences = abs(
+        matched_matches["age"]
+        - matched_cases.loc[matched_matches["set_id"], "age"].to_numpy()
+    )
+    tier_ranges = matched_matches["match_tier"].map({1: 0, 2: 2, 3: 10})
+    assert (differences <= tier_ranges).all()
+    # matches are only picked once, across all tiers
+    assert matched_matches.index.is_unique
+    report = (tmp_path / "matching_report.txt").read_text()
+    assert "Number of matched cases per tier:" in report
+
+    # the first tier is matched as if it was the only one
+    first_tier_cases, first_tier_matches = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        MatchConfig(**{**test_matching, "output_path": tmp_path / "first_tier"}),
+    )
+    assert list(first_tier_cases.index) == list(
+        matched_cases.index[matched_cases["match_tier"] == 1]
+    )
+    assert list(first_tier_matches.index) == list(
+        matched_matches.index[matched_matches["match_tier"] == 1]
+    )
+    # and later tiers match more cases
+    assert len(matched_cases) > len(first_tier_cases)
+
+
+def test_assign_matches_in_tiers_times_cases(tmp_path):
+    config, _ = parse_and_validate_config(
+        MatchConfig(
+            matches_per_case=1,
+            min_matches_per_case=1,
+            match_variables={"sex": "category", "age": 0},
+            index_date_variable="indexdate",
+            generate_match_index_date="no_offset",
+            tiers=[{"age": 0}, {"age": 5}],
+            output_path=tmp_path,
+        )
+    )
+    cases = pd.DataFrame(
+        {
+            "sex": ["F", "F", "M"],
+            "age": [20, 30, 20],
+            "indexdate": pd.to_datetime(["2020-01-01"] * 3),
+        }
+    )
+    matches = pd.DataFrame(
+        {"sex": ["F", "F"], "age": [20, 32], "indexdate": pd.NaT}
+    ).assign(set_id=NOT_PREVIOUSLY_MATCHED)
+    control_index = build_control_index(matches, config)
+
+    results = []
+    for case_seconds in [None, np.zeros(len(cases))]:
+        match_counts, case_tiers = assign_matches(
+            cases,
+            matches.copy(),
+            config,
+            control_index,
+            np.ones(len(matches), dtype=bool),
+            case_seconds=case_seconds,
+        )
+        results.append((list(match_counts), list(case_tiers)))
+    # timing doesn't change the matches, and the time of each tier is added up
+    assert results[0] == results[1] == ([1, 1, 0], [1, 2, 0])
+    assert case_seconds is not None and (case_seconds > 0).all()
+
+
+@pytest.mark.parametrize(
+    "match_variables,expected_thinning",
+    [
+        (
+            {"sex": "category", "age": 5},
+            [["F", 2, 10, 4, 0.4], ["M", 1, 2, 2, 1.0], ["X", 1, 0, 0, np.nan]],
+        ),
+        ({"age": 5}, [[4, 12, 8, 8 / 12]]),
+    ],
+)
+def test_thin_control_pool(tmp_path, match_variables, expected_thinning):
+    config, _ = parse_and_validate_config(
+        MatchConfig(
+            matches_per_case=1,
+            match_variables=match_variables,
+            index_date_variable="indexdate",
+            control_pool_multiple=2,
+            output_path=tmp_path,
+        )
+    )
+    cases = pd.DataFrame({"sex": ["F", "M", "F", "X"], "age": 20})
+    matches = pd.DataFrame(
+        {
+            "sex": ["F"] * 10 + ["M"] * 2 + ["X"],
+            "age": 20,
+            "indexdate": pd.to_datetime(["2020-01-01"] * 13),
+        }
+    )
+    control_index = build_control_index(matches, config)
+    available = np.ones(len(matches), dtype=bool)
+    # unavailable controls are not in the pool
+    available[-1] = False
+    thinning = thin_control_pool(cases, config, control_index, available)
+    pd.testing.assert_frame_equal(
+        thinning,
+        pd.DataFrame(expected_thinning, columns=thinning.columns),
+        check_dtype=False,
+    )
+    assert available.sum() == sum(row[-2] for row in expected_thinning)
+
+    # thinning is reproducible
+    repeated = np.ones(len(matches), dtype=bool)
+    repeated[-1] = False
+    thin_control_pool(cases, config, control_index, repeated)
+    assert np.array_equal(available, repeated)
+
+
+def test_match_with_thinned_control_pool(tmp_path):
+    test_matching = {
+        "matches_per_case": 1,
+        "match_variables": {"sex": "category", "age": 10},
+        "index_date_variable": "indexdate",
+        "control_pool_multiple": 1,
+        "output_path": tmp_path,
+    }
+    results = [
+        match(
+            load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+            load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+            MatchConfig(**test_matching),
+        )
+        for _ in range(2)
+    ]
+    for first, second in zip(*results):
+        pd.testing.assert_frame_equal(first, second)
+    report = (tmp_path / "matching_report.txt").read_text()
+    assert "Controls kept in each stratum:" in report
+    assert "thinning_ratio" in report
@@ -0,0 +1,151 @@
+import json
+import time
+
+import numpy as np
+
+from osmatching import metrics
+from osmatching.metrics import (
+    MatchingMetrics,
+    MatchingProgress,
+    StageMetrics,
+    get_current_rss_mb,
+    get_histogram,
+    get_metrics_path,
+    get_peak_rss_mb,
+)
+
+
+def test_lap(monkeypatch):
+    clock = iter([3.0, 4.5])
+    monkeypatch.setattr(time, "perf_counter", lambda: next(clock))
+    monkeypatch.setattr(time, "process_time", lambda: 0.0)
+    matching_metrics = MatchingMetrics(lap_started=1.0, lap_cpu_started=0.0)
+    matching_metrics.lap("load", cases=10)
+    # a stage that's repeated has the sum of its times and rows
+    matching_metrics.lap("load", cases=5, matches=20)
+    assert matching_metrics.stages["load"].wall_seconds == 3.5
+    assert matching_metrics.stages["load"].rows == {"cases": 15, "matches": 20}
+
+
+def test_thread_stage():
+    matching_metrics = MatchingMetrics()
+    lap_started = matching_metrics.lap_started
+    with matching_metrics.thread_stage("write_matched_cases", rows=3):
+        pass
+    stage = matching_metrics.stages["write_matched_cases"]
+    assert stage.rows == {"rows": 3}
+    assert stage.wall_seconds >= 0
+    # the stage doesn't end a lap
+    assert matching_metrics.lap_started == lap_started
+
+
+def test_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "MAXRSS_BYTES", 1)
+    monkeypatch.setattr(metrics.resource, "getrusage", lambda who: _Usage())
+    matching_metrics = MatchingMetrics()
+    matching_metrics.lap("matching", cases=1)
+    path = get_metrics_path(tmp_path, "_suffix")
+    assert path.name == "matching_metrics_suffix.json"
+    matching_metrics.write(path)
+    written = json.loads(path.read_text())
+    assert list(written) == ["stages", "total"]
+    assert written["stages"]["matching"]["process_peak_rss_mb"] == 2.0
+    assert written["stages"]["matching"]["rows"] == {"cases": 1}
+    assert written["total"]["process_peak_rss_mb"] == 2.0
+    assert written["total"]["rows"] == {}
+
+
+def test_add():
+    matching_metrics = MatchingMetrics()
+    matching_metrics.record("matching", 1.0, 0.5, cases=2)
+    matching_metrics.stages["matching"].process_peak_rss_mb = 10.0
+    other = {
+        "stages": {
+            "matching": {
+                "wall_seconds": 2.0,
+                "cpu_seconds": 1.5,
+                "process_peak_rss_mb": 20.0,
+                "rows": {"cases": 3, "matches": 4},
+            },
+            "write_outputs": {
+                "wall_seconds": 0.5,
+                "cpu_seconds": 0.5,
+                "process_peak_rss_mb": None,
+                "rows": {},
+            },
+        }
+    }
+    matching_metrics.add(other)
+    # times and rows are summed, and the larger peak kept
+    assert matching_metrics.stages["matching"] == StageMetrics(
+        wall_seconds=3.0,
+        cpu_seconds=2.0,
+        process_peak_rss_mb=20.0,
+        rows={"cases": 5, "matches": 4},
+    )
+    assert matching_metrics.stages["write_outputs"].process_peak_rss_mb is None
+
+
+class _Usage:
+    ru_maxrss = 2 * 1024 * 1024
+
+
+def test_get_histogram():
+    histogram = get_histogram([0, 1, 2, 3, 4, 7, 8, 100], "candidates")
+    assert histogram.to_dict() == {
+        "0": 1,
+        "1": 1,
+        "2-3": 2,
+        "4-7": 2,
+        "8-15": 1,
+        "16-31": 0,
+        "32-63": 0,
+        "64-127": 1,
+    }
+    assert histogram.index.name == "candidates"
+    assert get_histogram([], "candidates").to_dict() == {"0": 0}
+
+
+def test_matching_progress(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "get_current_rss_mb", lambda: 12.5)
+    clock = iter([30.0, 70.0, 100.0, 130.0, 200.0])
+    monkeypatch.setattr(time, "monotonic", lambda: next(clock))
+    progress = MatchingProgress(
+        100, label=" (tier 2)", done_before=10, started=0.0, last_reported=0.0
+    )
+    available = np.array([True, False, True])
+    # not reported until PROGRESS_INTERVAL_SECONDS have passed
+    progress.update(20, available)
+    assert capsys.readouterr().out == ""
+    progress.update(38, available)
+    assert capsys.readouterr().out == (
+        "Matching progress (tier 2): 38/100 cases (38.0%), 0.4 cases/s, "
+        "ETA 0:02:35, 2 controls available, memory 12.5 MB\n"
+    )
+    progress.update(39, available)
+    assert capsys.readouterr().out == ""
+    # no cases matched since the start (e.g. when resuming)
+    progress.done_before = 40
+    progress.update(40, available)
+    assert "0.0 cases/s, ETA unknown" in capsys.readouterr().out
+    # where the resident memory isn't available (e.g. on Windows)
+    monkeypatch.setattr(metrics, "get_current_rss_mb", lambda: None)
+    progress.update(41, available)
+    assert capsys.readouterr().out.endswith("memory unknown\n")
+
+
+def test_get_current_rss_mb(tmp_path, monkeypatch):
+    assert get_current_rss_mb() > 0
+    # where the current resident memory isn't available, its peak is used
+    monkeypatch.setattr(metrics, "PROC_STATM_PATH", tmp_path / "unknown")
+    monkeypatch.setattr(metrics, "get_peak_rss_mb", lambda: 42.0)
+    assert get_current_rss_mb() == 42.0
+
+
+def test_get_peak_rss_mb_without_resource(monkeypatch):
+    # the resource module is Unix-only
+    monkeypatch.setattr(metrics, "resource", None)
+    assert get_peak_rss_mb() is None
+    matching_metrics = MatchingMetrics()
+    matching_metrics.lap("matching")
+    assert matching_metrics.stages["matching"].process_peak_rss_mb is None
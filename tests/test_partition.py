@@ -0,0 +1,222 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from osmatching import partition
+from osmatching.osmatching import match
+from osmatching.utils import MatchConfig, load_dataframe
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+CONFIGS = [
+    {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 5, "indexdate": "month_only"},
+        "closest_match_variables": ["age"],
+        "date_exclusion_variables": {
+            "died_date_ons": "before",
+            "previous_event": "after",
+        },
+    },
+    {
+        "matches_per_case": 2,
+        "min_matches_per_case": 1,
+        "match_variables": {"sex": "category", "region": "category", "age": 2},
+        "drop_cases_from_matches": True,
+    },
+    {
+        "matches_per_case": 1,
+        "min_matches_per_case": 1,
+        "match_variables": {"region": "category", "age": 0},
+        "closest_match_variables": ["age"],
+        "tiers": [{"age": 0}, {"age": 3}],
+        "generate_match_index_date": "1_year_earlier",
+    },
+]
+
+
+@pytest.fixture(autouse=True)
+def small_partitions(monkeypatch):
+    # the fixture controls are split into several partitions
+    monkeypatch.setattr(partition, "BYTES_PER_MB", 2000)
+
+
+def get_config(tmp_path, **kwargs):
+    return MatchConfig(
+        **{"index_date_variable": "indexdate", "output_path": tmp_path, **kwargs}
+    )
+
+
+@pytest.mark.parametrize("suffix", ["csv", "csv.gz", "arrow"])
+@pytest.mark.parametrize("config", CONFIGS)
+def test_match_partitioned(tmp_path, suffix, config):
+    expected = match(
+        load_dataframe(FIXTURE_PATH / f"input_cases.{suffix}"),
+        load_dataframe(FIXTURE_PATH / f"input_controls.{suffix}"),
+        get_config(tmp_path / "in_memory", **config),
+    )
+    matched = partition.match_partitioned(
+        load_dataframe(FIXTURE_PATH / f"input_cases.{suffix}"),
+        FIXTURE_PATH / f"input_controls.{suffix}",
+        get_config(
+            tmp_path / "partitioned",
+            partition_memory_mb=1,
+            loop_counters=True,
+            **config,
+        ),
+    )
+    for expected_df, matched_df in zip(expected, matched):
+        pd.testing.assert_frame_equal(matched_df, expected_df)
+    # the output files are identical, and the partitions are removed
+    assert sorted(path.name for path in (tmp_path / "partitioned").iterdir()) == [
+        "matched_cases.arrow",
+        "matched_combined.arrow",
+        "matched_matches.arrow",
+        "matching_metrics.json",
+        "matching_report.txt",
+        "matching_strata.arrow",
+    ]
+    for name in ["matched_cases", "matched_combined", "matched_matches"]:
+        assert (tmp_path / "partitioned" / f"{name}.arrow").read_bytes() == (
+            tmp_path / "in_memory" / f"{name}.arrow"
+        ).read_bytes()
+    # the strata are written in the same order, with the same counts
+    expected_strata, partitioned_strata = (
+        pd.read_feather(tmp_path / path / "matching_strata.arrow").drop(
+            columns="seconds"
+        )
+        for path in ["in_memory", "partitioned"]
+    )
+    pd.testing.assert_frame_equal(partitioned_strata, expected_strata)
+    report = (tmp_path / "partitioned" / "matching_report.txt").read_text()
+    assert "Partition 2:" in report
+    metrics = json.loads(
+        (tmp_path / "partitioned" / "matching_metrics.json").read_text()
+    )
+    # the metrics of matching each partition are summed
+    partition_matches = [
+        int(section.splitlines()[-1].split()[1])
+        for section in report.split("\n\n")
+        if section.startswith("Partition ")
+    ]
+    assert metrics["stages"]["load_partitions"]["rows"]["matches"] == sum(
+        partition_matches
+    )
+    # the cases of all partitions are counted
+    counters = metrics["loop_counters"]
+    assert sum(counters["histograms"]["candidates"].values()) == counters["cases"]
+    assert counters["cases"] > 0
+
+
+@pytest.mark.parametrize(
+    "suffix,visits_dtype", [("csv", "float64"), ("arrow", "Int64")]
+)
+def test_match_partitioned_with_missing_values(tmp_path, suffix, visits_dtype):
+    controls = load_dataframe(FIXTURE_PATH / "input_controls.csv")
+    controls.loc[controls.index[::7], "sex"] = None
+    # integer and boolean columns with missing values only in controls with no
+    # stratum, which are never loaded
+    controls["visits"] = pd.array(np.arange(len(controls)) % 5, dtype="Int64")
+    controls.loc[controls["sex"].isna(), "visits"] = None
+    controls["flag"] = (controls["visits"] > 2).astype(object)
+    controls.loc[controls["sex"].isna(), "flag"] = None
+    if suffix == "csv":
+        controls.to_csv(tmp_path / "controls.csv")
+    else:
+        # the controls are read in several record batches
+        controls.reset_index().to_feather(tmp_path / "controls.arrow", chunksize=100)
+    config = {
+        "matches_per_case": 2,
+        "match_variables": {"sex": "category", "age": 10},
+    }
+    expected = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        load_dataframe(tmp_path / f"controls.{suffix}"),
+        get_config(tmp_path / "in_memory", **config),
+    )
+    matched = partition.match_partitioned(
+        load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        tmp_path / f"controls.{suffix}",
+        get_config(
+            tmp_path / "partitioned",
+            partition_memory_mb=1,
+            loop_counters=True,
+            **config,
+        ),
+    )
+    for expected_df, matched_df in zip(expected, matched):
+        pd.testing.assert_frame_equal(matched_df, expected_df)
+    assert matched[1]["visits"].dtype == visits_dtype
+    assert matched[1]["flag"].dtype == "object"
+
+
+@pytest.mark.parametrize(
+    "columns,expected_columns",
+    [
+        (None, ["sex", "age", "indexdate", "set_id", "case"]),
+        (["patient_id", "sex", "indexdate"], ["sex", "indexdate", "set_id", "case"]),
+    ],
+)
+def test_match_partitioned_with_no_controls(tmp_path, columns, expected_columns):
+    (tmp_path / "controls.csv").write_text("patient_id,sex,age,indexdate\n")
+    matched_cases, matched_matches = partition.match_partitioned(
+        load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        tmp_path / "controls.csv",
+        get_config(
+            tmp_path,
+            matches_per_case=1,
+            match_variables={"sex": "category"},
+            partition_memory_mb=1,
+        ),
+        columns=columns,
+    )
+    assert (matched_cases["match_counts"] == 0).all()
+    assert len(matched_matches) == 0
+    assert list(matched_matches.columns) == expected_columns
+
+
+def test_get_partitions(tmp_path):
+    partitioned = partition.PartitionedControls(
+        directory=tmp_path,
+        schema=None,
+        num_controls=0,
+        num_available=0,
+        stratum_buckets={},
+        bucket_rows=[1, 0, 1, 1, 1, 1],
+        bucket_sizes=[5, 0, 3, 12, 4, 4],
+        categories={},
+        dtypes={},
+    )
+    # buckets larger than the maximum size are partitions of their own
+    assert partitioned.get_partitions(10) == [[0, 2], [3], [4, 5]]
+    assert partitioned.get_partitions(100) == [[0, 2, 3, 4, 5]]
+
+
+def test_match_partitioned_errors(tmp_path):
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        partition.match_partitioned(
+            load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+            FIXTURE_PATH / "input_controls.csv",
+            get_config(
+                tmp_path,
+                matches_per_case=1,
+                match_variables={"age": 1},
+                partition_memory_mb=1,
+            ),
+        )
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        partition.match_partitioned(
+            load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+            FIXTURE_PATH / "input_controls.csv",
+            get_config(
+                tmp_path,
+                matches_per_case=1,
+                match_variables={"sex": "category", "imd": 1},
+                partition_memory_mb=1,
+            ),
+            columns=["patient_id", "sex", "indexdate"],
+        )
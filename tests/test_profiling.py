@@ -0,0 +1,86 @@
+import pstats
+import sys
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+from osmatching.osmatching import match
+from osmatching.partition import match_partitioned
+from osmatching.profiling import StageProfiler, get_profile_path
+from osmatching.utils import MatchConfig, load_dataframe
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+
+def allocate():
+    return [list(range(100)) for _ in range(100)]
+
+
+def test_stage_profiler(tmp_path):
+    profiler = StageProfiler()
+    profiler.start()
+    assert tracemalloc.is_tracing()
+    allocate()
+    profiler.lap("allocate")
+    profiler.lap("nothing")
+    allocate()
+    profiler.lap("allocate")
+    profile_path = get_profile_path(tmp_path, "_suffix")
+    profiler.write(profile_path)
+    assert not tracemalloc.is_tracing()
+
+    assert sorted(path.name for path in profile_path.iterdir()) == [
+        "allocate.prof",
+        "allocate.txt",
+        "nothing.prof",
+        "nothing.txt",
+    ]
+    stats = pstats.Stats(str(profile_path / "allocate.prof"))
+    call_counts = [
+        function_stats[1]
+        for function, function_stats in stats.stats.items()
+        if function[2] == "allocate"
+    ]
+    # both runs of the stage are included
+    assert call_counts == [2]
+    summary = (profile_path / "allocate.txt").read_text()
+    assert summary.startswith("Top functions by cumulative time:")
+    assert "Run 1: peak traced memory" in summary
+    assert "Run 2: peak traced memory" in summary
+    assert "test_profiling.py" in summary
+
+
+def test_stage_profiler_already_tracing(tmp_path):
+    tracemalloc.start()
+    try:
+        profiler = StageProfiler()
+        profiler.start()
+        profiler.lap("stage")
+        profiler.write(tmp_path)
+        # tracing started elsewhere is left running
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize("partition_memory_mb", [None, 1])
+def test_profiling_stops_when_matching_fails(tmp_path, partition_memory_mb):
+    config = MatchConfig(
+        matches_per_case=1,
+        match_variables={"sex": "category", "age": 5},
+        index_date_variable="indexdate",
+        output_path=tmp_path,
+        partition_memory_mb=partition_memory_mb,
+        profile=True,
+    )
+    cases = load_dataframe(FIXTURE_PATH / "input_cases.arrow").drop(columns="age")
+    controls_path = FIXTURE_PATH / "input_controls.arrow"
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        if partition_memory_mb is None:
+            match(cases, load_dataframe(controls_path), config)
+        else:
+            match_partitioned(cases, controls_path, config)
+    assert not tracemalloc.is_tracing()
+    assert sys.getprofile() is None
@@ -0,0 +1,305 @@
+import itertools
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from osmatching import shard
+from osmatching.osmatching import match
+from osmatching.utils import ROW_NUMBER_VARIABLE, MatchConfig, load_dataframe
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+CONFIGS = [
+    {
+        "matches_per_case": 3,
+        "match_variables": {"sex": "category", "age": 5, "indexdate": "month_only"},
+        "closest_match_variables": ["age"],
+        "date_exclusion_variables": {
+            "died_date_ons": "before",
+            "previous_event": "after",
+        },
+    },
+    {
+        "matches_per_case": 2,
+        "min_matches_per_case": 1,
+        "match_variables": {"sex": "category", "region": "category", "age": 2},
+        "drop_cases_from_matches": True,
+    },
+    {
+        "matches_per_case": 1,
+        "min_matches_per_case": 1,
+        "match_variables": {"region": "category", "age": 0},
+        "closest_match_variables": ["age"],
+        "tiers": [{"age": 0}, {"age": 3}],
+        "generate_match_index_date": "1_year_earlier",
+    },
+]
+
+
+def parse_match_counts(report):
+    """The table of the number of cases with each number of available matches"""
+    lines = report.splitlines()
+    # the table follows its heading and a header line, and ends with a blank line
+    start = lines.index("Number of available matches per case:") + 2
+    table = itertools.takewhile(bool, lines[start:])
+    return {float(value): int(count) for value, count in map(str.split, table)}
+
+
+def get_strata(path):
+    """The stratum table, without the times"""
+    return pd.read_feather(path).drop(columns="seconds")
+
+
+def get_config(tmp_path, **kwargs):
+    return MatchConfig(
+        **{"index_date_variable": "indexdate", "output_path": tmp_path, **kwargs}
+    )
+
+
+def match_shards(cases, controls_path, tmp_path, config, num_shards, output_format):
+    """Shards the cases and controls, matches each shard, and merges the outputs"""
+    shard.shard(
+        cases, controls_path, get_config(tmp_path, **config), num_shards=num_shards
+    )
+    for shard_number in range(1, num_shards + 1):
+        match(
+            load_dataframe(tmp_path / f"cases_shard_{shard_number}.arrow"),
+            load_dataframe(tmp_path / f"controls_shard_{shard_number}.arrow"),
+            get_config(tmp_path, output_suffix=f"_shard_{shard_number}", **config),
+        )
+    return shard.merge(get_config(tmp_path, output_format=output_format, **config))
+
+
+@pytest.mark.parametrize(
+    "suffix,output_format", [("csv", "arrow"), ("arrow", "arrow"), ("csv.gz", "csv")]
+)
+@pytest.mark.parametrize("config", CONFIGS)
+def test_shard_and_merge(tmp_path, suffix, output_format, config):
+    expected = match(
+        load_dataframe(FIXTURE_PATH / f"input_cases.{suffix}"),
+        load_dataframe(FIXTURE_PATH / f"input_controls.{suffix}"),
+        get_config(tmp_path / "single", output_format=output_format, **config),
+    )
+    merged = match_shards(
+        load_dataframe(FIXTURE_PATH / f"input_cases.{suffix}"),
+        FIXTURE_PATH / f"input_controls.{suffix}",
+        tmp_path / "shards",
+        config,
+        num_shards=3,
+        output_format=output_format,
+    )
+    for expected_df, merged_df in zip(expected, merged):
+        pd.testing.assert_frame_equal(merged_df, expected_df)
+    for name in ["matched_cases", "matched_matches", "matched_combined"]:
+        assert (tmp_path / "shards" / f"{name}.{output_format}").read_bytes() == (
+            tmp_path / "single" / f"{name}.{output_format}"
+        ).read_bytes()
+
+    report = (tmp_path / "shards" / "matching_report.txt").read_text()
+    assert "Shards   3" in report
+    single_report = (tmp_path / "single" / "matching_report.txt").read_text()
+    # the results are reported as when matching in one process, except that cases
+    # with equally common numbers of matches may be listed in a different order
+    assert parse_match_counts(report) == parse_match_counts(single_report)
+
+    def get_results_report(report):
+        results = report[report.index("After matching:") :]
+        results, _, balance = results.partition("Balance after matching:")
+        return [
+            line
+            for line in results.splitlines()[2:]
+            if not re.fullmatch(r"\d+\.\d+\s+\d+", line)
+        ], [line.split() for line in balance.splitlines()]
+
+    results, balance = get_results_report(report)
+    single_results, single_balance = get_results_report(single_report)
+    assert results == single_results
+    # match variables derived from month_only variables aren't in the outputs, so
+    # their balance is only reported (and counted) when matching in one process
+    assert [line for line in balance if line[:1] != ["Variables"]] == [
+        line
+        for line in single_balance
+        if line[:1] != ["Variables"] and not (line and line[0].endswith("_m"))
+    ]
+
+    # the strata of each shard are combined into the table of all the cases
+    if output_format == "arrow":
+        pd.testing.assert_frame_equal(
+            get_strata(tmp_path / "shards" / "matching_strata.arrow"),
+            get_strata(tmp_path / "single" / "matching_strata.arrow"),
+        )
+    # the metrics are those of matching the shards, and merging them
+    metrics = json.loads((tmp_path / "shards" / "matching_metrics.json").read_text())
+    single_metrics = json.loads(
+        (tmp_path / "single" / "matching_metrics.json").read_text()
+    )
+    assert set(single_metrics["stages"]) <= set(metrics["stages"])
+    assert "merge_shards" in metrics["stages"]
+    assert (
+        metrics["stages"]["matching"]["rows"]
+        == (single_metrics["stages"]["matching"]["rows"])
+    )
+
+
+def test_shard_and_merge_with_missing_values(tmp_path):
+    cases = load_dataframe(FIXTURE_PATH / "input_cases.csv")
+    # cases with the same index date, which are matched in the order they're sorted
+    # into when all are sorted at once
+    cases["indexdate"] = cases["indexdate"].iloc[0]
+    controls = load_dataframe(FIXTURE_PATH / "input_controls.csv")
+    controls.loc[controls.index[::7], "sex"] = None
+    # an integer column with missing values only in controls with no stratum, which
+    # are in no shard
+    controls["visits"] = pd.array(np.arange(len(controls)) % 5, dtype="Int64")
+    controls.loc[controls["sex"].isna(), "visits"] = None
+    # a case that is also a control, in a different stratum (and shard)
+    controls.loc[cases.index[0], ["sex", "age"]] = [
+        "female" if cases["sex"].iloc[0] == "male" else "male",
+        50,
+    ]
+    controls.reset_index().to_feather(tmp_path / "controls.arrow", chunksize=100)
+    config = {
+        "matches_per_case": 5,
+        "match_variables": {"sex": "category", "age": 10},
+        "drop_cases_from_matches": True,
+        "output_columns": {"exclude": ["sex"]},
+    }
+    expected = match(
+        cases.copy(),
+        load_dataframe(tmp_path / "controls.arrow"),
+        get_config(tmp_path / "single", **config),
+    )
+    merged = match_shards(
+        cases.copy(),
+        tmp_path / "controls.arrow",
+        tmp_path / "shards",
+        config,
+        num_shards=2,
+        output_format="arrow",
+    )
+    for expected_df, merged_df in zip(expected, merged):
+        pd.testing.assert_frame_equal(merged_df, expected_df)
+    assert merged[1]["visits"].dtype == "Int64"
+    assert ROW_NUMBER_VARIABLE not in merged[1].columns
+
+
+def test_shard_with_more_shards_than_strata(tmp_path):
+    config = {"matches_per_case": 1, "match_variables": {"sex": "category"}}
+    expected = match(
+        load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        load_dataframe(FIXTURE_PATH / "input_controls.csv"),
+        get_config(tmp_path / "single", **config),
+    )
+    merged = match_shards(
+        load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        FIXTURE_PATH / "input_controls.csv",
+        tmp_path / "shards",
+        config,
+        num_shards=6,
+        output_format="arrow",
+    )
+    for expected_df, merged_df in zip(expected, merged):
+        pd.testing.assert_frame_equal(merged_df, expected_df)
+    # four strata, so two shards are empty
+    manifest = json.loads((tmp_path / "shards" / "shards.json").read_text())
+    assert manifest["num_shards"] == 6
+    shard_sizes = [
+        len(load_dataframe(tmp_path / "shards" / f"controls_shard_{n}.arrow"))
+        for n in range(1, 7)
+    ]
+    assert shard_sizes[4:] == [0, 0]
+
+
+@pytest.mark.parametrize(
+    "config,num_shards,error",
+    [
+        ({}, 0, "The number of shards must be a positive integer"),
+        (
+            {"control_pool_multiple": 2},
+            2,
+            "`control_pool_multiple` cannot be used when matching in shards",
+        ),
+        (
+            {"populations": {"flu": {"matches_per_case": 2}}},
+            2,
+            "`populations` cannot be used when matching in shards",
+        ),
+        ({"match_variables": {"age": 5}, "tiers": [{"age": 1}]}, 2, "tiers"),
+    ],
+)
+def test_shard_config_errors(tmp_path, capsys, config, num_shards, error):
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        shard.shard(
+            load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+            FIXTURE_PATH / "input_controls.csv",
+            get_config(
+                tmp_path,
+                **{
+                    "matches_per_case": 1,
+                    "match_variables": {"sex": "category", "age": 5},
+                    **config,
+                },
+            ),
+            num_shards=num_shards,
+        )
+    assert error in capsys.readouterr().out
+
+
+def test_shard_input_data_errors(tmp_path):
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        shard.shard(
+            load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+            FIXTURE_PATH / "input_controls.csv",
+            get_config(
+                tmp_path,
+                matches_per_case=1,
+                match_variables={"sex": "category", "imd": 1},
+            ),
+            num_shards=2,
+            columns=["patient_id", "sex", "indexdate"],
+        )
+
+
+def test_merge_errors(tmp_path, capsys):
+    config = {"matches_per_case": 1, "match_variables": {"sex": "category"}}
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        shard.merge(get_config(tmp_path, matches_per_case=1))
+
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        shard.merge(get_config(tmp_path, **config))
+    assert (
+        f"Shard manifest not found: {tmp_path / 'shards.json'}"
+        in capsys.readouterr().out
+    )
+
+    shard.shard(
+        load_dataframe(FIXTURE_PATH / "input_cases.csv"),
+        FIXTURE_PATH / "input_controls.csv",
+        get_config(tmp_path, **config),
+        num_shards=2,
+    )
+    match(
+        load_dataframe(tmp_path / "cases_shard_1.arrow"),
+        load_dataframe(tmp_path / "controls_shard_1.arrow"),
+        get_config(tmp_path, output_suffix="_shard_1", **config),
+    )
+    with pytest.raises(ValueError, match="Errors encountered in the input datasets"):
+        shard.merge(get_config(tmp_path, **config))
+    output = capsys.readouterr().out
+    assert (
+        f"Shard output not found: {tmp_path / 'matched_cases_shard_2.arrow'}" in output
+    )
+    assert (
+        f"Shard output not found: {tmp_path / 'matching_results_shard_2.json'}"
+        in output
+    )
+    assert (
+        f"Shard output not found: {tmp_path / 'matching_metrics_shard_2.json'}"
+        in output
+    )
+    assert "matched_cases_shard_1" not in output
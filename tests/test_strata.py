@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from osmatching.index import build_control_index
+from osmatching.strata import (
+    get_case_strata,
+    get_stratum_table,
+    sort_strata,
+    suppress_small_numbers,
+    to_stratum_table,
+)
+from osmatching.utils import MatchConfig, parse_and_validate_config
+
+
+def get_control_index(match_variables, controls):
+    config, errors = parse_and_validate_config(
+        MatchConfig(
+            matches_per_case=1,
+            match_variables=match_variables,
+            index_date_variable="indexdate",
+        )
+    )
+    assert not errors
+    controls["indexdate"] = pd.to_datetime("2020-01-01")
+    return build_control_index(controls, config)
+
+
+def test_get_stratum_table():
+    controls = pd.DataFrame(
+        {"sex": ["F", "M", "F", None, "M", "F"], "age": [20] * 6},
+        index=pd.Index(range(1, 7), name="patient_id"),
+    )
+    control_index = get_control_index({"sex": "category", "age": 5}, controls)
+    cases = pd.DataFrame({"sex": ["M", "F", "X", "F", None]})
+    case_strata = get_case_strata(cases, control_index)
+    # the stratum ids are in order of the first control of each stratum
+    assert list(case_strata) == [1, 0, -1, 0, -1]
+
+    table = get_stratum_table(
+        control_index,
+        case_strata,
+        case_seconds=np.array([1.0, 2.0, 0.5, 3.0, 0.25]),
+        matched_cases=np.array([True, True, False, False, False]),
+        eligible_controls=np.array([True, True, False, True, True, True]),
+        matched_controls=np.array([False, True, False, False, False, True]),
+    )
+    expected = pd.DataFrame(
+        {
+            "sex": ["F", "M", None],
+            "cases": [2, 1, 2],
+            "eligible_controls": [2, 2, 0],
+            "matched_cases": [1, 1, 0],
+            "matched_controls": [1, 1, 0],
+            "seconds": [5.0, 1.0, 0.75],
+        }
+    )
+    pd.testing.assert_frame_equal(table, expected, check_dtype=False)
+
+
+def test_get_case_strata_without_category_variables():
+    controls = pd.DataFrame(
+        {"age": [20, 30]}, index=pd.Index([1, 2], name="patient_id")
+    )
+    control_index = get_control_index({"age": 5}, controls)
+    cases = pd.DataFrame({"age": [20, 40, 50]})
+    assert list(get_case_strata(cases, control_index)) == [0, 0, 0]
+
+
+def test_sort_strata():
+    table = pd.DataFrame(
+        {
+            "sex": ["M", None, "F", "M", "F"],
+            "region": ["London", None, "Wales", "Bristol", "London"],
+            "cases": [1, 2, 3, 4, 5],
+            "eligible_controls": [0] * 5,
+            "matched_cases": [0] * 5,
+            "matched_controls": [0] * 5,
+            "seconds": [0.0] * 5,
+        }
+    )
+    # by each category variable in turn, with the strata of no controls last
+    sorted_table = sort_strata(table)
+    assert sorted_table["cases"].tolist() == [5, 3, 4, 1, 2]
+    assert sorted_table.index.tolist() == list(range(5))
+    # without category variables, there's a single stratum
+    assert sort_strata(table.drop(columns=["sex", "region"]).iloc[:1]).equals(
+        table.drop(columns=["sex", "region"]).iloc[:1]
+    )
+
+
+def test_suppress_small_numbers():
+    table = pd.DataFrame(
+        {
+            "sex": ["F", "M", None],
+            "cases": [100, 12, 8],
+            "eligible_controls": [503, 7, 0],
+            "matched_cases": [98, 12, 0],
+            "matched_controls": [196, 17, 0],
+            "seconds": [1.23456, 0.1, 0.0],
+        }
+    )
+    suppressed = suppress_small_numbers(table)
+    assert list(suppressed.columns) == [
+        "sex",
+        "cases",
+        "eligible_controls",
+        "matched_cases",
+        "matched_controls",
+        "mean_matches_per_case",
+        "seconds",
+    ]
+    # counts of 7 or less are redacted, and others rounded to the nearest 5
+    assert list(suppressed["cases"]) == [100, 10, 10]
+    assert suppressed["eligible_controls"].tolist() == [505, pd.NA, pd.NA]
+    assert suppressed["matched_cases"].tolist() == [100, 10, pd.NA]
+    assert suppressed["matched_controls"].tolist() == [195, 15, pd.NA]
+    # the mean is computed from the rounded counts, and redacted with either of them
+    assert suppressed["mean_matches_per_case"].tolist()[:2] == [1.95, 1.5]
+    assert np.isnan(suppressed["mean_matches_per_case"].iloc[2])
+    # times are redacted with any of the counts of their stratum
+    assert suppressed["seconds"].iloc[0] == 1.235
+    assert suppressed["seconds"].iloc[1:].isna().all()
+
+    stratum_table = to_stratum_table(suppressed)
+    assert stratum_table.schema.metadata is None
+    assert stratum_table.schema.field("cases").type == pa.int64()
@@ -0,0 +1,278 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from osmatching import sweep
+from osmatching.balance import get_balance_table
+from osmatching.index import build_control_index
+from osmatching.osmatching import add_variables, import_data, import_dataframe, match
+from osmatching.utils import MatchConfig, load_dataframe
+from osmatching.validation import parse_and_validate_config
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+
+def get_config(tmp_path, **kwargs):
+    return MatchConfig(
+        **{
+            "matches_per_case": 3,
+            "match_variables": {"sex": "category", "age": 5, "indexdate": "month_only"},
+            "closest_match_variables": ["age"],
+            "index_date_variable": "indexdate",
+            "date_exclusion_variables": {"died_date_ons": "before"},
+            "output_path": tmp_path,
+            **kwargs,
+        }
+    )
+
+
+def test_get_grid_points():
+    assert sweep.get_grid_points(
+        {"matches_per_case": [1, 2], "match_variables.age": [1, 3]}
+    ) == [
+        {"matches_per_case": 1, "match_variables.age": 1},
+        {"matches_per_case": 1, "match_variables.age": 3},
+        {"matches_per_case": 2, "match_variables.age": 1},
+        {"matches_per_case": 2, "match_variables.age": 3},
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_sweep(tmp_path, workers):
+    grid = {"matches_per_case": [1, 3], "match_variables.age": [1, 5]}
+    results = sweep.sweep(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        get_config(tmp_path, drop_cases_from_matches=True),
+        grid,
+        workers=workers,
+    )
+    # the levels of the month of the index date are not all matched at each point
+    assert list(results.columns[: results.columns.get_loc("age_smd") + 1]) == [
+        "matches_per_case",
+        "match_variables.age",
+        "cases",
+        "matched_cases",
+        "match_rate",
+        "cases_with_all_matches",
+        "matches",
+        "mean_matches_per_case",
+        "imbalanced_variables",
+        "sex_female_difference",
+        "sex_female_smd",
+        "sex_male_difference",
+        "sex_male_smd",
+        "sex_intersex_difference",
+        "sex_intersex_smd",
+        "sex_unknown_difference",
+        "sex_unknown_smd",
+        "age_difference",
+        "age_smd",
+    ]
+    assert len(results) == 4
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "sweep.csv"), results)
+
+    # each grid point has the same results as matching with its parameters
+    for _, row in results.iterrows():
+        config = get_config(
+            tmp_path / "match",
+            drop_cases_from_matches=True,
+            matches_per_case=int(row["matches_per_case"]),
+            match_variables={
+                "sex": "category",
+                "age": int(row["match_variables.age"]),
+                "indexdate": "month_only",
+            },
+        )
+        matched_cases, matched_matches = match(
+            load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+            load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+            config,
+        )
+        assert row["matched_cases"] == len(matched_cases)
+        assert row["matches"] == len(matched_matches)
+        balance = get_balance_table(matched_cases, matched_matches, ["sex", "age"])
+        for balance_row in balance.itertuples():
+            name = balance_row.variable
+            if balance_row.level:
+                name = f"{name}_{balance_row.level}"
+            assert row[f"{name}_difference"] == pytest.approx(balance_row.difference)
+            assert row[f"{name}_smd"] == pytest.approx(balance_row.smd, nan_ok=True)
+
+
+def test_sweep_with_thinned_control_pool(tmp_path):
+    grid = {"matches_per_case": [1, 3]}
+    results = [
+        sweep.sweep(
+            load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+            load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+            get_config(tmp_path, control_pool_multiple=control_pool_multiple),
+            grid,
+            workers=1,
+        )
+        for control_pool_multiple in [None, 1000, 1]
+    ]
+    # control pools larger than needed are not thinned
+    pd.testing.assert_frame_equal(results[0], results[1])
+    # thinning leaves fewer controls to choose from
+    assert (results[2]["matches"] <= results[0]["matches"]).all()
+
+
+def test_sweep_with_tiers(tmp_path):
+    config = get_config(
+        tmp_path,
+        min_matches_per_case=1,
+        match_variables={"sex": "category", "age": 0, "indexdate": "month_only"},
+        tiers=[{"age": 0}, {"age": 5}],
+    )
+    results = sweep.sweep(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        config,
+        {"matches_per_case": [1, 3]},
+        workers=1,
+    )
+    # each grid point is matched in the tiers
+    for _, row in results.iterrows():
+        config = get_config(
+            tmp_path / "match",
+            min_matches_per_case=1,
+            matches_per_case=int(row["matches_per_case"]),
+            match_variables={"sex": "category", "age": 0, "indexdate": "month_only"},
+            tiers=[{"age": 0}, {"age": 5}],
+        )
+        matched_cases, matched_matches = match(
+            load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+            load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+            config,
+        )
+        assert row["matched_cases"] == len(matched_cases)
+        assert row["matches"] == len(matched_matches)
+    assert (results["matched_cases"] > 0).all()
+
+    # the ranges of the tiers override those of the grid
+    assert sweep.validate_grid({"match_variables.age": [1, 5]}, config) == {
+        "grid": ["The range of `age` is set by `tiers`, so it cannot be swept"]
+    }
+
+
+def test_load_sweep_data(tmp_path):
+    config, _ = parse_and_validate_config(
+        get_config(
+            tmp_path,
+            min_matches_per_case=1,
+            match_variables={"sex": "category", "age": 0, "indexdate": "month_only"},
+            tiers=[{"age": 0}, {"age": 5}],
+            generate_match_index_date="1_year_earlier",
+        )
+    )
+    cases, matches = import_data(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+        config,
+    )
+    cases, matches = add_variables(cases, matches, config.indicator_variable_name)
+    cases = cases[sweep.get_sweep_columns(cases, config)]
+    matches = matches[sweep.get_sweep_columns(matches, config)]
+    # only the columns used to match and summarise the grid points are kept
+    assert "region" not in matches.columns
+    assert {"sex", "age", "indexdate", "indexdate_m", "set_id", "case"} <= set(
+        matches.columns
+    )
+    control_index = build_control_index(matches, config)
+    available = np.arange(len(matches)) % 2 == 0
+    sweep.write_sweep_data(tmp_path, cases, matches, control_index, available)
+    try:
+        sweep.load_sweep_data(tmp_path, config)
+        pd.testing.assert_frame_equal(sweep.SWEEP_DATA["cases"], cases)
+        pd.testing.assert_frame_equal(sweep.SWEEP_DATA["matches"], matches)
+        # numeric columns are views of the shared file
+        assert not sweep.SWEEP_DATA["matches"]["age"].to_numpy().flags.writeable
+        assert sweep.SWEEP_DATA["config"] is config
+        assert (
+            sweep.SWEEP_DATA["control_index"].stratum_keys == control_index.stratum_keys
+        )
+        np.testing.assert_array_equal(sweep.SWEEP_DATA["available"], available)
+        # the shared data can be matched, and gives the same results as the data
+        # it was written from
+        shared_row = sweep.run_grid_point({"matches_per_case": 2})
+        sweep.SWEEP_DATA.update(cases=cases, matches=matches)
+        assert sweep.run_grid_point({"matches_per_case": 2}) == pytest.approx(
+            shared_row, nan_ok=True
+        )
+        assert shared_row["matches"] > 0
+    finally:
+        sweep.SWEEP_DATA.clear()
+
+
+def test_sweep_with_no_matches(tmp_path):
+    matches = import_dataframe(
+        load_dataframe(FIXTURE_PATH / "input_controls.arrow"), get_config(tmp_path)
+    )
+    results = sweep.sweep(
+        load_dataframe(FIXTURE_PATH / "input_cases.arrow").iloc[:0],
+        matches,
+        get_config(tmp_path),
+        {"min_matches_per_case": [0, 1]},
+        workers=1,
+        control_index=build_control_index(matches, get_config(tmp_path)),
+    )
+    assert list(results["cases"]) == [0, 0]
+    assert results["match_rate"].isna().all()
+    assert results["age_difference"].isna().all()
+
+
+@pytest.mark.parametrize(
+    "grid,expected_errors",
+    [
+        ([1, 2], ["The grid must be a dict of parameters to lists of values"]),
+        ({}, ["The grid must be a dict of parameters to lists of values"]),
+        (
+            {"output_suffix": [1], "match_variables.sex": [1]},
+            [
+                "`output_suffix` cannot be swept. Allowed are matches_per_case, min_matches_per_case and match_variables.<variable>",
+                "`sex` is not a scalar match variable; only the ranges of scalar match variables can be swept",
+            ],
+        ),
+        (
+            {
+                "matches_per_case": [],
+                "min_matches_per_case": ["1"],
+                "match_variables.age": [True, False],
+            },
+            [
+                "`matches_per_case` must be a list of integers",
+                "`min_matches_per_case` must be a list of integers",
+                "`match_variables.age` must be a list of integers",
+            ],
+        ),
+        (
+            {"min_matches_per_case": [1, 4]},
+            [
+                "{'min_matches_per_case': 4}: `min_matches_per_case` (4) cannot be greater than `matches_per_case` (3)"
+            ],
+        ),
+    ],
+)
+def test_sweep_grid_errors(tmp_path, grid, expected_errors):
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        sweep.sweep(
+            load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+            load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+            get_config(tmp_path),
+            grid,
+        )
+    assert sweep.validate_grid(grid, get_config(tmp_path)) == {"grid": expected_errors}
+
+
+def test_sweep_config_errors(tmp_path):
+    with pytest.raises(ValueError, match="There was an error in one or more config"):
+        sweep.sweep(
+            load_dataframe(FIXTURE_PATH / "input_cases.arrow"),
+            load_dataframe(FIXTURE_PATH / "input_controls.arrow"),
+            get_config(tmp_path, min_matches_per_case=5),
+            {"matches_per_case": [1]},
+        )
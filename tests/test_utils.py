@@ -0,0 +1,221 @@
+import gzip
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from osmatching import utils
+from osmatching.utils import iter_record_batches, load_dataframe, write_output_file
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
+
+
+@pytest.fixture
+def output_df():
+    return pd.DataFrame(
+        {
+            "sex": pd.Categorical(["F", "M", None]),
+            "indexdate": pd.to_datetime(["2020-01-01", None, "2021-02-03"]),
+            "admitted": pd.to_datetime(["2020-01-01 10:00", "2020-01-02 00:00", None]),
+            "match_counts": [1.0, None, 2.0],
+            "age": [72, 23, 5],
+            "score": [72.5, 1e-05, 1e16],
+            "has_diagnosis": [True, False, None],
+            "notes": ['a, "quoted" note', None, "other"],
+        },
+        index=pd.Index([1, 2, 3], name="patient_id"),
+    )
+
+
+def read_text(file_path: Path) -> str:
+    if file_path.suffix == ".gz":
+        return gzip.decompress(file_path.read_bytes()).decode()
+    return file_path.read_text()
+
+
+@pytest.mark.parametrize("suffix", ["csv", "csv.gz"])
+@pytest.mark.parametrize("rows", [slice(None), slice(1, None), slice(0)])
+def test_write_csv_output_file(tmp_path, output_df, suffix, rows):
+    output_path = tmp_path / f"output.{suffix}"
+    write_output_file(output_df.iloc[rows], output_path)
+
+    # the output is identical to that written by pandas, with or without values
+    # that need quoting
+    assert read_text(output_path) == output_df.iloc[rows].reset_index().to_csv()
+
+
+def test_write_csv_output_file_without_index(tmp_path, output_df):
+    output_path = tmp_path / "output.csv"
+    write_output_file(output_df, output_path, index=False)
+    assert output_path.read_text() == output_df.reset_index().to_csv(index=False)
+
+
+def test_write_csv_gz_independent_members(tmp_path, output_df, monkeypatch):
+    monkeypatch.setattr(utils, "CSV_BATCH_SIZE", 1)
+    output_path = tmp_path / "output.csv.gz"
+    write_output_file(output_df, output_path)
+
+    lines = read_text(output_path).splitlines()
+    # one header line, then one line per row
+    assert len(lines) == 4
+    assert lines[0] == (
+        ",patient_id,sex,indexdate,admitted,match_counts,age,score,has_diagnosis,notes"
+    )
+    assert lines[1] == (
+        '0,1,F,2020-01-01,2020-01-01 10:00:00,1.0,72,72.5,True,"a, ""quoted"" note"'
+    )
+    assert lines[2] == "1,2,M,,2020-01-02 00:00:00,,23,1e-05,False,"
+    # the header and each row are compressed as separate gzip members
+    assert output_path.read_bytes().count(b"\x1f\x8b\x08") == 4
+
+
+def test_format_csv_column_subsecond_timestamps():
+    column = pa.chunked_array(
+        [pd.to_datetime(["2020-01-01 10:00:00.5", "2020-01-02 00:00:00.0"])]
+    )
+    assert utils.format_csv_column(column).type == pa.timestamp("ns")
+
+
+@pytest.mark.parametrize("compression", ["lz4", "zstd", "uncompressed"])
+def test_write_arrow_output_file(tmp_path, output_df, compression):
+    output_path = tmp_path / "output.arrow"
+    write_output_file(output_df, output_path, compression=compression)
+
+    written = pd.read_feather(output_path)
+    pd.testing.assert_frame_equal(written, output_df.reset_index())
+    assert written.sex.dtype.name == "category"
+    with pa.ipc.open_file(output_path) as reader:
+        assert reader.schema.metadata is None
+
+
+def test_combine_output_tables():
+    cases = utils.to_output_table(
+        pd.DataFrame(
+            {
+                "sex": pd.Categorical(["F", "M"]),
+                "age": [30, 40],
+                "notes": ["a", "b"],
+                "empty": [None, None],
+                "match_counts": [1.0, 2.0],
+                "practice_id": [72, -75],
+            },
+            index=pd.Index([1, 2], name="patient_id"),
+        )
+    )
+    matches = utils.to_output_table(
+        pd.DataFrame(
+            {
+                "sex": pd.Categorical(["M", "U"]),
+                "age": [31.5, 41.0],
+                "notes": [1, 2],
+                "empty": pd.to_datetime(["2020-01-01", "2020-02-01"]),
+            },
+            index=pd.Index([3, 4], name="patient_id"),
+        )
+    )
+    combined = utils.combine_output_tables([cases, matches])
+
+    assert combined.column_names == [
+        "patient_id",
+        "sex",
+        "age",
+        "notes",
+        "empty",
+        "match_counts",
+        "practice_id",
+    ]
+    # categories are unified, and stay dictionary-encoded
+    assert combined.column("sex").chunk(0).dictionary.to_pylist() == ["F", "M", "U"]
+    assert combined.column("sex").to_pylist() == ["F", "M", "M", "U"]
+    # numeric types are promoted
+    assert combined.column("age").to_pylist() == [30, 40, 31.5, 41]
+    # incompatible types are cast to strings
+    assert combined.column("notes").to_pylist() == ["a", "b", "1", "2"]
+    # columns with no values take the type of the other table's column
+    assert combined.schema.field("empty").type == pa.timestamp("ns")
+    # missing columns are filled with nulls
+    assert combined.column("match_counts").to_pylist() == [1.0, 2.0, None, None]
+    # as pd.concat fills them with NaN, integer columns with missing values are floats
+    assert combined.schema.field("practice_id").type == pa.float64()
+    assert combined.schema.field("age").type == pa.float64()
+
+    # empty tables are not included, unless all tables are empty
+    assert utils.combine_output_tables([cases, matches.slice(0, 0)]).equals(cases)
+    assert (
+        utils.combine_output_tables([cases.slice(0, 0), matches.slice(0, 0)]).num_rows
+        == 0
+    )
+    # categorical columns with no categories
+    no_categories = utils.to_output_table(
+        pd.DataFrame(
+            {"sex": pd.Categorical([], categories=pd.Index([], dtype=object))},
+            index=pd.Index([], name="patient_id", dtype="int64"),
+        )
+    )
+    combined = utils.combine_output_tables([no_categories, no_categories])
+    assert combined.num_rows == 0
+    assert combined.schema == no_categories.schema
+
+
+@pytest.mark.parametrize(
+    "output_columns,expected",
+    [
+        ({}, ["sex", "age", "died_date", "previous_event", "set_id", "case"]),
+        ({"include": ["sex"]}, ["sex", "set_id", "case"]),
+        ({"exclude": ["*_date", "previous_*"]}, ["sex", "age", "set_id", "case"]),
+        (
+            {"include": ["age", "previous_*", "died_date"], "exclude": ["died_*"]},
+            ["age", "previous_event", "set_id", "case"],
+        ),
+        # set_id and the indicator variable cannot be excluded
+        ({"exclude": ["*"]}, ["set_id", "case"]),
+    ],
+)
+def test_select_output_columns(output_columns, expected):
+    config = utils.MatchConfig(output_columns=output_columns)
+    columns = ["sex", "age", "died_date", "previous_event", "set_id", "case"]
+    assert utils.select_output_columns(columns, config) == expected
+
+
+def test_select_input_columns():
+    config = utils.MatchConfig(
+        match_variables={"sex": "category", "age": 5},
+        index_date_variable="indexdate",
+        date_exclusion_variables={"died_date_ons": "before"},
+    )
+    columns = ["patient_id", "sex", "age", "indexdate", "region", "died_date_ons"]
+    # all columns are loaded by default
+    assert utils.select_input_columns(columns, config) is None
+
+    config.output_columns = {"include": ["region"]}
+    assert utils.select_input_columns(columns, config) == columns
+
+    config.output_columns = {"exclude": ["region", "died_*"]}
+    assert utils.select_input_columns(columns, config) == [
+        "patient_id",
+        "sex",
+        "age",
+        "indexdate",
+        "died_date_ons",
+    ]
+
+
+@pytest.mark.parametrize("suffix", ["csv", "csv.gz", "arrow"])
+def test_load_dataframe_columns(suffix):
+    df = utils.load_dataframe(
+        FIXTURE_PATH / f"input_controls.{suffix}", columns=["patient_id", "age"]
+    )
+    assert list(df.columns) == ["age"]
+    assert df.index.name == "patient_id"
+    assert len(df) == 1000
+
+
+@pytest.mark.parametrize("suffix", ["csv", "csv.gz", "arrow"])
+@pytest.mark.parametrize("columns", [None, ["patient_id", "sex", "died_date_ons"]])
+def test_iter_record_batches(suffix, columns):
+    file_path = FIXTURE_PATH / f"input_controls.{suffix}"
+    batches = list(iter_record_batches(file_path, columns))
+    dataframe = pa.Table.from_batches(batches).to_pandas().set_index("patient_id")
+    pd.testing.assert_frame_equal(dataframe, load_dataframe(file_path, columns))
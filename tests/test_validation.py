@@ -1,10 +1,18 @@
 from pathlib import Path
 
-import pandas as pd
+import pyarrow as pa
 import pytest
 
-from osmatching.utils import MatchConfig, parse_and_validate_config
-from osmatching.validation import get_match_index_date_offset, validate_input_data
+from osmatching.utils import MatchConfig, parse_and_validate_config, read_schema
+from osmatching.validation import (
+    get_match_index_date_offset,
+    get_population_config,
+    validate_input_schema,
+    validate_matches_schema,
+)
+
+
+FIXTURE_PATH = Path(__file__).parent / "test_data" / "fixtures"
 
 
 CONFIG_DICT_DEFAULTS = {
@@ -133,6 +141,268 @@ def test_match_variables_types():
     }
 
 
+@pytest.mark.parametrize(
+    "compression,error",
+    [
+        ("lz4", None),
+        ("zstd", None),
+        ("uncompressed", None),
+        (
+            "gzip",
+            ["Invalid output compression 'gzip'. Allowed are lz4, zstd, uncompressed"],
+        ),
+    ],
+)
+def test_output_compression(compression, error):
+    config = get_match_config({"output_compression": compression})
+    config, errors = parse_and_validate_config(config)
+    assert errors.get("output_compression") == error
+
+
+@pytest.mark.parametrize(
+    "engine,error",
+    [
+        ("pandas", None),
+        ("arrow", None),
+        ("polars", ["Invalid engine 'polars'. Allowed are pandas, arrow"]),
+    ],
+)
+def test_engine(engine, error):
+    config = get_match_config({"engine": engine})
+    config, errors = parse_and_validate_config(config)
+    assert errors.get("engine") == error
+
+
+def test_control_cache_max_size():
+    config = get_match_config({"control_cache_max_size_mb": -1})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {
+        "control_cache_max_size_mb": [
+            "`control_cache_max_size_mb` must not be negative"
+        ]
+    }
+
+    config = get_match_config({"control_cache_max_size_mb": "1GB"})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {
+        "control_cache_max_size_mb": ["`control_cache_max_size_mb` must be an integer"]
+    }
+
+
+def test_output_columns():
+    config = get_match_config({"output_columns": None})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {}
+    assert config.output_columns == {}
+
+    config = get_match_config(
+        {
+            "output_columns": {
+                "include": ["age", "sex"],
+                "exclude": "region",
+                "keep": ["imd"],
+            }
+        }
+    )
+    config, errors = parse_and_validate_config(config)
+    assert errors == {
+        "output_columns": [
+            "`exclude` must be a list of column names or patterns",
+            "Invalid key 'keep'. Allowed are 'include' and 'exclude'",
+        ]
+    }
+
+    config = get_match_config({"output_columns": ["age"]})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {
+        "output_columns": [
+            "`output_columns` must be a dict with `include` and/or `exclude` lists"
+        ]
+    }
+
+
+def test_balance_variables():
+    config = get_match_config({"balance_variables": None})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {}
+    assert config.balance_variables == []
+
+    config = get_match_config({"balance_variables": "region"})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {
+        "balance_variables": ["`balance_variables` must be a list of column names"]
+    }
+    assert config.balance_variables == []
+
+
+def test_populations():
+    config = get_match_config({"populations": None})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {}
+    assert config.populations == {}
+
+    config = get_match_config(
+        {
+            "output_suffix": "_study",
+            "populations": {
+                "covid": {"matches_per_case": 3},
+                "flu": {"output_path": "flu_output"},
+            },
+        }
+    )
+    config, errors = parse_and_validate_config(config)
+    assert errors == {}
+    covid_config = get_population_config(config, "covid")
+    assert covid_config.matches_per_case == 3
+    assert covid_config.output_suffix == "_study_covid"
+    assert covid_config.populations == {}
+    flu_config = get_population_config(config, "flu")
+    assert flu_config.matches_per_case == 1
+    assert flu_config.output_suffix == "_study_flu"
+    assert not flu_config.validated
+    flu_config, _ = parse_and_validate_config(flu_config)
+    assert flu_config.output_path == Path("flu_output")
+
+
+def test_population_errors():
+    config = get_match_config({"populations": ["covid"]})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {
+        "populations": [
+            "`populations` must be a dict of population names to config overrides"
+        ]
+    }
+
+    config = get_match_config(
+        {
+            "populations": {
+                "covid": {"unknown": 1, "control_cache_path": "cache"},
+                "flu": {"min_matches_per_case": 2},
+                "pneumonia": "_pneumonia",
+                "other": {},
+                "influenza": {"output_suffix": "_other"},
+            },
+        }
+    )
+    config, errors = parse_and_validate_config(config)
+    assert errors == {
+        "populations": [
+            "`covid`: `unknown` cannot be set for a population",
+            "`covid`: `control_cache_path` cannot be set for a population",
+            "`flu`: `min_matches_per_case` (2) cannot be greater than `matches_per_case` (1)",
+            "`pneumonia`: overrides must be a dict of config options",
+            "`influenza`: `output_suffix` '_other' is used by more than one population",
+        ]
+    }
+
+
+@pytest.mark.parametrize(
+    "control_pool_multiple,error",
+    [
+        (None, None),
+        (5, None),
+        (0, ["`control_pool_multiple` must be a positive integer"]),
+        (1.5, ["`control_pool_multiple` must be a positive integer"]),
+    ],
+)
+def test_control_pool_multiple(control_pool_multiple, error):
+    config = get_match_config({"control_pool_multiple": control_pool_multiple})
+    config, errors = parse_and_validate_config(config)
+    assert errors.get("control_pool_multiple") == error
+
+
+def test_partition_memory_mb():
+    config = get_match_config(
+        {"partition_memory_mb": 100, "match_variables": {"sex": "category"}}
+    )
+    config, errors = parse_and_validate_config(config)
+    assert errors == {}
+
+    config = get_match_config(
+        {
+            "partition_memory_mb": 0,
+            "control_pool_multiple": 2,
+            "populations": {"covid": {}},
+        }
+    )
+    config, errors = parse_and_validate_config(config)
+    assert errors["partition_memory_mb"] == [
+        "`partition_memory_mb` must be a positive integer",
+        "`partition_memory_mb` requires at least one 'category' or 'month_only' match variable, to partition the controls by",
+        "`partition_memory_mb` cannot be used with `control_pool_multiple`",
+        "`partition_memory_mb` cannot be used with `populations`",
+    ]
+
+
+@pytest.mark.parametrize(
+    "config,error",
+    [
+        ({"checkpoint_interval": None}, None),
+        ({"checkpoint_interval": 1000}, None),
+        (
+            {"checkpoint_interval": 0},
+            ["`checkpoint_interval` must be a positive integer"],
+        ),
+        (
+            {
+                "checkpoint_interval": 10,
+                "partition_memory_mb": 100,
+                "match_variables": {"sex": "category"},
+            },
+            ["`checkpoint_interval` cannot be used with `partition_memory_mb`"],
+        ),
+    ],
+)
+def test_checkpoint_interval(config, error):
+    config, errors = parse_and_validate_config(get_match_config(config))
+    assert errors.get("checkpoint_interval") == error
+
+
+def test_tiers():
+    config = get_match_config({"tiers": None})
+    config, errors = parse_and_validate_config(config)
+    assert errors == {}
+    assert config.tiers == []
+
+    config = get_match_config(
+        {"tiers": [{"age": 1}, {"age": 3}], "min_matches_per_case": 1}
+    )
+    config, errors = parse_and_validate_config(config)
+    assert errors == {}
+
+
+@pytest.mark.parametrize(
+    "config_vars,error",
+    [
+        (
+            {"tiers": {"age": 1}},
+            ["`tiers` must be a list of dicts of match variables to ranges"],
+        ),
+        (
+            {"tiers": [{"age": 1}], "min_matches_per_case": 0},
+            ["`min_matches_per_case` must be at least 1 to match in tiers"],
+        ),
+        (
+            {
+                "match_variables": {"age": 5, "sex": "category"},
+                "tiers": [{"sex": 1}, {"age": -1, "imd": 2}, {"age": True}],
+                "min_matches_per_case": 1,
+            },
+            [
+                "Tier 1: `sex` is not a scalar match variable",
+                "Tier 2: the range of `age` must be a non-negative integer",
+                "Tier 2: `imd` is not a scalar match variable",
+                "Tier 3: the range of `age` must be a non-negative integer",
+            ],
+        ),
+    ],
+)
+def test_tiers_errors(config_vars, error):
+    config = get_match_config(config_vars)
+    config, errors = parse_and_validate_config(config)
+    assert errors == {"tiers": error}
+
+
 @pytest.mark.parametrize(
     "offset_str, offset",
     [
@@ -168,12 +438,12 @@ def test_generate_match_index_date_error(offset_str, error):
     assert errors["generate_match_index_date"] == [error]
 
 
-def test_validate_input_data_missing_index_date():
+def test_validate_input_schema_missing_index_date():
     config = get_match_config({})
     # we require index_date and age columns
-    cases = pd.DataFrame.from_records([{"age": 36}])
-    matches = pd.DataFrame.from_records([{"age": 30}])
-    errors = validate_input_data(cases, matches, config)
+    cases = pa.schema([("age", pa.int64())])
+    matches = pa.schema([("age", pa.int64())])
+    errors = validate_input_schema(cases, matches, config)
     assert errors == {
         "index_date_variable": [
             "column `index_date` not found in cases dataset",
@@ -182,7 +452,7 @@ def test_validate_input_data_missing_index_date():
     }
 
     config.generate_match_index_date = "no_offset"
-    errors = validate_input_data(cases, matches, config)
+    errors = validate_input_schema(cases, matches, config)
     assert errors == {
         "index_date_variable": [
             "column `index_date` not found in cases dataset",
@@ -190,24 +460,89 @@ def test_validate_input_data_missing_index_date():
     }
 
 
-def test_validate_input_data_required_columns():
+def test_validate_input_schema_required_columns():
     config = get_match_config(
         {
             "match_variables": {"age": 5, "index_date": "month_only"},
             "closest_match_variables": ["region", "imd"],
+            "balance_variables": ["bmi"],
             "date_exclusion_variables": {"event_date": "1_year_earlier"},
         }
     )
-    cases = pd.DataFrame.from_records(
-        [{"index_date": "2025-01-01", "region": "South West", "age": 30}]
+    cases = pa.schema(
+        [("index_date", pa.string()), ("region", pa.int64()), ("age", pa.int64())]
     )
-    matches = pd.DataFrame.from_records(
-        [{"index_date": "2025-02-01", "region": "Londong"}]
-    )
-    errors = validate_input_data(cases, matches, config)
+    matches = pa.schema([("index_date", pa.string()), ("region", pa.int64())])
+    errors = validate_input_schema(cases, matches, config)
     assert errors == {
         "required_columns": [
-            "column(s) `event_date`, `imd` not found in cases dataset",
-            "column(s) `age`, `event_date`, `imd` not found in matches dataset",
+            "column(s) `bmi`, `event_date`, `imd` not found in cases dataset",
+            "column(s) `age`, `bmi`, `event_date`, `imd` not found in matches dataset",
         ]
     }
+
+
+@pytest.mark.parametrize("suffix", ["csv", "csv.gz", "arrow"])
+def test_read_schema(suffix):
+    schema = read_schema(FIXTURE_PATH / f"input_controls.{suffix}")
+    assert schema.names == [
+        "patient_id",
+        "sex",
+        "age",
+        "indexdate",
+        "region",
+        "died_date_ons",
+        "previous_event",
+    ]
+    assert pa.types.is_integer(schema.field("age").type)
+    assert pa.types.is_date(schema.field("indexdate").type)
+
+
+def test_validate_input_schema():
+    config = get_match_config(
+        {
+            "match_variables": {
+                "age": 5,
+                "sex": "category",
+                "index_date": "month_only",
+            },
+            "closest_match_variables": ["score"],
+            "date_exclusion_variables": {"died_date": "before"},
+        }
+    )
+    cases_schema = pa.schema(
+        [
+            ("index_date", pa.date32()),
+            ("age", pa.int64()),
+            ("sex", pa.dictionary(pa.int8(), pa.string())),
+            ("score", pa.float64()),
+            # empty columns in csv files have a null type
+            ("died_date", pa.null()),
+        ]
+    )
+    matches_schema = pa.schema(
+        [
+            ("index_date", pa.string()),
+            ("age", pa.string()),
+            ("sex", pa.int64()),
+            ("died_date", pa.int64()),
+        ]
+    )
+    errors = validate_input_schema(cases_schema, matches_schema, config)
+    assert errors == {
+        "required_columns": [
+            "column(s) `score` not found in matches dataset",
+        ],
+        "column_types": [
+            "column `age` in matches dataset has type string; expected numeric values",
+            "column `died_date` in matches dataset has type int64; expected date values",
+        ],
+    }
+    # the matches schema can be validated alone
+    assert validate_matches_schema(matches_schema, config) == errors
+
+    timestamp_schema = pa.schema(
+        [(name, pa.timestamp("ns")) for name in ["index_date", "died_date"]]
+        + [(name, pa.int32()) for name in ["age", "sex", "score"]]
+    )
+    assert validate_input_schema(timestamp_schema, timestamp_schema, config) == {}